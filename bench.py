@@ -0,0 +1,154 @@
+import os, sys, json, time, argparse, platform, itertools, subprocess, tempfile
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# Benchmark of the demos: each configuration of the matrix (resolution x local size x NB_BODY) is run in its
+# own headless process (frames synchronized with the GPU), its per-frame timings (--timings) are reduced to
+# mean / p50 / p95 / p99 after the warm-up frames.
+#
+#   run    : sweep the matrix, results saved to a JSON file
+#   compare: flag the regressions of a result file against a baseline
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# matrix axes supported by each demo (ray-fractal: O(N^2) gravity, run with its default bodies)
+DEMOS = {
+    "ray-tracing"   : ("size", "group_size"),
+    "ray-fractal"   : ("size", "group_size"),
+    "ray-cs-texture": ("size", "group_size", "body"),
+    "ray-marching"  : ("size",),
+}
+
+# options of each demo pinned for the benchmark (ray-marching: render scale not adjusted to the frame time,
+# simulations: one step per frame, not the steps of the real time elapsed)
+DEMO_OPTIONS = {
+    "ray-fractal"   : ["--substeps=1"],
+    "ray-cs-texture": ["--substeps=1"],
+    "ray-marching"  : ["--target_fps=0"],
+}
+
+def get_stats(values):
+    values = np.asarray(values)
+    return {"mean": float(values.mean()),
+            "p50" : float(np.percentile(values, 50)),
+            "p95" : float(np.percentile(values, 95)),
+            "p99" : float(np.percentile(values, 99))}
+
+def run_demo(demo, config, warmup, frames):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        timings_file = os.path.join(tmp_dir, "timings.json")
+
+        # --sync: each frame is finished by the GPU before its time is taken
+        cmd = [sys.executable, "main.py", "--headless", "--sync", f"--frames={warmup + frames}", f"--timings={timings_file}"]
+        cmd += [f"--{axis}={value}" for axis, value in config.items()]
+        cmd += DEMO_OPTIONS.get(demo, [])
+        if "body" in config:
+            cmd += ["--seed=0", "--gpu_init"]
+
+        process = subprocess.run(cmd, cwd=os.path.join(ROOT, demo), capture_output=True, text=True)
+        if process.returncode != 0:
+            print(process.stdout + process.stderr)
+            raise RuntimeError(f"{demo} {config} failed")
+
+        with open(timings_file) as file:
+            records = json.load(file)[warmup:]
+
+    passes = list(dict.fromkeys(name for record in records for name in record if name not in ("frame", "frame_ms")))
+
+    return {"demo": demo, **config,
+            "frame": get_stats([record["frame_ms"] for record in records]),
+            "passes": {name: get_stats([record[name] for record in records if name in record]) for name in passes}}
+
+def run(args):
+    results = []
+
+    for demo in args["demos"]:
+        axes = {"size": args["sizes"], "group_size": args["group_sizes"], "body": args["bodies"]}
+        axes = {axis: values for axis, values in axes.items() if axis in DEMOS[demo]}
+
+        for values in itertools.product(*axes.values()):
+            config = dict(zip(axes.keys(), values))
+
+            result = run_demo(demo, config, args["warmup"], args["frames"])
+            results.append(result)
+
+            frame = result["frame"]
+            print(f"{demo:15s} {get_name(result):40s} frame mean {frame['mean']:8.3f} | p50 {frame['p50']:8.3f} | p95 {frame['p95']:8.3f} | p99 {frame['p99']:8.3f} ms")
+
+    with open(args["output"], "w") as file:
+        json.dump({"date": time.strftime("%Y-%m-%d %H:%M:%S"), "host": platform.node(), "python": platform.python_version(),
+                   "warmup": args["warmup"], "frames": args["frames"], "results": results}, file, indent=1)
+
+    print(f"Results saved to {args['output']}")
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_name(result):
+    return " ".join(f"{axis}={result[axis]}" for axis in ("size", "group_size", "body") if axis in result)
+
+def compare(args):
+    with open(args["baseline"]) as file:
+        baseline = {(result["demo"], get_name(result)): result for result in json.load(file)["results"]}
+
+    with open(args["results"]) as file:
+        results = json.load(file)["results"]
+
+    metric = args["metric"]
+    nb_regressions = 0
+
+    for result in results:
+        key = (result["demo"], get_name(result))
+        if key not in baseline:
+            continue
+
+        old, new = baseline[key]["frame"][metric], result["frame"][metric]
+        ratio = new / old - 1.0
+
+        status = ""
+        if ratio > args["threshold"]:
+            status = "REGRESSION"
+            nb_regressions += 1
+        elif ratio < -args["threshold"]:
+            status = "improvement"
+
+        print(f"{key[0]:15s} {key[1]:40s} {metric} {old:8.3f} -> {new:8.3f} ms ({100 * ratio:+6.1f}%) {status}")
+
+    print(f"{nb_regressions} regression(s) above {100 * args['threshold']:.0f}%")
+    return nb_regressions
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 bench.py run --output=base.json
+# python3 bench.py run --demos ray-cs-texture --sizes 640x400 1280x800 --group_sizes 64x1 256x1 --bodies 4096 1000000 --output=new.json
+# python3 bench.py compare base.json new.json --metric=p95 --threshold=0.1
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Sweep the benchmark matrix")
+    run_parser.add_argument('--demos', help='Demos to run', nargs='+', default=list(DEMOS), choices=list(DEMOS))
+    run_parser.add_argument('--sizes', help='Screen sizes WxH', nargs='+', default=["640x400", "1280x800"])
+    run_parser.add_argument('--group_sizes', help='Local work group sizes XxY (compute demos)', nargs='+', default=["64x1", "8x8"])
+    run_parser.add_argument('--bodies', help='NB_BODY values (demos with bodies)', nargs='+', default=[4096, 1000000], type=int)
+    run_parser.add_argument('--warmup', help='Warm-up frames, not measured', default=30, type=int)
+    run_parser.add_argument('--frames', help='Measured frames', default=200, type=int)
+    run_parser.add_argument('-o', '--output', help='Result file', default="bench.json", type=str)
+
+    compare_parser = subparsers.add_parser("compare", help="Flag the regressions between two result files")
+    compare_parser.add_argument('baseline', help='Baseline result file')
+    compare_parser.add_argument('results', help='Result file to check')
+    compare_parser.add_argument('--metric', help='Frame time statistic compared', default="p50", choices=("mean", "p50", "p95", "p99"))
+    compare_parser.add_argument('--threshold', help='Relative slowdown reported as a regression', default=0.05, type=float)
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    if args["command"] == "run":
+        run(args)
+    else:
+        sys.exit(1 if compare(args) else 0)
+
+if __name__ == "__main__":
+    main()
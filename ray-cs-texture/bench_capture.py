@@ -0,0 +1,61 @@
+import os, time, argparse, tempfile
+
+import numpy as np
+import pygame
+
+from config import ScreenRecorder
+
+# -----------------------------------------------------------------------------------------------------------
+# Microbenchmark of the ScreenRecorder frame conversion (texture RGBA bytes => open-cv BGR frame)
+#
+#   surface: bytes => pygame.image.fromstring => pixels3d => cv2.rotate => cv2.flip => cv2.cvtColor
+#   rgba   : bytes => NumPy view => cv2.cvtColor into a preallocated frame => in-place cv2.flip
+
+def bench(width, height, nb_frames):
+    data = np.random.default_rng(0).integers(0, 256, width * height * 4, dtype=np.uint8).tobytes()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        recorder = ScreenRecorder(width, height, 60, out_file=os.path.join(tmp_dir, 'bench.avi'))
+
+        def surface_path():
+            pg_surface = pygame.image.fromstring(data, (width, height), 'RGBA', True)
+            return recorder.surface_to_bgr(pg_surface)
+
+        def rgba_path():
+            return recorder.rgba_to_bgr(data)
+
+        if not np.array_equal(surface_path(), rgba_path()):
+            raise RuntimeError("surface and rgba paths disagree")
+
+        results = {}
+        for name, path in (("surface", surface_path), ("rgba", rgba_path)):
+            t0 = time.perf_counter()
+            for _ in range(nb_frames):
+                path()
+            results[name] = 1000 * (time.perf_counter() - t0) / nb_frames
+
+        recorder.end_recording()
+
+    return results
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 bench_capture.py
+# python3 bench_capture.py --frames=50 --size 1280x800 3840x2160
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('--frames', help='Number of converted frames per size', default=100, type=int)
+    parser.add_argument('--size', help='Frame sizes WxH', nargs='+', default=["1280x800", "3840x2160"])
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    for size in args["size"]:
+        width, height = (int(v) for v in size.lower().split("x"))
+        results = bench(width, height, args["frames"])
+        print(f"{width}x{height}: surface {results['surface']:7.3f} ms/frame | rgba {results['rgba']:7.3f} ms/frame | x{results['surface'] / results['rgba']:.1f}")
+
+if __name__ == "__main__":
+    main()
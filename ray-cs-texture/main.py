@@ -1,4 +1,4 @@
-import sys, argparse, random
+import os, sys, argparse, random
 
 import pygame as pg
 import numpy as np
@@ -7,54 +7,138 @@ import glm
 from array import array
 
 from config import *
-from shader_program import ShaderProgram
+from shader_program import ShaderProgram, setup_shader_cache
 
 # -----------------------------------------------------------------------------------------------------------
 
+# Body
+# {
+#    vec4 pos;  // x, y, z, w
+#    vec4 dat;  // angle, ID, nop, nop
+# };
+BODY_DTYPE = np.dtype([('pos', 'f4', 4), ('dat', 'f4', 4)])
+
+# number of bodies drawn per batch from the random generator (bounds the transient memory)
+INIT_CHUNK = 1 << 20
+
+def get_morton(x, y):
+    # bits of x / y interleaved (x in the even bits), as spread_bits() of sort_cs.glsl
+    key = 0
+    for bit in range(16):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+def get_particles(nb_body, seed):
+    rng = np.random.default_rng(seed)
+
+    bodies = np.empty(nb_body, dtype=BODY_DTYPE)
+
+    for start in range(0, nb_body, INIT_CHUNK):
+        chunk = bodies[start:start + INIT_CHUNK]
+
+        chunk['pos'][:, :3] = rng.uniform(-0.99, 0.99, (len(chunk), 3))
+        chunk['pos'][:, 3]  = 1.0
+        chunk['dat'][:, 0]  = rng.uniform(0.0, 6.2831853, len(chunk))
+        chunk['dat'][:, 1]  = np.arange(start, start + len(chunk))
+        chunk['dat'][:, 2:] = 0.0
+
+    return bodies
+
 class Bodies:
 
     def __init__(self, app):
         self.app = app
         self.ctx = app.ctx
 
-        particles_array = self.get_particles()
-        self.ssbo_in    = self.ctx.buffer(data = particles_array)
+        if self.app.gpu_init:
+            self.ssbo_in = self.ctx.buffer(reserve=self.app.nb_body * BODY_DTYPE.itemsize)
+            self.init_on_gpu()
+        else:
+            particles_array = get_particles(self.app.nb_body, self.app.seed)
+            self.ssbo_in    = self.ctx.buffer(data = particles_array)
+
+        # --sort_every: sorted copy of the bodies (swapped with ssbo_in after each sort), bodies per tile key
+        if self.app.sort_every:
+            self.ssbo_out = self.ctx.buffer(reserve=self.app.nb_body * BODY_DTYPE.itemsize)
+            self.counts = self.ctx.buffer(reserve=self.app.sort_keys * 4)
 
     def destroy(self):
         self.ssbo_in.release()
+        if self.app.sort_every:
+            self.ssbo_out.release()
+            self.counts.release()
+
+    def init_on_gpu(self):
+        init_shader = self.app.all_shaders.get_compute_program("init")
+
+        self.app.set_uniform(init_shader, "NB_BODY", self.app.nb_body)
+        self.app.set_uniform(init_shader, "SEED", self.app.seed)
 
-    def get_particles(self):
+        # CS: layout(std430, binding = 0) buffer bodies_in
+        self.ssbo_in.bind_to_storage_buffer(0)
 
-        # Body
-        # {
-        #    vec4 pos;  // x, y, z, w
-        #    vec4 dat;  // angle, ID, nop, nop
-        # };
+        group_x, group_y = self.app.get_body_groups()
+        init_shader.run(group_x=group_x, group_y=group_y, group_z=1)
 
-        bodies = []
-        for i in range(0, self.app.nb_body):
-            posx, posy, posz = random.uniform(-0.99, 0.99), random.uniform(-0.99, 0.99), random.uniform(-0.99, 0.99)
+        self.ctx.memory_barrier()
 
-            bodies.extend((posx, posy, posz, 1.0))
-            bodies.extend((random.uniform(0.0, 6.2831853), i, 0.0, 0.0))
+    def sort(self):
+        # counting sort by trail map tile (Morton order): histogram, scan, scatter into ssbo_out, buffers swapped
+        self.ssbo_in.bind_to_storage_buffer(0)
+        self.ssbo_out.bind_to_storage_buffer(1)
+        self.counts.bind_to_storage_buffer(2)
+        self.counts.clear()
 
-        vertex_data = np.asarray(bodies, dtype='f4') #vertex_data = np.array(bodies, dtype='f4')
+        histogram_shader, scan_shader, scatter_shader = self.app.sort_shaders
+        group_x, group_y = self.app.get_body_groups()
 
-        return vertex_data
+        histogram_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+        self.ctx.memory_barrier()
+
+        scan_shader.run(group_x=1, group_y=1, group_z=1)
+        self.ctx.memory_barrier()
+
+        scatter_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+        self.ctx.memory_barrier()
+
+        self.ssbo_in, self.ssbo_out = self.ssbo_out, self.ssbo_in
 
 # -----------------------------------------------------------------------------------------------------------
 
 class App:
 
-    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, nb_body=4096, fps=-1, record_video="", video_fps=60):
+    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, nb_body=4096, fps=-1, record_video="", video_fps=60, readback_buffers=3, headless=False, frames=-1, seed=None, gpu_init=False, diffuse_radius=DIFFUSE_RADIUS, diffuse_kernel=DIFFUSE_KERNEL, hot_reload=False, timings="", group_size=None, autotune=False, sync=False, sim_dt=SIM_DT, substeps=0, fast_forward=0, sort_every=0):
 
         self.screen_width = screen_width
         self.screen_height = screen_height
         self.max_fps = fps
         self.nb_body = nb_body
 
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.gpu_init = gpu_init
+        self.diffuse_radius = diffuse_radius
+        self.diffuse_kernel = diffuse_kernel
+
+        self.headless = headless
+        self.max_frames = frames
+        self.hot_reload = hot_reload
+        self.timings = timings
+        self.sync = sync
+        self.group_size = group_size
+        self.autotune = autotune
+
+        # fixed timestep: steps of sim_dt ms, --substeps / --fast_forward per displayed frame (else in real time)
+        self.sim_dt = sim_dt
+        self.substeps = substeps
+        self.fast_forward = fast_forward
+
+        # --sort_every: bodies sorted by tile every N simulation steps, keys: Morton codes of the SORT_TILE pixels tiles
+        self.sort_every = sort_every
+        self.sort_keys = get_morton((self.screen_width - 1) // SORT_TILE, (self.screen_height - 1) // SORT_TILE) + 1
+
         self.record_video = record_video
         self.video_fps = video_fps
+        self.readback_buffers = readback_buffers
 
         if self.record_video:
             if self.record_video in ("XVID", "h264", "avc1", "mp4v"):
@@ -63,17 +147,15 @@ class App:
                 self.video_recorder = ScreenRecorder(self.screen_width, self.screen_height, self.video_fps)
 
         #
-        print("SCREEN WIDTH =", SCREEN_WIDTH)
-        print("SCREEN HEIGHT=", SCREEN_HEIGHT)
-
-        print("X LOCAL  GROUPSIZE=", XGROUPSIZE)
-        print("Y LOCAL  GROUPSIZE=", YGROUPSIZE)
-        print("Z LOCAL  GROUPSIZE=", ZGROUPSIZE)
-        print("X GLOBAL GROUPSIZE=", SCREEN_WIDTH // XGROUPSIZE)
-        print("Y GLOBAL GROUPSIZE=", SCREEN_HEIGHT // YGROUPSIZE)
-        print("Z GLOBAL GROUPSIZE=", 1)
+        print("SCREEN WIDTH =", self.screen_width)
+        print("SCREEN HEIGHT=", self.screen_height)
 
         print("NB_BODY=", self.nb_body)
+        print("SEED=", self.seed)
+        print("DIFFUSE_RADIUS=", self.diffuse_radius)
+        print("DIFFUSE_KERNEL=", self.diffuse_kernel)
+        print("SIM_DT=", self.sim_dt)
+        print("SORT_EVERY=", self.sort_every)
 
         #
         self.lastTime = time.time()
@@ -83,24 +165,52 @@ class App:
         self.fps = FPSCounter()
 
         # pygame init
+        if self.headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+        # persistent shader binaries, before the OpenGL context creation
+        setup_shader_cache()
+
         pg.init()
 
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
+        if self.headless:
+            # OpenGL context without window (EGL), rendering into an offscreen framebuffer
+            self.ctx = mgl.create_context(standalone=True, require=430, backend=HEADLESS_BACKEND)
 
-        pg_flags = pg.OPENGL | pg.DOUBLEBUF
-        if FULLSCREEN:
-            pg_flags |= pg.FULLSCREEN
+            self.fbo = self.ctx.simple_framebuffer((self.screen_width, self.screen_height), components=4)
+            self.fbo.use()
+        else:
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
 
-        pg.display.set_mode((self.screen_width, self.screen_height), flags=pg_flags)
+            pg_flags = pg.OPENGL | pg.DOUBLEBUF
+            if FULLSCREEN:
+                pg_flags |= pg.FULLSCREEN
 
-        pg.event.set_grab(GRAB_MOUSE)
-        pg.mouse.set_visible(True)
+            pg.display.set_mode((self.screen_width, self.screen_height), flags=pg_flags)
+
+            pg.event.set_grab(GRAB_MOUSE)
+            pg.mouse.set_visible(True)
+
+            # OpenGL context / options
+            self.ctx = mgl.create_context()
+            self.fbo = self.ctx.screen
+
+        # GPU time per pass (timer queries) + CPU time of flip / readback
+        self.timer = PassTimer(self.ctx, keep_records=bool(self.timings))
+
+        # uniform blocks of the compute shaders: constants of the simulation (written when changed) and time of
+        # each step of the frame (one slot per step)
+        self.sim_params = UniformBlock(self.ctx, "SimParams", SIM_PARAMS_BINDING, SIM_PARAMS)
+        self.frame_params = UniformBlock(self.ctx, "FrameParams", FRAME_PARAMS_BINDING, FRAME_PARAMS)
+
+        self.sim_params.set(SCREEN_WIDTH=self.screen_width, SCREEN_HEIGHT=self.screen_height, NB_BODY=self.nb_body,
+                            SPEED_RATE=SPEED_RATE, TURN_SPEED=TURN_SPEED, FADE_RATE=FADE_RATE, DIFFUSE_RATE=DIFFUSE_RATE,
+                            SENSOR_ANGLE=SENSOR_ANGLE, SENSOR_DIST=SENSOR_DIST, SENSOR_SIZE=SENSOR_SIZE, SENSOR_WEIGHT=SENSOR_WEIGHT,
+                            RANDOM_DIRECTION_STRENGTH=RANDOM_DIRECTION_STRENGTH, COLOR=COLOR)
+        self.sim_params.bind()
 
-        # OpenGL context / options
-        self.ctx = mgl.create_context()
-        
         self.ctx.wireframe = False
         #self.ctx.front_face = 'cw'
         #self.ctx.enable(flags=mgl.DEPTH_TEST)
@@ -111,9 +221,13 @@ class App:
         # time objects
         self.clock = pg.time.Clock()
         self.time = 0
-        self.delta_time = 0
         self.num_frames = 0
 
+        # simulation clock: real time not simulated yet (ms), simulated steps / time (s)
+        self.sim_accumulator = 0.0
+        self.sim_steps = 0
+        self.sim_time = 0.0
+
         # quad
         quad = [
             # pos (x, y), uv coords (x, y)
@@ -123,50 +237,120 @@ class App:
             1.0, -1.0, 1.0, 0.0,  # br
         ]
 
-        quad_buffer = self.ctx.buffer(data=np.array(quad, dtype='f4'))
+        self.quad_buffer = self.ctx.buffer(data=np.array(quad, dtype='f4'))
+        self.quad_vao = None
 
-        self.all_shaders = ShaderProgram(self.ctx)
-        self.quad_program = self.all_shaders.get_program("quad")
+        # local work group size: --group_size, else the winner of a previous --autotune on this device, else config.py
+        self.tuner = GroupSizeTuner(self.ctx)
+        self.xgroupsize, self.ygroupsize = self.group_size or self.tuner.get("nbody") or (XGROUPSIZE, YGROUPSIZE)
 
-        # compute shader
-        with open(f'shaders/nbody_cs.glsl') as file:
-            compute_shader_source = file.read()
+        self.all_shaders = ShaderProgram(self.ctx, watch=self.hot_reload, group_size=(self.xgroupsize, self.ygroupsize, ZGROUPSIZE))
+        self.load_programs()
 
-        compute_shader_source = compute_shader_source.replace("XGROUPSIZE_VAL", str(XGROUPSIZE)) \
-                                                     .replace("YGROUPSIZE_VAL", str(YGROUPSIZE)) \
-                                                     .replace("ZGROUPSIZE_VAL", str(ZGROUPSIZE))
+        # ping-pong trail maps, self.texture is the last diffused one (displayed / recorded)
+        self.trail_textures = []
+        for _ in range(2):
+            texture = self.ctx.texture((int(self.screen_width/1), int(self.screen_height/1)), 4, dtype='f1')
+            texture.filter = mgl.NEAREST, mgl.NEAREST # because when we access the image from a CS it is an Image2D (not Sampler2D)
+            self.trail_textures.append(texture)
 
-        self.compute_shader = self.ctx.compute_shader(compute_shader_source)
+        self.texture = self.trail_textures[0]
 
-        self.set_uniform(self.compute_shader, "SCREEN_WIDTH", self.screen_width)
-        self.set_uniform(self.compute_shader, "SCREEN_HEIGHT", self.screen_height)
-        self.set_uniform(self.compute_shader, "NB_BODY", self.nb_body)
-        self.set_uniform(self.compute_shader, "SPEED_RATE", SPEED_RATE)
-        self.set_uniform(self.compute_shader, "FADE_RATE", FADE_RATE)
-        self.set_uniform(self.compute_shader, "TURN_SPEED", TURN_SPEED)
-        self.set_uniform(self.compute_shader, "DIFFUSE_RATE", DIFFUSE_RATE)
-        self.set_uniform(self.compute_shader, "SENSOR_ANGLE", SENSOR_ANGLE)
-        self.set_uniform(self.compute_shader, "SENSOR_DIST", SENSOR_DIST)
-        self.set_uniform(self.compute_shader, "SENSOR_SIZE", SENSOR_SIZE)
-        self.set_uniform(self.compute_shader, "SENSOR_WEIGHT", SENSOR_WEIGHT)
-        self.set_uniform(self.compute_shader, "COLOR", COLOR)
-        self.set_uniform(self.compute_shader, "RANDOM_DIRECTION_STRENGTH", RANDOM_DIRECTION_STRENGTH)
+        if self.record_video:
+            self.readback = AsyncReadback(self.ctx, self.screen_width, self.screen_height, nb_buffers=self.readback_buffers)
 
-        self.compute_shader["out_texture"] = 0
+        self.bodies = Bodies(self)
 
-        self.texture = self.ctx.texture((int(self.screen_width/1), int(self.screen_height/1)), 4, dtype='f1')
-        self.texture.filter = mgl.NEAREST, mgl.NEAREST # because when we access the image from a CS it is an Image2D (not Sampler2D)
-        #self.texture.bind_to_image(0, read=False, write=True)
+        # --autotune: the candidates step the simulation, untimed, from a snapshot restored afterwards (same run
+        # with or without --autotune for a --seed)
+        if self.autotune:
+            state = self.get_state()
+            with self.timer.disabled():
+                self.set_group_size(self.tuner.tune("nbody", self.run_group_size))
+            self.set_state(state)
+            self.all_shaders.prune()
+
+        print("X LOCAL  GROUPSIZE=", self.xgroupsize)
+        print("Y LOCAL  GROUPSIZE=", self.ygroupsize)
+        print("Z LOCAL  GROUPSIZE=", ZGROUPSIZE)
 
-        self.quad_program['quad_tex'] = 0
+    def set_group_size(self, group_size):
+        self.xgroupsize, self.ygroupsize = group_size
+        self.all_shaders.group_size = (self.xgroupsize, self.ygroupsize, ZGROUPSIZE)
+        self.load_programs()
 
-        self.quad_vao = self.ctx.vertex_array(self.quad_program, [(quad_buffer, '2f 2f', 'vert', 'texcoord')])
+    def run_group_size(self, group_size):
+        # --autotune: one simulation step run with a candidate local size
+        self.set_group_size(group_size)
+        self.write_params(1)
+        self.step()
 
-        self.bodies = Bodies(self)
+    def get_state(self):
+        # bodies, trail maps (in their ping-pong order) and simulation clock
+        return self.bodies.ssbo_in.read(), list(self.trail_textures), [texture.read() for texture in self.trail_textures], self.sim_steps, self.sim_time
+
+    def set_state(self, state):
+        bodies, self.trail_textures, trails, self.sim_steps, self.sim_time = state
+
+        self.bodies.ssbo_in.write(bodies)
+        for texture, data in zip(self.trail_textures, trails):
+            texture.write(data)
+        self.texture = self.trail_textures[0]
+
+    def load_programs(self):
+        # programs and their static uniforms / vertex arrays, reloaded after a shader change
+        self.quad_program = self.all_shaders.get_program("quad")
+
+        # compute shaders: agents pass (1 invocation per body) + diffuse pass (1 invocation per pixel),
+        # their parameters in the uniform blocks (no per-program uniform)
+        blocks = self.sim_params.get_source() + "\n\n" + self.frame_params.get_source()
+
+        self.compute_shader = self.all_shaders.get_compute_program("nbody", PARAMS_BLOCKS=blocks)
+        diffuse_name = "diffuse" if self.diffuse_kernel == "tiled" else "diffuse_direct"
+        self.diffuse_shader = self.all_shaders.get_compute_program(diffuse_name, DIFFUSE_GROUPSIZE=DIFFUSE_GROUPSIZE, DIFFUSE_RADIUS=self.diffuse_radius, PARAMS_BLOCKS=blocks)
+
+        # --sort_every: histogram, scan, scatter passes of the sort by tile
+        if self.sort_every:
+            self.sort_shaders = [self.all_shaders.get_compute_program("sort", SORT_PASS=sort_pass, SORT_TILE=SORT_TILE, SORT_KEYS=self.sort_keys,
+                                                                      SCAN_GROUPSIZE=SCAN_GROUPSIZE, PARAMS_BLOCKS=blocks) for sort_pass in (1, 2, 3)]
+
+        self.quad_program['quad_tex'] = 0
+
+        if self.quad_vao:
+            self.quad_vao.release()
+        self.quad_vao = self.ctx.vertex_array(self.quad_program, [(self.quad_buffer, '2f 2f', 'vert', 'texcoord')])
 
     def destroy(self):
         self.all_shaders.destroy()
+        self.quad_vao.release()
+        self.quad_buffer.release()
         self.bodies.destroy()
+        for texture in self.trail_textures:
+            texture.release()
+        self.sim_params.release()
+        self.frame_params.release()
+
+    def quit(self):
+        self.timer.flush()
+        if self.timings:
+            self.timer.dump(self.timings)
+
+        if self.record_video:
+            for data in self.readback.flush():
+                self.capture_frame(data)
+            self.video_recorder.end_recording()
+            print(f"Readback stall: {self.readback.get_stall_ms():.3f} ms/frame ({self.readback_buffers} buffer(s))")
+            self.readback.release()
+
+        self.destroy()
+        pg.quit()
+
+    def get_body_groups(self):
+        # one invocation per body, in rows of at most 65535 work groups (minimum GL_MAX_COMPUTE_WORK_GROUP_COUNT)
+        group_size = self.xgroupsize * self.ygroupsize
+        group_x = min((self.nb_body + group_size - 1) // group_size, 65535)
+        group_y = (self.nb_body + group_x * group_size - 1) // (group_x * group_size)
+        return group_x, group_y
 
     def set_uniform(self, program, u_name, u_value):
         try:
@@ -181,7 +365,11 @@ class App:
         if delta >= 1:
             fps = f"FPS: {self.fps.get_fps():3.0f}"
             nb_body = f"BODY: {self.nb_body}"
-            pg.display.set_caption(fps + " | " + nb_body)
+            timings = self.timer.get_summary()
+            if self.headless:
+                print(fps + " | " + nb_body + " | " + timings)
+            else:
+                pg.display.set_caption(fps + " | " + nb_body + " | " + timings)
 
             self.lastTime = self.currentTime
 
@@ -192,82 +380,234 @@ class App:
         for event in pg.event.get():
 
             if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
-                self.destroy()
-                if self.record_video:
-                    self.video_recorder.end_recording()
-                pg.quit()
+                self.quit()
                 sys.exit()
 
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_p:
                     self.pause = not self.pause
 
+                # sensors of the agents, changed at runtime in the SimParams block
+                if event.key in (pg.K_LEFT, pg.K_RIGHT):
+                    self.sim_params.set(SENSOR_ANGLE=self.sim_params.get("SENSOR_ANGLE") + (5.0 if event.key == pg.K_RIGHT else -5.0))
+                    print("SENSOR_ANGLE=", self.sim_params.get("SENSOR_ANGLE"))
+                if event.key in (pg.K_UP, pg.K_DOWN):
+                    self.sim_params.set(SENSOR_DIST=max(self.sim_params.get("SENSOR_DIST") + (5.0 if event.key == pg.K_UP else -5.0), 0.0))
+                    print("SENSOR_DIST=", self.sim_params.get("SENSOR_DIST"))
+
             if event.type == pg.KEYUP:
                 pass
 
-    def run(self):
+    def capture_frame(self, data):
+        self.video_recorder.capture_rgba(data)
 
-        while True:
-            self.time = pg.time.get_ticks() * 0.001
+    def render_frame(self):
+        # shader hot reload, at the frame boundary
+        if self.all_shaders.reload():
+            self.load_programs()
 
-            self.check_events()
+        self.time = pg.time.get_ticks() * 0.001
 
-            self.ctx.clear(color=(0.0, 0.0, 0.0))
+        self.ctx.clear(color=(0.0, 0.0, 0.0))
 
-            if not self.pause:
-                self.set_uniform(self.compute_shader, "time", self.time)
-                self.set_uniform(self.compute_shader, "delta_time", self.delta_time)
+        # steps of the frame dispatched back to back, no flip / readback between them
+        if not self.pause:
+            nb_steps = self.get_sim_steps()
+            if nb_steps:
+                self.write_params(nb_steps)
 
-                # CS: layout(std430, binding = 0) buffer bodies_in
-                self.bodies.ssbo_in.bind_to_storage_buffer(0)
+            for slot in range(nb_steps):
+                self.step(slot)
 
-                # CS: layout(rgba8, binding = 0) uniform image2D out_texture;
-                self.texture.bind_to_image(0, read=False, write=True) # glBindImageTexture(0, texHandle, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_R32F);
+        # FS
+        with self.timer.gpu("quad"):
+            self.texture.use(location=0)
+            self.quad_vao.render(mode=mgl.TRIANGLE_STRIP)
 
-                self.compute_shader.run(group_x= self.screen_width//XGROUPSIZE, group_y= self.screen_height//YGROUPSIZE, group_z=1)
+    def get_sim_steps(self):
+        # --fast_forward / --substeps: fixed number of steps per frame, else the real time elapsed in steps of sim_dt
+        if self.fast_forward or self.substeps:
+            return self.fast_forward or self.substeps
 
-                #self.ctx.memory_barrier()
+        steps = int(self.sim_accumulator // self.sim_dt)
+        self.sim_accumulator -= steps * self.sim_dt
 
-            # FS
-            self.texture.use(location=0)
-            self.quad_vao.render(mode=mgl.TRIANGLE_STRIP)
+        # frames too slow to keep up: the simulation slows down instead of spiralling into more steps per frame
+        if steps > MAX_SIM_STEPS:
+            steps, self.sim_accumulator = MAX_SIM_STEPS, 0.0
+
+        return steps
+
+    def write_params(self, nb_steps):
+        # one Buffer.write per block and frame at most: the constants when changed, the time of the steps of the frame
+        self.frame_params.reserve(nb_steps)
+
+        # times summed as self.sim_time in step()
+        times = np.cumsum([self.sim_time] + [self.sim_dt * 0.001] * (nb_steps - 1))
+        self.frame_params.set(slice(0, nb_steps), time=times, delta_time=self.sim_dt)
+
+        self.sim_params.write()
+        self.frame_params.write()
+
+    def step(self, slot=0):
+        # one simulation step of sim_dt ms: agents then diffuse, trail maps swapped. slot: FrameParams of the step
+        self.frame_params.bind(slot)
+
+        trail_in, trail_out = self.trail_textures
+
+        if self.sort_every and self.sim_steps % self.sort_every == 0:
+            with self.timer.gpu("sort"):
+                self.bodies.sort()
+
+        # agents: sense / turn / move / deposit
+        # CS: layout(std430, binding = 0) buffer bodies_in
+        self.bodies.ssbo_in.bind_to_storage_buffer(0)
+
+        # CS: layout(rgba8, binding = 0) uniform image2D trail_map;
+        trail_in.bind_to_image(0, read=True, write=True)
+
+        group_x, group_y = self.get_body_groups()
+        with self.timer.gpu("agents"):
+            self.compute_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+            self.ctx.memory_barrier()
+
+        # diffuse / fade: trail_in => trail_out
+        trail_in.bind_to_image(0, read=True, write=False)
+        trail_out.bind_to_image(1, read=False, write=True)
 
-            pg.display.flip()
+        group_x = (self.screen_width  + DIFFUSE_GROUPSIZE - 1) // DIFFUSE_GROUPSIZE
+        group_y = (self.screen_height + DIFFUSE_GROUPSIZE - 1) // DIFFUSE_GROUPSIZE
+        with self.timer.gpu("diffuse"):
+            self.diffuse_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+            self.ctx.memory_barrier()
+
+        self.trail_textures.reverse()
+        self.texture = self.trail_textures[0]
+
+        self.sim_steps += 1
+        self.sim_time += self.sim_dt * 0.001
+
+    def end_frame(self):
+        # --fast_forward: frame rate not capped
+        frame_time = self.clock.tick(-1 if self.fast_forward else self.max_fps)
+        if not self.pause:
+            self.sim_accumulator += frame_time
+
+        if self.sync:
+            self.ctx.finish()
+
+        self.timer.end_frame()
+
+        self.get_fps()
+        self.num_frames += 1
+
+    def frames(self, count=-1):
+        """Render `count` frames (-1 for unlimited) and yield each one as a (height, width, 4) uint8 RGBA array.
+
+        The array is a top-down view of a single buffer reused for every frame: copy it to keep a frame.
+        """
+        frame = np.empty((self.screen_height, self.screen_width, 4), dtype=np.uint8)
+
+        nb_frames = 0
+        while count < 0 or nb_frames < count:
+            nb_frames += 1
+
+            self.render_frame()
+            self.fbo.read_into(frame, components=4)
+            self.end_frame()
+
+            yield frame[::-1]
+
+    def run(self):
+
+        start_time = time.perf_counter()
+
+        while self.max_frames < 0 or self.num_frames < self.max_frames:
+
+            if not self.headless:
+                self.check_events()
+
+            self.render_frame()
+
+            if not self.headless:
+                with self.timer.cpu("flip"):
+                    pg.display.flip()
 
             # record video
             if self.record_video:
-                pg_surface = pygame.image.fromstring(self.texture.read(), (self.texture.width, self.texture.height), 'RGBA', True)
-                self.video_recorder.capture_frame(pg_surface)
+                with self.timer.cpu("readback"):
+                    data = self.readback.read(self.texture)
+                    if data is not None:
+                        self.capture_frame(data)
+
+            self.end_frame()
 
-            self.delta_time = self.clock.tick(self.max_fps)
+        self.ctx.finish()
+        self.timer.flush()
+        elapsed = time.perf_counter() - start_time
+        print(f"Rendered {self.num_frames} frames in {elapsed:.3f}s ({self.num_frames / elapsed:.1f} FPS)")
+        print(f"Simulated {self.sim_steps} steps of {self.sim_dt:.3f} ms in {elapsed:.3f}s ({self.sim_steps / elapsed:.1f} steps/s, {self.sim_time:.1f}s of simulation)")
+        print(f"Agents: {self.sim_steps * self.nb_body / elapsed:.4g} agents/s")
+        print(f"Pass timings: {self.timer.get_summary()}")
 
-            self.get_fps()
-            self.num_frames += 1
+        self.quit()
 
 # -----------------------------------------------------------------------------------------------------------
 # python3 main.py --body=10000 --fps=-1
 # python3 main.py --body=10000 --fps=60 -rv="h264" -vfps=60
+# python3 main.py --body=10000 --headless --frames=1000 --size=1920x1080
+# python3 main.py --body=10000000 --seed=42 --gpu_init
+# python3 main.py --body=1000000 --diffuse_radius=4 --diffuse_kernel=tiled
+# python3 main.py --body=1000000 --substeps=4
+# python3 main.py --body=1000000 --fast_forward=100 --frames=100
+# python3 main.py --body=10000000 --gpu_init --sort_every=16
 
 # Some docs:
 #            https://github.com/moderngl/moderngl/blob/main/examples/compute_shader_render_texture.py 
 #            https://stackoverflow.com/questions/75613151/executing-a-simple-glsl-compute-shader-with-moderngl-does-not-work
 
 
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
 def main():
 
     parser = argparse.ArgumentParser(description="")
 
     parser.add_argument('-f', '--fps', help='Max FPS, -1 for unlimited', default=-1, type=int)
     parser.add_argument('-b', '--body', help='NB Body', default=4096, type=int)
+    parser.add_argument('-s', '--seed', help='Seed of the bodies initialization, random if not set', default=None, type=int)
+    parser.add_argument('--gpu_init', help='Initialize the bodies on the GPU with a compute shader', action='store_true')
+    parser.add_argument('--diffuse_radius', help='Radius of the trail diffusion (box blur) kernel', default=DIFFUSE_RADIUS, type=int)
+    parser.add_argument('--diffuse_kernel', help='Trail diffusion kernel', default=DIFFUSE_KERNEL, choices=("tiled", "direct"))
+    parser.add_argument('--sim_dt', help='Fixed simulation step (ms)', default=SIM_DT, type=float)
+    parser.add_argument('--substeps', help='Simulation steps per displayed frame, 0: steps of the real time elapsed', default=0, type=int)
+    parser.add_argument('--fast_forward', help='Display every Nth simulation step only, frame rate not capped', default=0, type=int)
+    parser.add_argument('--sort_every', help='Sort the bodies by trail map tile every N simulation steps, 0: never', default=0, type=int)
     parser.add_argument('-rv', '--record_video', help='', default="", type=str)
     parser.add_argument('-vfps', '--video_fps', help='', default=60, type=int)
+    parser.add_argument('-rb', '--readback_buffers', help='Number of PBOs for video readback, 1 for synchronous read', default=3, type=int)
+    parser.add_argument('--headless', help='Render offscreen without window (EGL context)', action='store_true')
+    parser.add_argument('--frames', help='Number of frames to render, -1 for unlimited', default=-1, type=int)
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('-g', '--group_size', help='Local work group size XxY of the compute shaders (default: autotuned or config)', default=None, type=parse_size)
+    parser.add_argument('--autotune', help='Time candidate local sizes on this device and keep the fastest one', action='store_true')
+    parser.add_argument('--hot_reload', help='Recompile the shaders when their source files change', action='store_true')
+    parser.add_argument('--timings', help='Save the per-frame pass timings to a .csv or .json file', default="", type=str)
+    parser.add_argument('--sync', help='Wait for the GPU at the end of each frame (per-frame times of benchmarks)', action='store_true')
 
     result = parser.parse_args()
     args = dict(result._get_kwargs())
 
     print("Args = %s" % args)
 
-    app = App(screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, nb_body=args["body"], fps=args["fps"], record_video=args["record_video"], video_fps=args["video_fps"])
+    screen_width, screen_height = args["size"]
+
+    app = App(screen_width=screen_width, screen_height=screen_height, nb_body=args["body"], fps=args["fps"], record_video=args["record_video"], video_fps=args["video_fps"],
+              readback_buffers=args["readback_buffers"], headless=args["headless"], frames=args["frames"], hot_reload=args["hot_reload"], timings=args["timings"], group_size=args["group_size"], autotune=args["autotune"], sync=args["sync"], seed=args["seed"], gpu_init=args["gpu_init"],
+              diffuse_radius=args["diffuse_radius"], diffuse_kernel=args["diffuse_kernel"], sim_dt=args["sim_dt"], substeps=args["substeps"], fast_forward=args["fast_forward"],
+              sort_every=args["sort_every"])
     app.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,266 @@
+import time, argparse
+
+import numpy as np
+
+from config import *
+from main import BODY_DTYPE, App, get_particles, parse_size
+
+# -----------------------------------------------------------------------------------------------------------
+# NumPy port of a simulation step of main.py, for the machines without an OpenGL 4.3 context and to check the
+# compute shaders:
+#
+#   agents : nbody_cs.glsl          sense (3 sensors) => turn => move => wrap => deposit
+#   diffuse: diffuse_direct_cs.glsl box blur => fade
+#
+# float32 arithmetic, random_01() hash of the shader, trail map quantized as the rgba8 textures. The GPU agents sense
+# the trail map while the other agents deposit into it (and 2 agents may deposit into the same texel): the agents
+# here sense the map of the previous step, the GPU / CPU trail maps agree within a tolerance, not bit for bit.
+
+f32 = np.float32
+
+def random_01(state):
+    # hash of random_01() of nbody_cs.glsl, uint32 arithmetic
+    state = state.astype(np.uint32)
+    state ^= np.uint32(2747636419)
+    state *= np.uint32(2654435769)
+    state ^= state >> np.uint32(16)
+    state *= np.uint32(2654435769)
+    state ^= state >> np.uint32(16)
+    state *= np.uint32(2654435769)
+    return state.astype(np.float32) / f32(4294967295.0)
+
+def quantize(colors):
+    # float => rgba8 texel (UNORM: clamped to [0, 1], rounded to the nearest of the 256 levels)
+    return np.rint(np.clip(colors, 0.0, 1.0) * f32(255.0)).astype(np.uint8)
+
+def box_sum(image, radius, margin=0):
+    # sum over the (2r+1)x(2r+1) texels around each texel, coordinates clamped to the edges, in the order of the loops of
+    # the shaders (float sums: the ties of the sensors depend on it). margin: sums also around the centers up to margin
+    # texels out of the image, at [y + margin, x + margin]
+    pad = radius + margin
+    padded = np.pad(image, [(pad, pad), (pad, pad)] + [(0, 0)] * (image.ndim - 2), mode='edge')
+    height, width = image.shape[0] + 2 * margin, image.shape[1] + 2 * margin
+
+    total = np.zeros((height, width) + image.shape[2:], dtype=image.dtype)
+    for dx in range(2 * radius + 1):
+        for dy in range(2 * radius + 1):
+            total += padded[dy:dy + height, dx:dx + width]
+    return total
+
+class PhysarumCPU:
+    """Bodies and trail map of the physarum simulation, stepped with NumPy.
+
+    bodies: BODY_DTYPE array (get_particles() or read back from the SSBO), trail: (height, width, 4) uint8 texels of
+    the trail map (bottom row first, as Texture.read()), black if None.
+    """
+
+    def __init__(self, bodies, screen_width, screen_height, trail=None, diffuse_radius=DIFFUSE_RADIUS):
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.diffuse_radius = diffuse_radius
+
+        self.pos = bodies['pos'][:, :2].astype(np.float32)
+        self.angle = bodies['dat'][:, 0].astype(np.float32)
+        self.ids = bodies['dat'][:, 1].astype(np.int64)
+
+        if trail is None:
+            trail = np.zeros((screen_height, screen_width, 4), dtype=np.uint8)
+        self.trail = trail.copy()
+
+        self.color = quantize(np.array(COLOR + (1.0,), dtype=np.float32))
+
+    def to_tex_coord(self, x, y):
+        # int() of GLSL: truncation toward zero
+        return ((x + f32(1.0)) / f32(2.0) * f32(self.screen_width)).astype(np.int32), ((y + f32(1.0)) / f32(2.0) * f32(self.screen_height)).astype(np.int32)
+
+    def get_sensor(self, tex_x, tex_y, angle):
+        # center of a sensor as an index of box_sum(..., SENSOR_SIZE, margin=SENSOR_SIZE): further out, the clamped
+        # samples are the same
+        sensor_x = (tex_x.astype(np.float32) + np.cos(angle) * f32(SENSOR_DIST)).astype(np.int32)
+        sensor_y = (tex_y.astype(np.float32) + np.sin(angle) * f32(SENSOR_DIST)).astype(np.int32)
+
+        return np.clip(sensor_y, -SENSOR_SIZE, self.screen_height - 1 + SENSOR_SIZE) + SENSOR_SIZE, np.clip(sensor_x, -SENSOR_SIZE, self.screen_width - 1 + SENSOR_SIZE) + SENSOR_SIZE
+
+    def step(self, time, delta_time):
+        """One simulation step of delta_time ms at time s (FrameParams): agents then diffuse."""
+        dt = f32(delta_time)
+
+        # agents
+        colors = self.trail[..., :3].astype(np.float32) / f32(255.0)
+        weights = box_sum(colors[..., 0] * f32(SENSOR_WEIGHT) + colors[..., 1] * f32(SENSOR_WEIGHT) + colors[..., 2] * f32(SENSOR_WEIGHT), SENSOR_SIZE, margin=SENSOR_SIZE)
+
+        tex_x, tex_y = self.to_tex_coord(self.pos[:, 0], self.pos[:, 1])
+        sensor_angle = f32(np.radians(f32(SENSOR_ANGLE)))
+
+        # forward, left, right
+        self.sensors = [self.get_sensor(tex_x, tex_y, self.angle + angle) for angle in (f32(0.0), sensor_angle, -sensor_angle)]
+        self.weights = [weights[sensor] for sensor in self.sensors]
+        weight_forward, weight_left, weight_right = self.weights
+
+        state = (self.ids + int(f32(time) * f32(10000.0))) & 0xFFFFFFFF
+        direction_strength = (f32(0.5) - f32(RANDOM_DIRECTION_STRENGTH) / f32(2.0)) + f32(RANDOM_DIRECTION_STRENGTH) * random_01(state)
+        turn = direction_strength * f32(TURN_SPEED) * dt
+
+        random_turn = (weight_forward < weight_left) & (weight_forward < weight_right)
+        turn_right = ~random_turn & (weight_right > weight_left)
+        turn_left = ~random_turn & (weight_left > weight_right)
+
+        angle = self.angle
+        angle = np.where(random_turn, angle + (direction_strength - f32(0.5)) * f32(2.0) * f32(TURN_SPEED) * dt, angle)
+        angle = np.where(random_turn, angle + ((direction_strength + f32(0.5)) * f32(2.0) - f32(1.0)) * f32(TURN_SPEED) * dt, angle)
+        angle = np.where(turn_right, angle - turn, angle)
+        angle = np.where(turn_left, angle + turn, angle)
+        self.angle = angle.astype(np.float32)
+
+        self.pos[:, 0] += np.cos(self.angle) * dt * f32(SPEED_RATE)
+        self.pos[:, 1] += np.sin(self.angle) * dt * f32(SPEED_RATE)
+
+        # wrap around the edges, as clamp_pos()
+        for axis in range(2):
+            coord = self.pos[:, axis]
+            over, under = coord > 1.0, coord < -1.0
+            coord[over] = -1.0
+            coord[under] = 1.0
+
+        # deposit (texels out of the map, at x or y = 1.0, ignored as by imageStore)
+        tex_x, tex_y = self.to_tex_coord(self.pos[:, 0], self.pos[:, 1])
+        inside = (tex_x < self.screen_width) & (tex_y < self.screen_height)
+        self.trail[tex_y[inside], tex_x[inside]] = self.color
+
+        # diffuse / fade
+        colors = self.trail[..., :3].astype(np.float32) / f32(255.0)
+        blur = box_sum(colors, self.diffuse_radius) / f32((2 * self.diffuse_radius + 1) ** 2)
+
+        diffuse_weight = f32(min(max(DIFFUSE_RATE * dt, 0.0), 1.0))
+        colors = colors * (f32(1.0) - diffuse_weight) + blur * diffuse_weight - f32(FADE_RATE) * dt
+
+        self.trail[..., :3] = quantize(np.maximum(colors, 0.0))
+        self.trail[..., 3] = 255
+
+# -----------------------------------------------------------------------------------------------------------
+
+def run_cpu(args):
+    screen_width, screen_height = args["size"]
+    seed = args["seed"] if args["seed"] is not None else 0
+
+    sim = PhysarumCPU(get_particles(args["body"], seed), screen_width, screen_height, diffuse_radius=args["diffuse_radius"])
+
+    sim_time = 0.0
+    t0 = time.perf_counter()
+    for _ in range(args["steps"]):
+        sim.step(sim_time, args["sim_dt"])
+        sim_time += args["sim_dt"] * 0.001
+    elapsed = time.perf_counter() - t0
+
+    print(f"CPU: {args['steps']} steps of {args['body']} agents in {elapsed:.3f}s ({args['steps'] * args['body'] / elapsed:.4g} agents/s)")
+
+    if args["output"]:
+        cv2.imwrite(args["output"], cv2.cvtColor(sim.trail[::-1], cv2.COLOR_RGBA2BGR))
+
+def get_deposits(pos, agents, screen_width, screen_height):
+    # (height, width) mask of the texels deposited by the agents at pos
+    x = ((pos[agents, 0] + f32(1.0)) / f32(2.0) * f32(screen_width)).astype(np.int32)
+    y = ((pos[agents, 1] + f32(1.0)) / f32(2.0) * f32(screen_height)).astype(np.int32)
+    inside = (x < screen_width) & (y < screen_height)
+
+    deposits = np.zeros((screen_height, screen_width), dtype=np.float32)
+    deposits[y[inside], x[inside]] = 1.0
+    return deposits
+
+def run_compare(args):
+    # GPU and CPU in lockstep: each step of the CPU starts from the bodies / trail map of the GPU, so that the
+    # differences do not add up over the steps.
+    # The GPU agents sense the deposits of the agents run before them in the same pass (in an order of the driver):
+    # are checked only the agents whose sensors cover no texel deposited by the step (on the GPU or on the CPU), and the
+    # texels out of reach of the deposits of the other agents. The agents with 2 sensors of equal weights are not checked
+    # either: the float sums of the sensors depend on the compiler, and so the side of the tie
+    screen_width, screen_height = args["size"]
+    all_agents = np.ones(args["body"], dtype=bool)
+
+    app = App(screen_width=screen_width, screen_height=screen_height, nb_body=args["body"], headless=True, seed=args["seed"],
+              diffuse_radius=args["diffuse_radius"], diffuse_kernel="direct", sim_dt=args["sim_dt"], substeps=1)
+
+    agents, agents_off, texels, texels_off, max_diff, cpu_time = 0, 0, 0, 0, 0, 0.0
+    for _ in range(args["steps"]):
+        bodies = np.frombuffer(app.bodies.ssbo_in.read(), dtype=BODY_DTYPE)
+        trail = np.frombuffer(app.texture.read(), dtype=np.uint8).reshape(screen_height, screen_width, 4)
+
+        sim = PhysarumCPU(bodies, screen_width, screen_height, trail, diffuse_radius=args["diffuse_radius"])
+        t0 = time.perf_counter()
+        sim.step(app.sim_time, app.sim_dt)
+        cpu_time += time.perf_counter() - t0
+
+        app.write_params(1)
+        app.step()
+
+        gpu_bodies = np.frombuffer(app.bodies.ssbo_in.read(), dtype=BODY_DTYPE)
+        gpu_trail = np.frombuffer(app.texture.read(), dtype=np.uint8).reshape(screen_height, screen_width, 4)
+
+        # agents
+        deposits = get_deposits(sim.pos, all_agents, screen_width, screen_height) + get_deposits(gpu_bodies['pos'], all_agents, screen_width, screen_height)
+        sensed = box_sum(deposits, SENSOR_SIZE, margin=SENSOR_SIZE)
+        racing = np.logical_or.reduce([sensed[sensor] > 0 for sensor in sim.sensors])
+
+        forward, left, right = sim.weights
+        for a, b in ((forward, left), (forward, right), (left, right)):
+            racing |= (np.abs(a - b) <= 1e-5 * np.maximum(a, b)) & (np.maximum(a, b) > 0)
+
+        off = (np.abs(gpu_bodies['dat'][:, 0] - sim.angle) > 1e-4) | (np.abs(gpu_bodies['pos'][:, :2] - sim.pos) > 1e-5).any(axis=1)
+        agents += np.count_nonzero(~racing)
+        agents_off += np.count_nonzero(off & ~racing)
+
+        # trail maps
+        deposits = get_deposits(sim.pos, racing, screen_width, screen_height) + get_deposits(gpu_bodies['pos'], racing, screen_width, screen_height)
+        checked = box_sum(deposits, args["diffuse_radius"]) == 0
+
+        diff = np.abs(gpu_trail.astype(np.int16) - sim.trail).max(axis=2)[checked]
+        texels += diff.size
+        texels_off += np.count_nonzero(diff > args["tolerance"])
+        max_diff = max(max_diff, int(diff.max(initial=0)))
+
+    app.destroy()
+
+    agents_checked, texels_checked = agents / (args["steps"] * args["body"]), texels / (args["steps"] * screen_width * screen_height)
+    agents_off, texels_off = agents_off / max(agents, 1), texels_off / max(texels, 1)
+    print(f"Agents: {100 * agents_checked:.2f}% checked, {100 * agents_off:.4f}% off")
+    print(f"Trail maps: {100 * texels_checked:.2f}% texels checked, max diff {max_diff}/255, {100 * texels_off:.4f}% off by more than {args['tolerance']}/255")
+    print(f"CPU: {args['steps'] * args['body'] / cpu_time:.4g} agents/s")
+
+    # dense runs leave most agents racing: too few checked to tell the backends apart
+    if min(agents_checked, texels_checked) < args["min_checked"]:
+        raise SystemExit(f"GPU / CPU steps not compared: {100 * agents_checked:.2f}% agents, {100 * texels_checked:.2f}% texels checked (min {100 * args['min_checked']:.2f}%), fewer agents or a larger --size")
+
+    if max(agents_off, texels_off) > args["max_off"]:
+        raise SystemExit(f"GPU / CPU steps disagree: {100 * agents_off:.4f}% agents, {100 * texels_off:.4f}% texels off (max {100 * args['max_off']:.4f}%)")
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 physarum_cpu.py --body=100000 --steps=100 --output=trail.png
+# python3 physarum_cpu.py --steps=20 --compare --seed=42
+# python3 physarum_cpu.py --body=1000 --steps=100 --compare --seed=42 --size=320x200
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('-b', '--body', help='NB Body', default=4096, type=int)
+    parser.add_argument('-s', '--seed', help='Seed of the bodies initialization', default=None, type=int)
+    parser.add_argument('--steps', help='Number of simulation steps', default=100, type=int)
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('--sim_dt', help='Fixed simulation step (ms)', default=SIM_DT, type=float)
+    parser.add_argument('--diffuse_radius', help='Radius of the trail diffusion (box blur) kernel', default=DIFFUSE_RADIUS, type=int)
+    parser.add_argument('--output', help='Save the CPU trail map to an image file', default="", type=str)
+    parser.add_argument('--compare', help='Step the GPU (headless) and the CPU in lockstep and compare their trail maps', action='store_true')
+    parser.add_argument('--tolerance', help='--compare: max difference of a texel channel (/255)', default=1, type=int)
+    parser.add_argument('--max_off', help='--compare: max fraction of the checked agents / texels off', default=0.001, type=float)
+    parser.add_argument('--min_checked', help='--compare: min fraction of the agents / texels checked', default=0.5, type=float)
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    if args["compare"]:
+        run_compare(args)
+    else:
+        run_cpu(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#version 430 core
+
+// Tiled separable box blur: each work group loads its tile + a halo of RADIUS pixels into shared memory once,
+// then runs a horizontal and a vertical pass on it (2 * (2 * RADIUS + 1) reads from shared memory per pixel).
+
+#define TILE        DIFFUSE_GROUPSIZE_VAL
+#define RADIUS      DIFFUSE_RADIUS_VAL
+#define APRON       (TILE + 2 * RADIUS)
+
+layout(local_size_x=TILE, local_size_y=TILE, local_size_z=1) in;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+// uniform blocks SimParams (SCREEN_WIDTH, NB_BODY, SPEED_RATE, ...) and FrameParams (time, delta_time), config.py
+PARAMS_BLOCKS_VAL
+
+// ping-pong trail maps: read the deposits of the agents pass, write the diffused / faded map
+layout(rgba8, binding = 0) uniform readonly  image2D trail_in;
+layout(rgba8, binding = 1) uniform writeonly image2D trail_out;
+
+// tile + halo, and its horizontal sums for every row of the apron
+shared vec3 tile_col[APRON][APRON];
+shared vec3 row_sum[APRON][TILE];
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+float clamp_01(float x)
+{
+    return max(0, min(1, x));
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void load_tile(ivec2 tile_origin, ivec2 local)
+{
+    ivec2 max_coord = ivec2(SCREEN_WIDTH - 1, SCREEN_HEIGHT - 1);
+
+    for (int y = local.y; y < APRON; y += TILE) {
+        for (int x = local.x; x < APRON; x += TILE) {
+            ivec2 sample_coord = clamp(tile_origin + ivec2(x, y), ivec2(0), max_coord);
+            tile_col[y][x] = imageLoad(trail_in, sample_coord).rgb;
+        }
+    }
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void blur_rows(ivec2 local)
+{
+    for (int y = local.y; y < APRON; y += TILE) {
+        vec3 sum_col = vec3(0.0, 0.0, 0.0);
+
+        for (int offset = -RADIUS; offset <= RADIUS; offset ++) {
+            sum_col += tile_col[y][local.x + RADIUS + offset];
+        }
+
+        row_sum[y][local.x] = sum_col;
+    }
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+vec3 blur_column(ivec2 local)
+{
+    vec3 sum_col = vec3(0.0, 0.0, 0.0);
+
+    for (int offset = -RADIUS; offset <= RADIUS; offset ++) {
+        sum_col += row_sum[local.y + RADIUS + offset][local.x];
+    }
+
+    return sum_col / float((2 * RADIUS + 1) * (2 * RADIUS + 1));
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void main()
+{
+    // 1 invocation per pixel (dispatched over the screen, independently of NB_BODY)
+    ivec2 tex_coord = ivec2(gl_GlobalInvocationID.xy);
+    ivec2 local     = ivec2(gl_LocalInvocationID.xy);
+
+    load_tile(ivec2(gl_WorkGroupID.xy) * TILE - RADIUS, local);
+    barrier();
+
+    blur_rows(local);
+    barrier();
+
+    // out of screen invocations only help loading the tile
+    if (tex_coord.x >= SCREEN_WIDTH || tex_coord.y >= SCREEN_HEIGHT) {
+        return;
+    }
+
+    vec3 ori_col  = tile_col[local.y + RADIUS][local.x + RADIUS];
+    vec3 blur_col = blur_column(local);
+
+	float diffuse_weight = clamp_01(DIFFUSE_RATE * delta_time);
+
+    blur_col = (ori_col * (1 - diffuse_weight)) + (blur_col * diffuse_weight);
+    blur_col = blur_col - (FADE_RATE * delta_time);
+
+    if (blur_col.r < 0) blur_col.r = 0;
+    if (blur_col.g < 0) blur_col.g = 0;
+    if (blur_col.b < 0) blur_col.b = 0;
+
+    imageStore(trail_out, tex_coord, vec4(blur_col, 1.0));
+}
@@ -0,0 +1,72 @@
+#version 430 core
+
+// Direct box blur: (2 * RADIUS + 1)^2 image loads per pixel, no shared memory.
+// Default kernel: the tiled one (diffuse_cs.glsl, --diffuse_kernel=tiled) is opt-in, measured slower on llvmpipe.
+
+#define TILE        DIFFUSE_GROUPSIZE_VAL
+#define RADIUS      DIFFUSE_RADIUS_VAL
+
+layout(local_size_x=TILE, local_size_y=TILE, local_size_z=1) in;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+// uniform blocks SimParams (SCREEN_WIDTH, NB_BODY, SPEED_RATE, ...) and FrameParams (time, delta_time), config.py
+PARAMS_BLOCKS_VAL
+
+// ping-pong trail maps: read the deposits of the agents pass, write the diffused / faded map
+layout(rgba8, binding = 0) uniform readonly  image2D trail_in;
+layout(rgba8, binding = 1) uniform writeonly image2D trail_out;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+float clamp_01(float x)
+{
+    return max(0, min(1, x));
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void blur(ivec2 tex_coord)
+{
+    vec3 ori_col = imageLoad(trail_in, tex_coord).rgb;
+
+    vec3 sum_col = vec3(0.0, 0.0, 0.0);
+
+	for (int offset_x = -RADIUS; offset_x <= RADIUS; offset_x ++) {
+		for (int offset_y = -RADIUS; offset_y <= RADIUS; offset_y ++) {
+			int sample_x = min(SCREEN_WIDTH -1, max(0, tex_coord.x + offset_x));
+            int sample_y = min(SCREEN_HEIGHT-1, max(0, tex_coord.y + offset_y));
+
+            vec3 suround_col = imageLoad(trail_in, ivec2(sample_x, sample_y)).rgb;
+
+            sum_col += suround_col;
+		}
+	}
+
+    vec3 blur_col = sum_col / float((2 * RADIUS + 1) * (2 * RADIUS + 1));
+
+	float diffuse_weight = clamp_01(DIFFUSE_RATE * delta_time);
+
+    blur_col = (ori_col * (1 - diffuse_weight)) + (blur_col * diffuse_weight);
+    blur_col = blur_col - (FADE_RATE * delta_time);
+
+    if (blur_col.r < 0) blur_col.r = 0;
+    if (blur_col.g < 0) blur_col.g = 0;
+    if (blur_col.b < 0) blur_col.b = 0;
+
+    imageStore(trail_out, tex_coord, vec4(blur_col, 1.0));
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void main()
+{
+    // 1 invocation per pixel (dispatched over the screen, independently of NB_BODY)
+    ivec2 tex_coord = ivec2(gl_GlobalInvocationID.xy);
+
+    if (tex_coord.x >= SCREEN_WIDTH || tex_coord.y >= SCREEN_HEIGHT) {
+        return;
+    }
+
+    blur(tex_coord);
+}
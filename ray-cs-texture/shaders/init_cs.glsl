@@ -0,0 +1,69 @@
+#version 430 core
+
+#define XGROUPSIZE  XGROUPSIZE_VAL
+#define YGROUPSIZE  YGROUPSIZE_VAL
+#define ZGROUPSIZE  ZGROUPSIZE_VAL
+
+#define PI     3.1415926538
+
+layout(local_size_x=XGROUPSIZE, local_size_y=YGROUPSIZE, local_size_z=ZGROUPSIZE) in;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+uniform int  NB_BODY;
+uniform uint SEED;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+struct Body
+{
+    vec4 pos;  // x, y, z, w
+    vec4 dat;  // angle, ID, nop, nop
+};
+
+layout(std430, binding = 0) buffer bodies_in
+{
+    Body bodies[];
+} buf;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+uint hash(uint state)
+{
+    state ^= 2747636419u;
+    state *= 2654435769u;
+    state ^= state >> 16;
+    state *= 2654435769u;
+    state ^= state >> 16;
+    state *= 2654435769u;
+    return state;
+}
+
+float random_01(inout uint state)
+{
+    state = hash(state);
+    return float(state) / 4294967295.0;
+}
+
+float random_range(inout uint state, float low, float high)
+{
+    return low + (high - low) * random_01(state);
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void main()
+{
+    // Def: gl_GlobalInvocationID = gl_WorkGroupID * gl_WorkGroupSize + gl_LocalInvocationID
+    uvec3 nb_particles = gl_NumWorkGroups * gl_WorkGroupSize;
+    int id = int(gl_GlobalInvocationID.y * nb_particles.x + gl_GlobalInvocationID.x);
+
+    if (id >= NB_BODY) {
+        return;
+    }
+
+    uint state = hash(uint(id) ^ hash(SEED));
+
+    buf.bodies[id].pos = vec4(random_range(state, -0.99, 0.99), random_range(state, -0.99, 0.99), random_range(state, -0.99, 0.99), 1.0);
+    buf.bodies[id].dat = vec4(random_range(state, 0.0, 2.0 * PI), float(id), 0.0, 0.0);
+}
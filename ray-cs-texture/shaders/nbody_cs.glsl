@@ -10,26 +10,10 @@ layout(local_size_x=XGROUPSIZE, local_size_y=YGROUPSIZE, local_size_z=ZGROUPSIZE
 
 // ---------------------------------------------------------------------------------------------------------------------
 
-uniform int   SCREEN_WIDTH;
-uniform int   SCREEN_HEIGHT;
+// uniform blocks SimParams (SCREEN_WIDTH, NB_BODY, SPEED_RATE, ...) and FrameParams (time, delta_time), config.py
+PARAMS_BLOCKS_VAL
 
-uniform float time;
-uniform int   delta_time;
-uniform int   NB_BODY;
-
-uniform float SPEED_RATE;
-uniform float TURN_SPEED;
-uniform float FADE_RATE;
-uniform float DIFFUSE_RATE;
-
-uniform float RANDOM_DIRECTION_STRENGTH;
-uniform float SENSOR_ANGLE;
-uniform float SENSOR_DIST;
-uniform int   SENSOR_SIZE;
-uniform float SENSOR_WEIGHT;
-uniform vec3  COLOR;
-
-layout(rgba8, binding = 0) uniform image2D out_texture;
+layout(rgba8, binding = 0) uniform image2D trail_map;
 
 // ---------------------------------------------------------------------------------------------------------------------
 
@@ -60,25 +44,8 @@ float random_01(uint state)
     state *= 2654435769u;
     state ^= state >> 16;
     state *= 2654435769u;
-    return state / 4294967295;
-}
-
-// ---------------------------------------------------------------------------------------------------------------------
-
-float clamp_01(float x)
-{
-    return max(0, min(1, x));
-}
-
-// ---------------------------------------------------------------------------------------------------------------------
-
-void random_test()
-{
-    ivec2 tex_coord2 = ivec2(gl_GlobalInvocationID.x, gl_GlobalInvocationID.y);
-
-    float c = random_01(gl_GlobalInvocationID.y * SCREEN_WIDTH + gl_GlobalInvocationID.x + int(time*10000));
-    vec4 color = vec4(c, c, c, 1.0);
-    imageStore(out_texture, tex_coord2, color);
+    // float division to [0, 1]
+    return float(state) / 4294967295.0;
 }
 
 // ---------------------------------------------------------------------------------------------------------------------
@@ -101,56 +68,6 @@ void clamp_pos(int id)
 
 // ---------------------------------------------------------------------------------------------------------------------
 
-void fade()
-{
-    ivec2 tex_coord = ivec2(gl_GlobalInvocationID.xy);
-
-    vec3 col = imageLoad(out_texture, tex_coord).rgb;
-
-    float r = max(0, col.r - FADE_RATE * delta_time);
-    float g = max(0, col.g - FADE_RATE * delta_time);
-    float b = max(0, col.b - FADE_RATE * delta_time);
-
-    imageStore(out_texture, tex_coord, vec4(r, g, b, 1.0));
-}
-
-// ---------------------------------------------------------------------------------------------------------------------
-
-void blur()
-{
-    ivec2 tex_coord = ivec2(gl_GlobalInvocationID.xy);
-
-    vec3 ori_col = imageLoad(out_texture, tex_coord).rgb;
-
-    vec3 sum_col = vec3(0.0, 0.0, 0.0);
-
-	for (int offset_x = -1; offset_x <= 1; offset_x ++) {
-		for (int offset_y = -1; offset_y <= 1; offset_y ++) {
-			int sample_x = min(SCREEN_WIDTH -1, max(0, tex_coord.x + offset_x));
-            int sample_y = min(SCREEN_HEIGHT-1, max(0, tex_coord.y + offset_y));
-
-            vec3 suround_col = imageLoad(out_texture, ivec2(sample_x, sample_y)).rgb;
-
-            sum_col += suround_col;
-		}
-	}
-
-    vec3 blur_col = sum_col / 9;
-
-	float diffuse_weight = clamp_01(DIFFUSE_RATE * delta_time);
-
-    blur_col = (ori_col * (1 - diffuse_weight)) + (blur_col * diffuse_weight);
-    blur_col = blur_col - (FADE_RATE * delta_time);
-
-    if (blur_col.r < 0) blur_col.r = 0;
-    if (blur_col.g < 0) blur_col.g = 0;
-    if (blur_col.b < 0) blur_col.b = 0;
-
-    imageStore(out_texture, tex_coord, vec4(blur_col, 1.0));
-}
-
-// ---------------------------------------------------------------------------------------------------------------------
-
 float sense(ivec2 body_pos, float body_angle, float sensor_angle)
 {
 	vec3 sense_weight  = vec3(SENSOR_WEIGHT, SENSOR_WEIGHT, SENSOR_WEIGHT);
@@ -172,7 +89,7 @@ float sense(ivec2 body_pos, float body_angle, float sensor_angle)
             int sample_x = min(SCREEN_WIDTH  - 1, max(0, int(sensor_center.x) + offset_x));
 			int sample_y = min(SCREEN_HEIGHT - 1, max(0, int(sensor_center.y) + offset_y));
 
-            vec3 sense_col = imageLoad(out_texture, ivec2(sample_x, sample_y)).rgb;
+            vec3 sense_col = imageLoad(trail_map, ivec2(sample_x, sample_y)).rgb;
 			sum += dot(sense_weight, sense_col);
 		}
 	}
@@ -185,17 +102,21 @@ float sense(ivec2 body_pos, float body_angle, float sensor_angle)
 void main()
 {
     // Def: gl_GlobalInvocationID = gl_WorkGroupID * gl_WorkGroupSize + gl_LocalInvocationID
+    // 1 invocation per body (dispatched over NB_BODY, independently of the screen size)
     uvec3 nb_particles = gl_NumWorkGroups * gl_WorkGroupSize;
     int id = int(gl_GlobalInvocationID.y * nb_particles.x + gl_GlobalInvocationID.x);
-    //id = int(gl_GlobalInvocationID);
-    //gl_LocalInvocationIndex
+
+    if (id >= NB_BODY) {
+        return;
+    }
 
     //
     float weight_forward = sense( to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), buf.bodies[id].dat.x, 0 );
     float weight_left    = sense( to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), buf.bodies[id].dat.x, radians(SENSOR_ANGLE) );
     float weight_right   = sense( to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), buf.bodies[id].dat.x, -radians(SENSOR_ANGLE) );
 
-    float direction_strength = (0.5 - RANDOM_DIRECTION_STRENGTH/2) + RANDOM_DIRECTION_STRENGTH * random_01(gl_GlobalInvocationID.y * SCREEN_WIDTH + gl_GlobalInvocationID.x + int(time*10000));
+    // random stream of the body ID (dat.y), not of its index: the bodies are reordered by the sort passes
+    float direction_strength = (0.5 - RANDOM_DIRECTION_STRENGTH/2) + RANDOM_DIRECTION_STRENGTH * random_01(int(buf.bodies[id].dat.y) + int(time*10000));
 
     //if (weight_forward > weight_left && weight_forward > weight_right) {
 	//}
@@ -219,12 +140,6 @@ void main()
 
     clamp_pos(id);
 
-    //random_test();
-
-    imageStore(out_texture, to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), vec4(COLOR, 1.0));
-    blur();
-
-    //memoryBarrierImage();
-    memoryBarrier();
-    barrier();
+    // deposit, diffused / faded by the diffuse pass
+    imageStore(trail_map, to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), vec4(COLOR, 1.0));
 }
\ No newline at end of file
@@ -0,0 +1,134 @@
+#version 430 core
+
+// Counting sort of the bodies by the Morton code of their trail map tile (SORT_TILE x SORT_TILE pixels), so that
+// neighbouring invocations of the agents pass sense / deposit neighbouring texels:
+// 1: histogram, bodies counted per key
+// 2: scan, counts => exclusive offsets (1 work group of SCAN_GROUPSIZE invocations)
+// 3: scatter, bodies_in copied to their offset in bodies_out (order within a key not kept)
+
+#define SORT_PASS   SORT_PASS_VAL
+
+#define XGROUPSIZE  XGROUPSIZE_VAL
+#define YGROUPSIZE  YGROUPSIZE_VAL
+#define ZGROUPSIZE  ZGROUPSIZE_VAL
+
+#define SORT_TILE       SORT_TILE_VAL
+#define SORT_KEYS       SORT_KEYS_VAL
+#define SCAN_GROUPSIZE  SCAN_GROUPSIZE_VAL
+
+#if SORT_PASS == 2
+layout(local_size_x=SCAN_GROUPSIZE, local_size_y=1, local_size_z=1) in;
+#else
+layout(local_size_x=XGROUPSIZE, local_size_y=YGROUPSIZE, local_size_z=ZGROUPSIZE) in;
+#endif
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+// uniform blocks SimParams (SCREEN_WIDTH, NB_BODY, SPEED_RATE, ...) and FrameParams (time, delta_time), config.py
+PARAMS_BLOCKS_VAL
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+struct Body
+{
+    vec4 pos;  // x, y, z, w
+    vec4 dat;  // angle, ID, nop, nop
+};
+
+layout(std430, binding = 0) buffer bodies_in
+{
+    Body bodies[];
+} buf_in;
+
+layout(std430, binding = 1) buffer bodies_out
+{
+    Body bodies[];
+} buf_out;
+
+// bodies per key (histogram), then first index of each key (scan, incremented by the scatter)
+layout(std430, binding = 2) buffer sort_counts
+{
+    uint counts[];
+};
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+uint spread_bits(uint x)
+{
+    x &= 0x0000FFFFu;
+    x = (x | (x << 8)) & 0x00FF00FFu;
+    x = (x | (x << 4)) & 0x0F0F0F0Fu;
+    x = (x | (x << 2)) & 0x33333333u;
+    x = (x | (x << 1)) & 0x55555555u;
+    return x;
+}
+
+uint get_key(vec4 pos)
+{
+    ivec2 tex_coord = ivec2( ((pos.x+1.0)/2.0) * SCREEN_WIDTH, ((pos.y+1.0)/2.0) * SCREEN_HEIGHT );
+    uvec2 tile = uvec2(clamp(tex_coord, ivec2(0), ivec2(SCREEN_WIDTH - 1, SCREEN_HEIGHT - 1)) / SORT_TILE);
+
+    return spread_bits(tile.x) | (spread_bits(tile.y) << 1);
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+#if SORT_PASS == 2
+
+shared uint partial[SCAN_GROUPSIZE];
+
+void main()
+{
+    // each invocation scans a run of consecutive keys, the sums of the runs are scanned in shared memory
+    const uint KEYS_PER_INVOCATION = (SORT_KEYS + SCAN_GROUPSIZE - 1) / SCAN_GROUPSIZE;
+
+    uint i     = gl_LocalInvocationID.x;
+    uint begin = min(i * KEYS_PER_INVOCATION, SORT_KEYS);
+    uint end   = min(begin + KEYS_PER_INVOCATION, SORT_KEYS);
+
+    uint sum = 0;
+    for (uint key = begin; key < end; key++) {
+        sum += counts[key];
+    }
+
+    // inclusive scan (Hillis-Steele)
+    partial[i] = sum;
+    barrier();
+
+    for (uint offset = 1; offset < SCAN_GROUPSIZE; offset <<= 1) {
+        uint value = i >= offset ? partial[i - offset] : 0;
+        barrier();
+        partial[i] += value;
+        barrier();
+    }
+
+    uint offset = partial[i] - sum;
+    for (uint key = begin; key < end; key++) {
+        uint count = counts[key];
+        counts[key] = offset;
+        offset += count;
+    }
+}
+
+#else
+
+void main()
+{
+    // 1 invocation per body, as the agents pass
+    uvec3 nb_particles = gl_NumWorkGroups * gl_WorkGroupSize;
+    int id = int(gl_GlobalInvocationID.y * nb_particles.x + gl_GlobalInvocationID.x);
+
+    if (id >= NB_BODY) {
+        return;
+    }
+
+    uint key = get_key(buf_in.bodies[id].pos);
+
+#if SORT_PASS == 1
+    atomicAdd(counts[key], 1u);
+#else
+    buf_out.bodies[atomicAdd(counts[key], 1u)] = buf_in.bodies[id];
+#endif
+}
+
+#endif
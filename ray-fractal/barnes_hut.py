@@ -0,0 +1,101 @@
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# Barnes-Hut octree of the bodies, built with NumPy from their Morton codes, flattened for a stackless traversal
+# in gravity_cs.glsl.
+#
+# struct Node
+# {
+#     vec4  com;    // center of mass, mass
+#     float size;   // side of the cell
+#     int   skip;   // next node once the subtree is accepted or done
+#     int   start;  // bodies [start, end[ of the sorted bodies
+#     int   end;
+# };
+#
+# The nodes are in depth-first order: the first child of a node follows it, skip == index + 1 for a leaf.
+# A node is split while it holds more than leaf_size bodies, nodes with a single child are dropped (the child
+# covers the same bodies with a smaller cell).
+
+NODE_DTYPE = np.dtype([('com', 'f4', 4), ('size', 'f4'), ('skip', 'i4'), ('start', 'i4'), ('end', 'i4')])
+
+MORTON_BITS = 10    # bits per axis of the Morton codes: depth of the tree
+
+def spread_bits(x):
+    # bits of x (up to 21) spaced by 2 zeros
+    x = x.astype(np.uint64) & 0x1FFFFF
+    x = (x | (x << 32)) & 0x1F00000000FFFF
+    x = (x | (x << 16)) & 0x1F0000FF0000FF
+    x = (x | (x << 8))  & 0x100F00F00F00F00F
+    x = (x | (x << 4))  & 0x10C30C30C30C30C3
+    x = (x | (x << 2))  & 0x1249249249249249
+    return x
+
+def get_morton_codes(positions, bmin, size, bits=MORTON_BITS):
+    cells = np.clip(((positions - bmin) / size * (1 << bits)).astype(np.int64), 0, (1 << bits) - 1)
+    return spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << 1) | (spread_bits(cells[:, 2]) << 2)
+
+def build_octree(positions, masses, leaf_size=8, bits=MORTON_BITS):
+    """Octree of (n, 3) positions and (n,) masses.
+
+    Returns (nodes, order): the NODE_DTYPE array and the permutation sorting the bodies along the Morton curve
+    (node bodies ranges index positions[order]).
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    masses = np.asarray(masses, dtype=np.float64)
+    nb_body = len(positions)
+
+    bmin = positions.min(axis=0)
+    size = max(float((positions.max(axis=0) - bmin).max()), 1e-6) * (1.0 + 1e-6)
+
+    codes = get_morton_codes(positions, bmin, size, bits)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+
+    # cells of each level: ranges of equal code prefixes, which exist when their parent cell was split (it holds
+    # more than leaf_size bodies)
+    levels, starts, ends = [], [], []
+    parent_starts = np.zeros(1, dtype=np.int64)
+    parent_split = np.ones(1, dtype=bool)
+
+    for level in range(bits + 1):
+        prefix = codes >> np.uint64(3 * (bits - level))
+        cell_starts = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+        cell_ends = np.r_[cell_starts[1:], nb_body]
+
+        exists = parent_split[np.searchsorted(parent_starts, cell_starts, side='right') - 1]
+
+        levels.append(np.full(np.count_nonzero(exists), level))
+        starts.append(cell_starts[exists])
+        ends.append(cell_ends[exists])
+
+        parent_starts = cell_starts
+        parent_split = exists & (cell_ends - cell_starts > leaf_size)
+        if not parent_split.any():
+            break
+
+    levels, starts, ends = np.concatenate(levels), np.concatenate(starts), np.concatenate(ends)
+
+    # depth-first order: by start, larger ranges first; same range: the deepest cell only
+    keys = np.lexsort((-levels, -ends, starts))
+    levels, starts, ends = levels[keys], starts[keys], ends[keys]
+
+    keep = np.r_[True, (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])]
+    levels, starts, ends = levels[keep], starts[keep], ends[keep]
+
+    # mass and center of mass of the ranges from prefix sums
+    sorted_masses = masses[order]
+    mass_sums = np.r_[0.0, np.cumsum(sorted_masses)]
+    moment_sums = np.vstack([np.zeros(3), np.cumsum(positions[order] * sorted_masses[:, None], axis=0)])
+
+    mass = mass_sums[ends] - mass_sums[starts]
+
+    nodes = np.zeros(len(starts), dtype=NODE_DTYPE)
+    nodes['com'][:, :3] = (moment_sums[ends] - moment_sums[starts]) / np.maximum(mass, 1e-30)[:, None]
+    nodes['com'][:, 3] = mass
+    nodes['size'] = size / (1 << levels)
+    nodes['skip'] = np.searchsorted(starts, ends, side='left')
+    nodes['start'] = starts
+    nodes['end'] = ends
+
+    return nodes, order
@@ -1,4 +1,5 @@
-import time, collections
+import os, csv, json, time, hashlib, contextlib, collections
+import numpy as np
 import moderngl as mgl
 import pygame, cv2
 
@@ -13,8 +14,36 @@ XGROUPSIZE = 64
 YGROUPSIZE = 1
 ZGROUPSIZE = 1
 
+# N-body: G, Plummer softening length, simulation time units per ms of delta_time, initial rotation of the cube
+GRAVITY    = 1.0
+SOFTENING  = 0.02
+TIME_SCALE = 0.001
+ROTATION   = 0.5
+
+# --gravity=barnes_hut: opening angle, bodies per leaf of the octree
+BH_THETA     = 0.5
+BH_LEAF_SIZE = 8
+
 GRAB_MOUSE = False
 
+HEADLESS_BACKEND = "egl"
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ray-python")
+
+# driver shader binary cache (empty: driver default)
+SHADER_CACHE_DIR = os.path.join(CACHE_DIR, "shaders")
+
+# shader hot reload: seconds between two polls of the sources
+SHADER_WATCH_INTERVAL = 0.25
+
+# local sizes timed by --autotune, the winner of each shader / device is saved to GROUPSIZE_FILE
+GROUPSIZE_CANDIDATES = [(8, 8), (16, 16), (32, 4), (32, 8), (16, 4), (64, 1), (128, 1), (256, 1)]
+GROUPSIZE_FILE = os.path.join(CACHE_DIR, "groupsizes.json")
+
+# fixed simulation step (ms, unit of the delta_time uniform), at most MAX_SIM_STEPS steps per displayed frame in real time
+SIM_DT        = 1000.0 / 60.0
+MAX_SIM_STEPS = 8
+
 # ----------------------------------------------------------------------------------------------------------------------
 
 class FPSCounter:
@@ -47,14 +76,269 @@ class ScreenRecorder:
 
         self.video = cv2.VideoWriter(out_file, four_cc, float(fps), (width, height))
 
-    def capture_frame(self, surf):
+        self.width = width
+        self.height = height
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def surface_to_bgr(self, surf):
         # transform the pixels to the format used by open-cv
         pixels = cv2.rotate(pygame.surfarray.pixels3d(surf), cv2.ROTATE_90_CLOCKWISE)
         pixels = cv2.flip(pixels, 1)
         pixels = cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+        return pixels
+
+    def rgba_to_bgr(self, data):
+        # bottom-up RGBA rows (as read from OpenGL) => top-down BGR, written into the preallocated frame:
+        # swizzle from a NumPy view of the raw data, then flip in place (no temporary image)
+        rgba = np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 4)
+        cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR, dst=self.frame)
+        cv2.flip(self.frame, 0, dst=self.frame)
+        return self.frame
 
+    def capture_frame(self, surf):
         # write the frame
-        self.video.write(pixels)
+        self.video.write(self.surface_to_bgr(surf))
+
+    def capture_rgba(self, data):
+        # raw texture bytes / array, no pygame Surface
+        self.video.write(self.rgba_to_bgr(data))
 
     def end_recording(self):
         self.video.release()
+
+# -----------------------------------------------------------------------------------------------------------
+
+class AsyncReadback:
+    """Read a texture back through a ring of pixel buffer objects.
+
+    read() queues the copy of the current frame and returns the pixels queued nb_buffers-1 frames
+    earlier, so the GPU->CPU transfer overlaps the rendering of the next frames. With nb_buffers=1
+    the texture is read synchronously. The time spent waiting for the pixels is kept in stall_times.
+
+    The pixels are returned in a uint8 array reused from one call to the next.
+    """
+    def __init__(self, ctx, width, height, components=4, nb_buffers=3):
+        self.pixels = np.empty(width * height * components, dtype=np.uint8)
+        self.buffers = [ctx.buffer(reserve=self.pixels.nbytes) for _ in range(nb_buffers)] if nb_buffers > 1 else []
+        self.index = 0
+        self.pending = 0
+        self.stall_times = []
+
+    def read(self, texture):
+        if not self.buffers:
+            t0 = time.perf_counter()
+            texture.read_into(self.pixels)
+            self.stall_times.append(time.perf_counter() - t0)
+            return self.pixels
+
+        texture.read_into(self.buffers[self.index])
+        self.index = (self.index + 1) % len(self.buffers)
+
+        if self.pending < len(self.buffers) - 1:
+            self.pending += 1
+            return None
+
+        t0 = time.perf_counter()
+        self.buffers[self.index].read_into(self.pixels)
+        self.stall_times.append(time.perf_counter() - t0)
+        return self.pixels
+
+    def flush(self):
+        # frames still in flight, oldest first
+        while self.pending > 0:
+            self.buffers[(self.index - self.pending) % len(self.buffers)].read_into(self.pixels)
+            yield self.pixels
+            self.pending -= 1
+
+    def get_stall_ms(self):
+        if not self.stall_times:
+            return 0
+        return 1000 * sum(self.stall_times) / len(self.stall_times)
+
+    def release(self):
+        for buffer in self.buffers:
+            buffer.release()
+
+# -----------------------------------------------------------------------------------------------------------
+
+class PassTimer:
+    """Per-pass timings of a frame, without stalling the pipeline.
+
+    gpu(name) wraps the GL commands of a pass in a GL_TIME_ELAPSED query, cpu(name) measures the wall time
+    of a CPU side step (display.flip, video readback...) and end_frame() the wall time of the whole frame
+    ("frame_ms", from the previous end_frame()). A query is read `latency` frames after its frame
+    was submitted, when the GPU is done with it: each pass has a ring of latency+1 queries (one ring per run
+    of a pass repeated in the frame, timed by their sum).
+
+    The timings (ms) of the last `history` resolved frames are averaged by get_summary(), all the resolved
+    frames are kept in records when keep_records is set, for dump().
+    """
+    NO_RESULT = 0xFFFFFFFF
+
+    def __init__(self, ctx, latency=3, history=60, keep_records=False):
+        self.ctx = ctx
+        self.latency = latency
+        self.queries = {}
+        self.frame = 0
+        self.frame_start = time.perf_counter()
+        self.gpu_queries = {}
+        self.cpu_times = {}
+        self.pending = collections.deque()
+        self.history = collections.deque(maxlen=history)
+        self.keep_records = keep_records
+        self.records = []
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def disabled(self):
+        # passes run outside of the frames (--autotune candidates): not timed
+        self.enabled = False
+        try:
+            yield
+        finally:
+            self.enabled = True
+
+    @contextlib.contextmanager
+    def gpu(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        # a pass run several times in a frame (simulation substeps) has a ring per run, its time is their sum
+        queries = self.gpu_queries.setdefault(name, [])
+        rings = self.queries.setdefault(name, [])
+        if len(queries) == len(rings):
+            rings.append([self.ctx.query(time=True) for _ in range(self.latency + 1)])
+
+        query = rings[len(queries)][self.frame % (self.latency + 1)]
+        with query:
+            yield
+        queries.append(query)
+
+    @contextlib.contextmanager
+    def cpu(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        t0 = time.perf_counter()
+        yield
+        self.cpu_times[name] = 1000 * (time.perf_counter() - t0)
+
+    def end_frame(self):
+        t1 = time.perf_counter()
+        self.cpu_times["frame_ms"] = 1000 * (t1 - self.frame_start)
+        self.frame_start = t1
+
+        self.pending.append((self.frame, self.gpu_queries, self.cpu_times))
+        self.gpu_queries = {}
+        self.cpu_times = {}
+        self.frame += 1
+
+        while len(self.pending) > self.latency:
+            self.resolve()
+
+    def resolve(self):
+        frame, gpu_queries, cpu_times = self.pending.popleft()
+
+        # a query without result reads 2^32 - 1 ns (llvmpipe, first use of a ring): its pass is left out of the frame
+        timings = {}
+        for name, queries in gpu_queries.items():
+            elapsed = [query.elapsed for query in queries]
+            if max(elapsed) < self.NO_RESULT:
+                timings[name] = sum(elapsed) / 1e6
+        timings.update(cpu_times)
+
+        self.history.append(timings)
+        if self.keep_records:
+            self.records.append({"frame": frame, **timings})
+
+    def flush(self):
+        while self.pending:
+            self.resolve()
+
+    def get_summary(self):
+        # mean ms per pass, "name ms | name ms ..."
+        names = list(dict.fromkeys(name for timings in self.history for name in timings))
+        if not names:
+            return "n/a"
+
+        means = [(name, [timings[name] for timings in self.history if name in timings]) for name in names]
+        return " | ".join(f"{name} {sum(values) / len(values):.2f}" for name, values in means) + " ms"
+
+    def dump(self, path):
+        # per-frame timings, .json (list of records) or .csv
+        if path.endswith(".json"):
+            with open(path, "w") as file:
+                json.dump(self.records, file, indent=1)
+        else:
+            names = list(dict.fromkeys(name for record in self.records for name in record))
+            with open(path, "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=names)
+                writer.writeheader()
+                writer.writerows(self.records)
+
+        print(f"Pass timings of {len(self.records)} frames saved to {path}")
+
+# -----------------------------------------------------------------------------------------------------------
+
+class GroupSizeTuner:
+    """Fastest local work group size of compute shaders on the current device.
+
+    tune() times `nb_runs` calls of run(group_size) per candidate (after a warm-up call, which compiles the
+    shaders) and saves the winner in a JSON file, keyed by the renderer, the shader names ("ray+gravity": the
+    shaders run by run()), the variant of the run (mode, sizes...) and the hash of their sources: editing a shader,
+    changing of variant or of GPU / driver invalidates the winner.
+    """
+    def __init__(self, ctx, path=GROUPSIZE_FILE):
+        self.ctx = ctx
+        self.path = path
+        self.renderer = ctx.info["GL_RENDERER"]
+        self.max_size = ctx.info["GL_MAX_COMPUTE_WORK_GROUP_SIZE"]
+        self.max_invocations = ctx.info["GL_MAX_COMPUTE_WORK_GROUP_INVOCATIONS"]
+
+        self.winners = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.winners = json.load(file)
+
+    def get_key(self, shader_name, variant=""):
+        source_hash = hashlib.sha256()
+        for name in shader_name.split("+"):
+            with open(f'shaders/{name}_cs.glsl', 'rb') as file:
+                source_hash.update(file.read())
+        return f"{self.renderer} | {shader_name} | {variant} | {source_hash.hexdigest()[:16]}"
+
+    def get(self, shader_name, variant=""):
+        # saved winner, None if the shaders were not tuned on this device
+        group_size = self.winners.get(self.get_key(shader_name, variant))
+        return tuple(group_size) if group_size else None
+
+    def tune(self, shader_name, run, variant="", candidates=GROUPSIZE_CANDIDATES, nb_runs=10):
+        times = {}
+
+        for group_size in candidates:
+            if group_size[0] > self.max_size[0] or group_size[1] > self.max_size[1] or group_size[0] * group_size[1] > self.max_invocations:
+                continue
+
+            run(group_size)
+            self.ctx.finish()
+
+            t0 = time.perf_counter()
+            for _ in range(nb_runs):
+                run(group_size)
+            self.ctx.finish()
+            times[group_size] = 1000 * (time.perf_counter() - t0) / nb_runs
+
+            print(f"{shader_name}: local size {group_size[0]:3d}x{group_size[1]:<3d} {times[group_size]:8.3f} ms")
+
+        best = min(times, key=times.get)
+        print(f"{shader_name}: best local size {best[0]}x{best[1]}, saved to {self.path}")
+
+        self.winners[self.get_key(shader_name, variant)] = list(best)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as file:
+            json.dump(self.winners, file, indent=1)
+
+        return best
@@ -1,4 +1,4 @@
-import sys, argparse, random
+import os, sys, argparse, random
 
 import pygame as pg
 import numpy as np
@@ -7,53 +7,126 @@ import glm
 from array import array
 
 from config import *
-from shader_program import ShaderProgram
+from shader_program import ShaderProgram, setup_shader_cache
+from barnes_hut import NODE_DTYPE, build_octree
 
 # -----------------------------------------------------------------------------------------------------------
 
+# Body
+# {
+#    vec4 pos;  // x, y, z, mass
+#    vec4 vel;  // x, y, z, nop
+# };
+BODY_DTYPE = np.dtype([('pos', 'f4', 4), ('vel', 'f4', 4)])
+
+# number of bodies drawn per batch from the random generator (bounds the transient memory)
+INIT_CHUNK = 1 << 20
+
 class Bodies:
 
     def __init__(self, app):
         self.app = app
         self.ctx = app.ctx
 
-        particles_array = self.get_particles()
-        self.ssbo_in    = self.ctx.buffer(data = particles_array)
+        if self.app.gpu_init:
+            self.ssbo_in = self.ctx.buffer(reserve=self.app.nb_body * BODY_DTYPE.itemsize)
+            self.init_on_gpu()
+        else:
+            particles_array = self.get_particles()
+            self.ssbo_in    = self.ctx.buffer(data = particles_array)
+
+        # gravity pass: ssbo_in => ssbo_out, swapped after each step
+        self.ssbo_out = self.ctx.buffer(reserve=self.app.nb_body * BODY_DTYPE.itemsize)
+
+        # --gravity=barnes_hut: octree nodes (at most 2 N - 1) and positions of the bodies in the order of the tree
+        if self.app.gravity == "barnes_hut":
+            self.tree_nodes = self.ctx.buffer(reserve=max(2 * self.app.nb_body - 1, 1) * NODE_DTYPE.itemsize)
+            self.tree_bodies = self.ctx.buffer(reserve=self.app.nb_body * 16)
+            self.nb_node = 0
 
     def destroy(self):
         self.ssbo_in.release()
+        self.ssbo_out.release()
+        if self.app.gravity == "barnes_hut":
+            self.tree_nodes.release()
+            self.tree_bodies.release()
 
     def get_particles(self):
+        rng = np.random.default_rng(self.app.seed)
+
+        bodies = np.empty(self.app.nb_body, dtype=BODY_DTYPE)
+
+        for start in range(0, self.app.nb_body, INIT_CHUNK):
+            chunk = bodies[start:start + INIT_CHUNK]
 
-        # Body
-        # {
-        #    vec4 pos;  // x, y, z, w
-        # };
+            # total mass 1, rotating cube
+            chunk['pos'][:, :3] = rng.uniform(-0.99, 0.99, (len(chunk), 3))
+            chunk['pos'][:, 3]  = 1.0 / self.app.nb_body
+            chunk['vel'][:, 0]  = -ROTATION * chunk['pos'][:, 1]
+            chunk['vel'][:, 1]  = ROTATION * chunk['pos'][:, 0]
+            chunk['vel'][:, 2:] = 0.0
 
-        bodies = []
-        for i in range(0, self.app.nb_body):
-            posx, posy, posz = random.uniform(-0.99, 0.99), random.uniform(-0.99, 0.99), random.uniform(-0.99, 0.99)
+        return bodies
 
-            bodies.extend((posx, posy, posz, 1.0))
+    def init_on_gpu(self):
+        init_shader = self.app.all_shaders.get_compute_program("init")
 
-        vertex_data = np.asarray(bodies, dtype='f4') #vertex_data = np.array(bodies, dtype='f4')
+        self.app.set_uniform(init_shader, "NB_BODY", self.app.nb_body)
+        self.app.set_uniform(init_shader, "SEED", self.app.seed)
+        self.app.set_uniform(init_shader, "ROTATION", ROTATION)
 
-        return vertex_data
+        # CS: layout(std430, binding = 0) buffer bodies_in
+        self.ssbo_in.bind_to_storage_buffer(0)
+
+        group_x, group_y = self.app.get_body_groups()
+        init_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+
+        self.ctx.memory_barrier()
+
+    def build_octree(self):
+        # --gravity=barnes_hut: octree of the current positions, read back and built with NumPy, then uploaded
+        bodies = np.frombuffer(self.ssbo_in.read(), dtype=BODY_DTYPE)
+        nodes, order = build_octree(bodies['pos'][:, :3], bodies['pos'][:, 3], leaf_size=BH_LEAF_SIZE)
+
+        self.tree_nodes.write(nodes)
+        self.tree_bodies.write(np.ascontiguousarray(bodies['pos'][order]))
+        self.nb_node = len(nodes)
+
+    def swap(self):
+        self.ssbo_in, self.ssbo_out = self.ssbo_out, self.ssbo_in
 
 # -----------------------------------------------------------------------------------------------------------
 
 class App:
 
-    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, fps=-1, record_video="", video_fps=60):
+    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, fps=-1, record_video="", video_fps=60, readback_buffers=3, headless=False, frames=-1, seed=None, gpu_init=False, hot_reload=False, timings="", group_size=None, autotune=False, sync=False, sim_dt=SIM_DT, substeps=0, fast_forward=0, nb_body=32, gravity="direct"):
+
+        self.nb_body = nb_body
+        self.gravity = gravity
 
-        self.nb_body = 32
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.gpu_init = gpu_init
 
         self.screen_width = screen_width
         self.screen_height = screen_height
         self.max_fps = fps
 
+        self.headless = headless
+        self.max_frames = frames
+        self.hot_reload = hot_reload
+        self.timings = timings
+        self.sync = sync
+        self.group_size = group_size
+        self.autotune = autotune
+
+        # fixed timestep: steps of sim_dt ms, --substeps / --fast_forward per displayed frame (else in real time)
+        self.sim_dt = sim_dt
+        self.substeps = substeps
+        self.fast_forward = fast_forward
+
         self.record_video = record_video
         self.video_fps = video_fps
+        self.readback_buffers = readback_buffers
 
         if self.record_video:
             if self.record_video in ("XVID", "h264", "avc1", "mp4v"):
@@ -62,15 +135,13 @@ class App:
                 self.video_recorder = ScreenRecorder(self.screen_width, self.screen_height, self.video_fps)
 
         #
-        print("SCREEN WIDTH =", SCREEN_WIDTH)
-        print("SCREEN HEIGHT=", SCREEN_HEIGHT)
+        print("SCREEN WIDTH =", self.screen_width)
+        print("SCREEN HEIGHT=", self.screen_height)
 
-        print("X LOCAL  GROUPSIZE=", XGROUPSIZE)
-        print("Y LOCAL  GROUPSIZE=", YGROUPSIZE)
-        print("Z LOCAL  GROUPSIZE=", ZGROUPSIZE)
-        print("X GLOBAL GROUPSIZE=", SCREEN_WIDTH // XGROUPSIZE)
-        print("Y GLOBAL GROUPSIZE=", SCREEN_HEIGHT // YGROUPSIZE)
-        print("Z GLOBAL GROUPSIZE=", 1)
+        print("NB_BODY=", self.nb_body)
+        print("GRAVITY=", self.gravity)
+        print("SEED=", self.seed)
+        print("SIM_DT=", self.sim_dt)
 
         #
         self.lastTime = time.time()
@@ -80,24 +151,41 @@ class App:
         self.fps = FPSCounter()
 
         # pygame init
+        if self.headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+        # persistent shader binaries, before the OpenGL context creation
+        setup_shader_cache()
+
         pg.init()
 
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
+        if self.headless:
+            # OpenGL context without window (EGL), rendering into an offscreen framebuffer
+            self.ctx = mgl.create_context(standalone=True, require=430, backend=HEADLESS_BACKEND)
+
+            self.fbo = self.ctx.simple_framebuffer((self.screen_width, self.screen_height), components=4)
+            self.fbo.use()
+        else:
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
 
-        pg_flags = pg.OPENGL | pg.DOUBLEBUF
-        if FULLSCREEN:
-            pg_flags |= pg.FULLSCREEN
+            pg_flags = pg.OPENGL | pg.DOUBLEBUF
+            if FULLSCREEN:
+                pg_flags |= pg.FULLSCREEN
 
-        pg.display.set_mode((self.screen_width, self.screen_height), flags=pg_flags)
+            pg.display.set_mode((self.screen_width, self.screen_height), flags=pg_flags)
 
-        pg.event.set_grab(GRAB_MOUSE)
-        pg.mouse.set_visible(True)
+            pg.event.set_grab(GRAB_MOUSE)
+            pg.mouse.set_visible(True)
+
+            # OpenGL context / options
+            self.ctx = mgl.create_context()
+            self.fbo = self.ctx.screen
+
+        # GPU time per pass (timer queries) + CPU time of flip / readback
+        self.timer = PassTimer(self.ctx, keep_records=bool(self.timings))
 
-        # OpenGL context / options
-        self.ctx = mgl.create_context()
-        
         self.ctx.wireframe = False
         #self.ctx.front_face = 'cw'
         #self.ctx.enable(flags=mgl.DEPTH_TEST)
@@ -108,9 +196,13 @@ class App:
         # time objects
         self.clock = pg.time.Clock()
         self.time = 0
-        self.delta_time = 0
         self.num_frames = 0
 
+        # simulation clock: real time not simulated yet (ms), simulated steps / time (s)
+        self.sim_accumulator = 0.0
+        self.sim_steps = 0
+        self.sim_time = 0.0
+
         # quad
         quad = [
             # pos (x, y), uv coords (x, y)
@@ -120,42 +212,130 @@ class App:
             1.0, -1.0, 1.0, 0.0,  # br
         ]
 
-        quad_buffer = self.ctx.buffer(data=np.array(quad, dtype='f4'))
+        self.quad_buffer = self.ctx.buffer(data=np.array(quad, dtype='f4'))
+        self.quad_vao = None
 
-        self.all_shaders = ShaderProgram(self.ctx)
-        self.quad_program = self.all_shaders.get_program("quad")
+        # local work group size: --group_size, else the winner of a previous --autotune on this device, else config.py
+        # (a step runs the gravity pass and the ray pass with the same local size, the gravity one depends on the mode
+        # and on the number of bodies)
+        self.tuner = GroupSizeTuner(self.ctx)
+        self.tune_variant = f"{self.gravity}, {self.nb_body} bodies"
+        self.xgroupsize, self.ygroupsize = self.group_size or self.tuner.get("ray+gravity", self.tune_variant) or (XGROUPSIZE, YGROUPSIZE)
 
-        # compute shader
-        with open(f'shaders/ray_cs.glsl') as file:
-            compute_shader_source = file.read()
+        self.all_shaders = ShaderProgram(self.ctx, watch=self.hot_reload, group_size=(self.xgroupsize, self.ygroupsize, ZGROUPSIZE))
+        self.load_programs()
 
-        compute_shader_source = compute_shader_source.replace("XGROUPSIZE_VAL", str(XGROUPSIZE)) \
-                                                     .replace("YGROUPSIZE_VAL", str(YGROUPSIZE)) \
-                                                     .replace("ZGROUPSIZE_VAL", str(ZGROUPSIZE))
+        self.texture = self.ctx.texture((int(self.screen_width/1), int(self.screen_height/1)), 4, dtype='f1')
+        self.texture.filter = mgl.NEAREST, mgl.NEAREST # because when we access the image from a CS it is an Image2D (not Sampler2D)
+        #self.texture.bind_to_image(0, read=False, write=True)
+
+        if self.record_video:
+            self.readback = AsyncReadback(self.ctx, self.screen_width, self.screen_height, nb_buffers=self.readback_buffers)
+
+        self.bodies = Bodies(self)
+        self.start_leapfrog()
+
+        # --autotune: the candidates step the simulation, untimed, from a snapshot restored afterwards (same run
+        # with or without --autotune for a --seed)
+        if self.autotune:
+            state = self.get_state()
+            with self.timer.disabled():
+                self.set_group_size(self.tuner.tune("ray+gravity", self.run_group_size, self.tune_variant))
+            self.set_state(state)
+            self.all_shaders.prune()
+
+        print("X LOCAL  GROUPSIZE=", self.xgroupsize)
+        print("Y LOCAL  GROUPSIZE=", self.ygroupsize)
+        print("Z LOCAL  GROUPSIZE=", ZGROUPSIZE)
+
+    def set_group_size(self, group_size):
+        self.xgroupsize, self.ygroupsize = group_size
+        self.all_shaders.group_size = (self.xgroupsize, self.ygroupsize, ZGROUPSIZE)
+        self.load_programs()
+
+    def run_group_size(self, group_size):
+        # --autotune: one simulation step run with a candidate local size
+        self.set_group_size(group_size)
+        self.step()
+
+    def get_state(self):
+        # bodies, texture and simulation clock
+        return self.bodies.ssbo_in.read(), self.texture.read(), self.sim_steps, self.sim_time
 
-        self.compute_shader = self.ctx.compute_shader(compute_shader_source)
+    def set_state(self, state):
+        bodies, texture, self.sim_steps, self.sim_time = state
+
+        self.bodies.ssbo_in.write(bodies)
+        self.texture.write(texture)
+
+    def load_programs(self):
+        # programs and their static uniforms / vertex arrays, reloaded after a shader change
+        self.quad_program = self.all_shaders.get_program("quad")
+
+        # compute shader
+        self.compute_shader = self.all_shaders.get_compute_program("ray")
 
         self.set_uniform(self.compute_shader, "SCREEN_WIDTH", self.screen_width)
         self.set_uniform(self.compute_shader, "SCREEN_HEIGHT", self.screen_height)
+        self.set_uniform(self.compute_shader, "NB_BODY", self.nb_body)
+
+        # gravity pass: direct sum (tiled) or Barnes-Hut
+        self.gravity_shader = self.all_shaders.get_compute_program("gravity", BARNES_HUT=int(self.gravity == "barnes_hut"))
+
+        self.set_uniform(self.gravity_shader, "NB_BODY", self.nb_body)
+        self.set_uniform(self.gravity_shader, "GRAVITY", GRAVITY)
+        self.set_uniform(self.gravity_shader, "SOFTENING", SOFTENING)
+        self.set_uniform(self.gravity_shader, "TIME_SCALE", TIME_SCALE)
+        self.set_uniform(self.gravity_shader, "THETA", BH_THETA)
+        self.set_uniform(self.gravity_shader, "KICK", 1.0)
+        self.set_uniform(self.gravity_shader, "DRIFT", 1.0)
 
         # CS: layout(rgba8, binding = 0) uniform image2D out_texture;
         self.compute_shader["out_texture"] = 0
         #self.compute_shader["out_texture2"] = 1 # layout(rgba8, binding = 1) uniform image2D out_texture2;
 
-        self.texture = self.ctx.texture((int(self.screen_width/1), int(self.screen_height/1)), 4, dtype='f1')
-        self.texture.filter = mgl.NEAREST, mgl.NEAREST # because when we access the image from a CS it is an Image2D (not Sampler2D)
-        #self.texture.bind_to_image(0, read=False, write=True)
-
         self.quad_program['quad_tex'] = 0
 
-        self.quad_vao = self.ctx.vertex_array(self.quad_program, [(quad_buffer, '2f 2f', 'vert', 'texcoord')])
-
-        self.bodies = Bodies(self)
+        if self.quad_vao:
+            self.quad_vao.release()
+        self.quad_vao = self.ctx.vertex_array(self.quad_program, [(self.quad_buffer, '2f 2f', 'vert', 'texcoord')])
 
     def destroy(self):
         self.all_shaders.destroy()
+        self.quad_vao.release()
+        self.quad_buffer.release()
         self.bodies.destroy()
 
+    def quit(self):
+        self.timer.flush()
+        if self.timings:
+            self.timer.dump(self.timings)
+
+        if self.record_video:
+            for data in self.readback.flush():
+                self.capture_frame(data)
+            self.video_recorder.end_recording()
+            print(f"Readback stall: {self.readback.get_stall_ms():.3f} ms/frame ({self.readback_buffers} buffer(s))")
+            self.readback.release()
+
+        self.destroy()
+        pg.quit()
+
+    def get_body_groups(self):
+        # one invocation per body, in rows of at most 65535 work groups (minimum GL_MAX_COMPUTE_WORK_GROUP_COUNT)
+        group_size = self.xgroupsize * self.ygroupsize
+        group_x = min((self.nb_body + group_size - 1) // group_size, 65535)
+        group_y = (self.nb_body + group_x * group_size - 1) // (group_x * group_size)
+        return group_x, group_y
+
+    def get_pixel_groups(self):
+        # one invocation per pixel, the invocations past the right / top borders are masked in the shader,
+        # rows added past the top border while there are fewer invocations than bodies
+        group_x = (self.screen_width  + self.xgroupsize - 1) // self.xgroupsize
+        group_y = (self.screen_height + self.ygroupsize - 1) // self.ygroupsize
+        group_y = max(group_y, (self.nb_body + group_x * self.xgroupsize * self.ygroupsize - 1) // (group_x * self.xgroupsize * self.ygroupsize))
+        return group_x, group_y
+
     def set_uniform(self, program, u_name, u_value):
         try:
             program[u_name] = u_value
@@ -168,7 +348,11 @@ class App:
 
         if delta >= 1:
             fps = f"FPS: {self.fps.get_fps():3.0f}"
-            pg.display.set_caption(fps)
+            timings = self.timer.get_summary()
+            if self.headless:
+                print(fps + " | " + timings)
+            else:
+                pg.display.set_caption(fps + " | " + timings)
 
             self.lastTime = self.currentTime
 
@@ -179,10 +363,7 @@ class App:
         for event in pg.event.get():
 
             if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
-                self.destroy()
-                if self.record_video:
-                    self.video_recorder.end_recording()
-                pg.quit()
+                self.quit()
                 sys.exit()
 
             if event.type == pg.KEYDOWN:
@@ -192,65 +373,210 @@ class App:
             if event.type == pg.KEYUP:
                 pass
 
-    def run(self):
+    def capture_frame(self, data):
+        self.video_recorder.capture_rgba(data)
+
+    def render_frame(self):
+        # shader hot reload, at the frame boundary
+        if self.all_shaders.reload():
+            self.load_programs()
 
-        while True:
-            self.time = pg.time.get_ticks() * 0.001
+        self.time = pg.time.get_ticks() * 0.001
 
-            self.check_events()
+        self.ctx.clear(color=(0.0, 0.0, 0.0))
 
-            self.ctx.clear(color=(0.0, 0.0, 0.0))
+        # steps of the frame dispatched back to back, no flip / readback between them
+        if not self.pause:
+            for _ in range(self.get_sim_steps()):
+                self.step()
 
-            if not self.pause:
-                self.set_uniform(self.compute_shader, "time", self.time)
-                self.set_uniform(self.compute_shader, "delta_time", self.delta_time)
+        # FS
+        with self.timer.gpu("quad"):
+            self.texture.use(location=0)
+            self.quad_vao.render(mode=mgl.TRIANGLE_STRIP)
 
-                # CS: layout(std430, binding = 0) buffer bodies_in
-                self.bodies.ssbo_in.bind_to_storage_buffer(0)
+    def get_sim_steps(self):
+        # --fast_forward / --substeps: fixed number of steps per frame, else the real time elapsed in steps of sim_dt
+        if self.fast_forward or self.substeps:
+            return self.fast_forward or self.substeps
 
-                # CS: layout(rgba8, binding = 0) uniform image2D out_texture;
-                self.texture.bind_to_image(0, read=False, write=True) # glBindImageTexture(0, texHandle, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_R32F);
+        steps = int(self.sim_accumulator // self.sim_dt)
+        self.sim_accumulator -= steps * self.sim_dt
 
-                # Number of WorkGroup: self.screen_width//XGROUPSIZE * self.screen_height//YGROUPSIZE * 1
-                self.compute_shader.run(group_x= self.screen_width//XGROUPSIZE, group_y= self.screen_height//YGROUPSIZE, group_z=1)
-                #self.compute_shader.run(group_x= self.screen_width, group_y= self.screen_height, group_z=1)
+        # frames too slow to keep up: the simulation slows down instead of spiralling into more steps per frame
+        if steps > MAX_SIM_STEPS:
+            steps, self.sim_accumulator = MAX_SIM_STEPS, 0.0
 
-                self.ctx.memory_barrier()
+        return steps
 
-            # FS
-            self.texture.use(location=0)
-            self.quad_vao.render(mode=mgl.TRIANGLE_STRIP)
+    def start_leapfrog(self):
+        # initial velocities v(0) => v(-dt/2), as the steps expect: half kick back, no drift
+        self.set_uniform(self.gravity_shader, "KICK", -0.5)
+        self.set_uniform(self.gravity_shader, "DRIFT", 0.0)
 
-            pg.display.flip()
+        with self.timer.disabled():
+            self.gravity_step()
+
+        self.set_uniform(self.gravity_shader, "KICK", 1.0)
+        self.set_uniform(self.gravity_shader, "DRIFT", 1.0)
+
+    def gravity_step(self):
+        # bodies ssbo_in => ssbo_out, swapped
+        if self.gravity == "barnes_hut":
+            with self.timer.cpu("octree"):
+                self.bodies.build_octree()
+
+            self.set_uniform(self.gravity_shader, "NB_NODE", self.bodies.nb_node)
+            self.bodies.tree_nodes.bind_to_storage_buffer(2)
+            self.bodies.tree_bodies.bind_to_storage_buffer(3)
+
+        self.set_uniform(self.gravity_shader, "delta_time", self.sim_dt)
+
+        # CS: layout(std430, binding = 0) buffer bodies_in, layout(std430, binding = 1) buffer bodies_out
+        self.bodies.ssbo_in.bind_to_storage_buffer(0)
+        self.bodies.ssbo_out.bind_to_storage_buffer(1)
+
+        group_x, group_y = self.get_body_groups()
+        with self.timer.gpu("gravity"):
+            self.gravity_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+            self.ctx.memory_barrier()
+
+        self.bodies.swap()
+
+    def step(self):
+        # one simulation step of sim_dt ms: bodies moved by the gravity pass, texture faded and bodies drawn
+        self.gravity_step()
+
+        self.set_uniform(self.compute_shader, "time", self.sim_time)
+        self.set_uniform(self.compute_shader, "delta_time", self.sim_dt)
+
+        # CS: layout(std430, binding = 0) buffer bodies_in
+        self.bodies.ssbo_in.bind_to_storage_buffer(0)
+
+        # CS: layout(rgba8, binding = 0) uniform image2D out_texture;
+        self.texture.bind_to_image(0, read=False, write=True) # glBindImageTexture(0, texHandle, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_R32F);
+
+        group_x, group_y = self.get_pixel_groups()
+        with self.timer.gpu("compute"):
+            self.compute_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+            #self.compute_shader.run(group_x= self.screen_width, group_y= self.screen_height, group_z=1)
+            self.ctx.memory_barrier()
+
+        self.sim_steps += 1
+        self.sim_time += self.sim_dt * 0.001
+
+    def end_frame(self):
+        # --fast_forward: frame rate not capped
+        frame_time = self.clock.tick(-1 if self.fast_forward else self.max_fps)
+        if not self.pause:
+            self.sim_accumulator += frame_time
+
+        if self.sync:
+            self.ctx.finish()
+
+        self.timer.end_frame()
+
+        self.get_fps()
+        self.num_frames += 1
+
+    def frames(self, count=-1):
+        """Render `count` frames (-1 for unlimited) and yield each one as a (height, width, 4) uint8 RGBA array.
+
+        The array is a top-down view of a single buffer reused for every frame: copy it to keep a frame.
+        """
+        frame = np.empty((self.screen_height, self.screen_width, 4), dtype=np.uint8)
+
+        nb_frames = 0
+        while count < 0 or nb_frames < count:
+            nb_frames += 1
+
+            self.render_frame()
+            self.fbo.read_into(frame, components=4)
+            self.end_frame()
+
+            yield frame[::-1]
+
+    def run(self):
+
+        start_time = time.perf_counter()
+
+        while self.max_frames < 0 or self.num_frames < self.max_frames:
+
+            if not self.headless:
+                self.check_events()
+
+            self.render_frame()
+
+            if not self.headless:
+                with self.timer.cpu("flip"):
+                    pg.display.flip()
 
             # record video
             if self.record_video:
-                pg_surface = pygame.image.fromstring(self.texture.read(), (self.texture.width, self.texture.height), 'RGBA', True)
-                self.video_recorder.capture_frame(pg_surface)
+                with self.timer.cpu("readback"):
+                    data = self.readback.read(self.texture)
+                    if data is not None:
+                        self.capture_frame(data)
+
+            self.end_frame()
 
-            self.delta_time = self.clock.tick(self.max_fps)
+        self.ctx.finish()
+        self.timer.flush()
+        elapsed = time.perf_counter() - start_time
+        print(f"Rendered {self.num_frames} frames in {elapsed:.3f}s ({self.num_frames / elapsed:.1f} FPS)")
+        print(f"Simulated {self.sim_steps} steps of {self.sim_dt:.3f} ms in {elapsed:.3f}s ({self.sim_steps / elapsed:.1f} steps/s, {self.sim_time:.1f}s of simulation)")
+        print(f"Pass timings: {self.timer.get_summary()}")
 
-            self.get_fps()
-            self.num_frames += 1
+        self.quit()
 
 # -----------------------------------------------------------------------------------------------------------
 # python3 main.py --fps=-1
 # python3 main.py --fps=60 -rv="h264" -vfps=60
+# python3 main.py --headless --frames=1000 --size=1920x1080
+# python3 main.py --seed=42 --gpu_init
+# python3 main.py --body=16384
+# python3 main.py --body=200000 --gravity=barnes_hut
+# python3 main.py --substeps=4
+# python3 main.py --fast_forward=100 --frames=100
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
 
 def main():
 
     parser = argparse.ArgumentParser(description="")
 
     parser.add_argument('-f', '--fps', help='Max FPS, -1 for unlimited', default=-1, type=int)
+    parser.add_argument('-b', '--body', help='NB Body', default=32, type=int)
+    parser.add_argument('--gravity', help='Gravity between the bodies: direct O(N^2) sum or Barnes-Hut octree', default="direct", choices=("direct", "barnes_hut"))
+    parser.add_argument('-s', '--seed', help='Seed of the bodies initialization, random if not set', default=None, type=int)
+    parser.add_argument('--gpu_init', help='Initialize the bodies on the GPU with a compute shader', action='store_true')
+    parser.add_argument('--sim_dt', help='Fixed simulation step (ms)', default=SIM_DT, type=float)
+    parser.add_argument('--substeps', help='Simulation steps per displayed frame, 0: steps of the real time elapsed', default=0, type=int)
+    parser.add_argument('--fast_forward', help='Display every Nth simulation step only, frame rate not capped', default=0, type=int)
     parser.add_argument('-rv', '--record_video', help='', default="", type=str)
     parser.add_argument('-vfps', '--video_fps', help='', default=60, type=int)
+    parser.add_argument('-rb', '--readback_buffers', help='Number of PBOs for video readback, 1 for synchronous read', default=3, type=int)
+    parser.add_argument('--headless', help='Render offscreen without window (EGL context)', action='store_true')
+    parser.add_argument('--frames', help='Number of frames to render, -1 for unlimited', default=-1, type=int)
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('-g', '--group_size', help='Local work group size XxY of the compute shaders (default: autotuned or config)', default=None, type=parse_size)
+    parser.add_argument('--autotune', help='Time candidate local sizes on this device and keep the fastest one', action='store_true')
+    parser.add_argument('--hot_reload', help='Recompile the shaders when their source files change', action='store_true')
+    parser.add_argument('--timings', help='Save the per-frame pass timings to a .csv or .json file', default="", type=str)
+    parser.add_argument('--sync', help='Wait for the GPU at the end of each frame (per-frame times of benchmarks)', action='store_true')
 
     result = parser.parse_args()
     args = dict(result._get_kwargs())
 
     print("Args = %s" % args)
 
-    app = App(screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, fps=args["fps"], record_video=args["record_video"], video_fps=args["video_fps"])
+    screen_width, screen_height = args["size"]
+
+    app = App(screen_width=screen_width, screen_height=screen_height, fps=args["fps"], record_video=args["record_video"], video_fps=args["video_fps"],
+              readback_buffers=args["readback_buffers"], headless=args["headless"], frames=args["frames"], hot_reload=args["hot_reload"], timings=args["timings"], group_size=args["group_size"], autotune=args["autotune"], sync=args["sync"], seed=args["seed"], gpu_init=args["gpu_init"],
+              sim_dt=args["sim_dt"], substeps=args["substeps"], fast_forward=args["fast_forward"], nb_body=args["body"], gravity=args["gravity"])
     app.run()
 
 if __name__ == "__main__":
@@ -1,25 +1,197 @@
+import os, time, queue, hashlib, threading
+
+from config import XGROUPSIZE, YGROUPSIZE, ZGROUPSIZE, SHADER_CACHE_DIR, SHADER_WATCH_INTERVAL
+
+# -----------------------------------------------------------------------------------------------------------
+
+def setup_shader_cache(cache_dir=SHADER_CACHE_DIR):
+    # Must be called before the OpenGL context creation.
+    # moderngl cannot create a program from a binary (no glProgramBinary), so the binaries are persisted by the
+    # driver's own disk cache, which checks them against its build / GPU and recompiles the ones it rejects.
+    if not cache_dir:
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    os.environ.setdefault("MESA_SHADER_CACHE_DIR", cache_dir)        # Mesa
+    os.environ.setdefault("MESA_GLSL_CACHE_DIR", cache_dir)          # Mesa < 21
+    os.environ.setdefault("__GL_SHADER_DISK_CACHE", "1")             # NVIDIA
+    os.environ.setdefault("__GL_SHADER_DISK_CACHE_PATH", cache_dir)
+
+# -----------------------------------------------------------------------------------------------------------
+
+class ShaderWatcher(threading.Thread):
+    # Polls the shader sources and reads / preprocesses the changed programs off the GL thread,
+    # the compilation itself is left to ShaderProgram.reload() (the GL context is current on the main thread only)
+
+    def __init__(self, shader_program, interval=SHADER_WATCH_INTERVAL):
+        super().__init__(daemon=True)
+        self.shader_program = shader_program
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.specs = {}     # spec => source paths
+        self.mtimes = {}    # path => last seen modification time
+        self.pending = queue.Queue()
+        self.running = True
+
+    def watch(self, spec):
+        paths = self.shader_program.get_paths(spec)
+        with self.lock:
+            self.specs[spec] = paths
+            for path in paths:
+                self.mtimes[path] = os.stat(path).st_mtime_ns
+
+    def unwatch(self, spec):
+        with self.lock:
+            self.specs.pop(spec, None)
+            paths = {path for paths in self.specs.values() for path in paths}
+            self.mtimes = {path: mtime for path, mtime in self.mtimes.items() if path in paths}
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+
+            changed = set()
+            with self.lock:
+                specs = list(self.specs.items())
+
+                for path, last_mtime in self.mtimes.items():
+                    try:
+                        mtime = os.stat(path).st_mtime_ns
+                    except OSError:  # file being saved
+                        continue
+
+                    if mtime != last_mtime:
+                        self.mtimes[path] = mtime
+                        changed.add(path)
+
+            for spec, paths in specs:
+                if changed.intersection(paths):
+                    try:
+                        self.pending.put((spec, self.shader_program.read_sources(spec)))
+                    except OSError as e:
+                        print("Failed to read %s : %s" % (spec[1], repr(e)))
+
+    def stop(self):
+        self.running = False
+
+# -----------------------------------------------------------------------------------------------------------
+
 class ShaderProgram:
 
-    def __init__(self, ctx):
+    def __init__(self, ctx, watch=False, group_size=(XGROUPSIZE, YGROUPSIZE, ZGROUPSIZE)):
         self.ctx = ctx
+        self.group_size = group_size
+        self.driver = (ctx.info["GL_VENDOR"], ctx.info["GL_RENDERER"], ctx.info["GL_VERSION"])
+        self.cache = {}     # source hash => program
+        self.current = {}   # spec (kind, name, values) => source hash of the program in use
+
+        self.watcher = None
+        if watch:
+            self.watcher = ShaderWatcher(self)
+            self.watcher.start()
+
         self.programs = {}
         self.programs['quad']   = self.get_program('quad')
 
-    def get_program(self, shader_name):
-        try:
-            with open(f'shaders/{shader_name}_vs.glsl') as file:
-                vertex_shader = file.read()
+    def get_key(self, *sources):
+        # post-substitution sources + driver, a program is compiled once per process
+        return hashlib.sha256("\0".join(self.driver + sources).encode()).hexdigest()
+
+    def get_paths(self, spec):
+        kind, shader_name, values = spec
+        if kind == "compute":
+            return (f'shaders/{shader_name}_cs.glsl',)
+        return (f'shaders/{shader_name}_vs.glsl', f'shaders/{shader_name}_fs.glsl')
+
+    def read_sources(self, spec):
+        sources = []
+        for path in self.get_paths(spec):
+            with open(path) as file:
+                source = file.read()
+
+            # NAME_VAL placeholders of the source are replaced by values
+            for name, value in spec[2]:
+                source = source.replace(f"{name}_VAL", str(value))
+
+            sources.append(source)
+
+        return tuple(sources)
 
-            with open(f'shaders/{shader_name}_fs.glsl') as file:
-                fragment_shader = file.read()
+    def build(self, spec, sources):
+        key = self.get_key(*sources)
+        if key not in self.cache:
+            if spec[0] == "compute":
+                self.cache[key] = self.ctx.compute_shader(sources[0])
+            else:
+                self.cache[key] = self.ctx.program(vertex_shader=sources[0], fragment_shader=sources[1])
 
-            program = self.ctx.program(vertex_shader=vertex_shader, fragment_shader=fragment_shader)
-            return program
+        # the program replaced by a reload is released, unless another spec still uses it
+        old_key = self.current.get(spec)
+        self.current[spec] = key
+        if old_key not in (None, key) and old_key not in self.current.values():
+            self.cache.pop(old_key).release()
+
+        return self.cache[key]
+
+    def load(self, spec):
+        if spec not in self.current:
+            self.build(spec, self.read_sources(spec))
+            if self.watcher:
+                self.watcher.watch(spec)
+
+        return self.cache[self.current[spec]]
+
+    def get_program(self, shader_name):
+        try:
+            return self.load(("program", shader_name, ()))
         except Exception as e:
             print("Failed to load %s : %s" % (shader_name, repr(e)))
             return None
 
+    def get_compute_program(self, shader_name, **values):
+        # local group sizes by default
+        values = {"XGROUPSIZE": self.group_size[0], "YGROUPSIZE": self.group_size[1], "ZGROUPSIZE": self.group_size[2], **values}
+        return self.load(("compute", shader_name, tuple(values.items())))
+
+    def prune(self):
+        # drops the compute programs of other local sizes than group_size (--autotune candidates): released and
+        # no longer watched
+        group_size = {"XGROUPSIZE": self.group_size[0], "YGROUPSIZE": self.group_size[1], "ZGROUPSIZE": self.group_size[2]}
+
+        for spec in list(self.current):
+            values = dict(spec[2])
+            if spec[0] != "compute" or all(values.get(name) == value for name, value in group_size.items()):
+                continue
+
+            key = self.current.pop(spec)
+            if key not in self.current.values():
+                self.cache.pop(key).release()
+            if self.watcher:
+                self.watcher.unwatch(spec)
+
+    def reload(self):
+        # At a frame boundary: compiles the changed programs, True if at least one was swapped in.
+        # On a compile error the previous program stays in use.
+        reloaded = False
+
+        while self.watcher and not self.watcher.pending.empty():
+            spec, sources = self.watcher.pending.get()
+            if spec not in self.current:    # pruned
+                continue
+
+            try:
+                self.build(spec, sources)
+                print("Reloaded %s" % spec[1])
+                reloaded = True
+            except Exception as e:
+                print("Failed to reload %s : %s" % (spec[1], e))
+
+        return reloaded
+
     def destroy(self):
-        for program in self.programs.values():
-            if program:
-                program.release()
\ No newline at end of file
+        if self.watcher:
+            self.watcher.stop()
+
+        for program in self.cache.values():
+            program.release()
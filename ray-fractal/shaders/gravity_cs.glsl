@@ -0,0 +1,168 @@
+#version 430 core
+
+// Gravity between the bodies, leapfrog integration: bodies_in => bodies_out (ping-pong), velocities at half steps
+// 0: direct sum, O(N^2): each work group stages blocks of XGROUPSIZE * YGROUPSIZE bodies in shared memory
+// 1: Barnes-Hut, the octree of barnes_hut.py is traversed with its skip pointers (no stack)
+#define BARNES_HUT  BARNES_HUT_VAL
+
+#define XGROUPSIZE  XGROUPSIZE_VAL
+#define YGROUPSIZE  YGROUPSIZE_VAL
+#define ZGROUPSIZE  ZGROUPSIZE_VAL
+
+#define TILE        (XGROUPSIZE * YGROUPSIZE * ZGROUPSIZE)
+
+layout(local_size_x=XGROUPSIZE, local_size_y=YGROUPSIZE, local_size_z=ZGROUPSIZE) in;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+uniform int   NB_BODY;
+
+uniform float delta_time;       // ms, fixed simulation step
+
+uniform float GRAVITY;          // G
+uniform float SOFTENING;        // Plummer softening length
+uniform float TIME_SCALE;       // simulation time units per ms
+
+uniform float KICK;             // fractions of dt of the velocity kick and of the drift: 1, 1 for a step,
+uniform float DRIFT;            // -0.5, 0 once at the start (initial velocities v(0) => v(-dt/2))
+
+#if BARNES_HUT
+uniform int   NB_NODE;
+uniform float THETA;            // opening angle: a cell is accepted when size < THETA * distance
+#endif
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+struct Body
+{
+    vec4 pos;  // x, y, z, mass
+    vec4 vel;  // x, y, z, nop
+};
+
+layout(std430, binding = 0) buffer bodies_in
+{
+    Body bodies[];
+} buf_in;
+
+layout(std430, binding = 1) buffer bodies_out
+{
+    Body bodies[];
+} buf_out;
+
+#if BARNES_HUT
+
+struct Node
+{
+    vec4  com;    // center of mass, mass
+    float size;   // side of the cell
+    int   skip;   // next node once the subtree is accepted or done
+    int   start;  // bodies [start, end[ of tree_bodies
+    int   end;
+};
+
+layout(std430, binding = 2) buffer tree_nodes
+{
+    Node nodes[];
+};
+
+// positions / masses of the bodies in the order of the tree
+layout(std430, binding = 3) buffer tree_bodies
+{
+    vec4 sorted_pos[];
+};
+
+#else
+
+shared vec4 tile_pos[TILE];
+
+#endif
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+vec3 get_acceleration(vec3 pos, vec4 other)
+{
+    // softened attraction of a point mass (zero for the body itself)
+    vec3 r = other.xyz - pos;
+    float inv_dist = inversesqrt(dot(r, r) + SOFTENING * SOFTENING);
+
+    return other.w * inv_dist * inv_dist * inv_dist * r;
+}
+
+#if BARNES_HUT
+
+vec3 get_tree_acceleration(vec3 pos)
+{
+    vec3 acc = vec3(0.0);
+
+    int i = 0;
+    while (i < NB_NODE) {
+        Node node = nodes[i];
+
+        // leaf: its bodies one by one
+        if (node.skip == i + 1) {
+            for (int j = node.start; j < node.end; j++) {
+                acc += get_acceleration(pos, sorted_pos[j]);
+            }
+            i = node.skip;
+            continue;
+        }
+
+        // far enough: the cell as a point mass, else its children
+        vec3 r = node.com.xyz - pos;
+        if (node.size * node.size < THETA * THETA * dot(r, r)) {
+            acc += get_acceleration(pos, node.com);
+            i = node.skip;
+        }
+        else {
+            i++;
+        }
+    }
+
+    return acc;
+}
+
+#endif
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+void main()
+{
+    // 1 invocation per body, the invocations past NB_BODY only help loading the tiles
+    uvec3 nb_particles = gl_NumWorkGroups * gl_WorkGroupSize;
+    int id = int(gl_GlobalInvocationID.y * nb_particles.x + gl_GlobalInvocationID.x);
+
+    bool is_body = id < NB_BODY;
+    vec4 pos = is_body ? buf_in.bodies[id].pos : vec4(0.0);
+
+#if BARNES_HUT
+    if (!is_body) {
+        return;
+    }
+
+    vec3 acc = get_tree_acceleration(pos.xyz);
+#else
+    vec3 acc = vec3(0.0);
+
+    for (int tile_start = 0; tile_start < NB_BODY; tile_start += TILE) {
+        int j = tile_start + int(gl_LocalInvocationIndex);
+        tile_pos[gl_LocalInvocationIndex] = j < NB_BODY ? buf_in.bodies[j].pos : vec4(0.0);    // padding: mass 0
+        barrier();
+
+        for (int k = 0; k < TILE; k++) {
+            acc += get_acceleration(pos.xyz, tile_pos[k]);
+        }
+        barrier();
+    }
+
+    if (!is_body) {
+        return;
+    }
+#endif
+
+    // leapfrog: v(t + dt/2) = v(t - dt/2) + a(t) dt, x(t + dt) = x(t) + v(t + dt/2) dt
+    float dt = delta_time * TIME_SCALE;
+    vec3 vel = buf_in.bodies[id].vel.xyz + KICK * GRAVITY * acc * dt;
+
+    buf_out.bodies[id].pos = vec4(pos.xyz + DRIFT * vel * dt, pos.w);
+    buf_out.bodies[id].vel = vec4(vel, 0.0);
+}
@@ -13,15 +13,17 @@ layout(rgba32f, binding = 0) uniform image2D out_texture;
 
 uniform int   SCREEN_WIDTH;
 uniform int   SCREEN_HEIGHT;
+uniform int   NB_BODY;
 
 uniform float time;
-uniform int   delta_time;
+uniform float delta_time;       // ms, fixed simulation step
 
 // ---------------------------------------------------------------------------------------------------------------------
 
 struct Body
 {
-    vec4 pos;  // x, y, z, w
+    vec4 pos;  // x, y, z, mass
+    vec4 vel;  // x, y, z, nop
 };
 
 layout(std430, binding = 0) buffer bodies_in
@@ -37,22 +39,6 @@ ivec2 to_tex_coord(float posx, float posy) {
 
 // ---------------------------------------------------------------------------------------------------------------------
 
-void clamp_pos(int id)
-{
-    if(buf.bodies[id].pos.x > 1.0) {
-        buf.bodies[id].pos.x = -1.0;
-    }
-    else if (buf.bodies[id].pos.x < -1.0) {
-        buf.bodies[id].pos.x = 1.0;
-    }
-    if(buf.bodies[id].pos.y > 1.0) {
-        buf.bodies[id].pos.y = -1.0;
-    }
-    else if (buf.bodies[id].pos.y < -1.0) {
-        buf.bodies[id].pos.y = 1.0;
-    }
-}
-
 void fade(ivec2 tex_coord, float fade_rate)
 {
     vec3 col = imageLoad(out_texture, tex_coord).rgb;
@@ -80,17 +66,21 @@ void main()
     //vec3 pixel = vec3(1.0, 0.0, 0.0);
     //imageStore(out_texture, pixel_coords, vec4(pixel,1.0));
 
-    float SPEED_RATE = 0.0001;
     float FADE_RATE = 0.001;
 
-    buf.bodies[id].pos.x += delta_time * SPEED_RATE;
-    buf.bodies[id].pos.y += delta_time * SPEED_RATE;
+    // 1 invocation per pixel (ceil-divided dispatch, rows added past the screen when there are more bodies than
+    // pixels), the first NB_BODY ones also draw a body (moved by the gravity pass, off screen ones are not stored)
+    bool is_body  = id < NB_BODY;
+    bool is_pixel = gl_GlobalInvocationID.x < SCREEN_WIDTH && gl_GlobalInvocationID.y < SCREEN_HEIGHT;
 
-    clamp_pos(id);
+    if (is_pixel) {
+        fade(ivec2(gl_GlobalInvocationID.xy), FADE_RATE);
+    }
 
-    fade(ivec2(gl_GlobalInvocationID.xy), FADE_RATE);
-    vec4 color = vec4(1.0);    
-    imageStore(out_texture, to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), color);
+    if (is_body) {
+        vec4 color = vec4(1.0);
+        imageStore(out_texture, to_tex_coord(buf.bodies[id].pos.x, buf.bodies[id].pos.y), color);
+    }
 
     //memoryBarrierImage();
     //memoryBarrier();
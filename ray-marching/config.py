@@ -1,4 +1,4 @@
-import time, collections
+import os, csv, json, time, math, contextlib, collections
 
 # ----------------------------------------------------------------------------------------------------------------------
 
@@ -7,9 +7,45 @@ SCREEN_HEIGHT = 800
 FONT_SIZE     = 32
 MAX_FPS       = 0
 
+HEADLESS_BACKEND = "egl"
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ray-python")
+
+# driver shader binary cache (empty: driver default)
+SHADER_CACHE_DIR = os.path.join(CACHE_DIR, "shaders")
+
+# shader hot reload: seconds between two polls of the sources
+SHADER_WATCH_INTERVAL = 0.25
+
 MODEL = "ray"
 #MODEL = "terrain"
 
+# dynamic resolution: the MODEL is rendered offscreen at a fraction of the window size then upscaled
+TARGET_FPS       = 60
+RENDER_SCALE_MIN = 0.25
+RENDER_SCALE_MAX = 1.0
+
+# cone-marching prepass: one start depth per PREPASS_TILE x PREPASS_TILE pixels
+PREPASS_TILE = 8
+
+# scene graphs compiled to sceneSDF (sdf_scene.py): generated sources cache, at most SDF_GROUP_SIZE children per
+# bounding sphere, subtrees farther than SDF_CULL_MARGIN returning the distance to their bounding sphere
+SDF_CACHE_DIR   = os.path.join(CACHE_DIR, "sdf")
+SDF_GROUP_SIZE  = 4
+SDF_CULL_MARGIN = 0.5
+SDF_PRIMITIVES  = 200
+
+# baked terrain (terrain.py): heights of the terrain_fs function on TERRAIN_RES x TERRAIN_RES texels covering
+# TERRAIN_SIZE x TERRAIN_SIZE world units around the origin, marched in steps of TERRAIN_STEP x the height above it
+# (1.0 as the analytic march, lower: fewer ridges stepped over, more steps)
+TERRAIN_CACHE_DIR = os.path.join(CACHE_DIR, "terrain")
+TERRAIN_SIZE      = 4096.0
+TERRAIN_RES       = 4096
+TERRAIN_STEP      = 1.0
+
+# CPU renderer (cpu_render.py) of the ray model: tiles of CPU_TILE x CPU_TILE pixels shared by the processes
+CPU_TILE = 64
+
 # ----------------------------------------------------------------------------------------------------------------------
 
 class FPSCounter:
@@ -29,3 +65,139 @@ class FPSCounter:
             return 0
         else:
             return len(self.frame_times) / sum(self.frame_times)
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+# -----------------------------------------------------------------------------------------------------------
+
+class PassTimer:
+    """Per-pass timings of a frame, without stalling the pipeline.
+
+    gpu(name) wraps the GL commands of a pass in a GL_TIME_ELAPSED query, cpu(name) measures the wall time
+    of a CPU side step (display.flip, video readback...) and end_frame() the wall time of the whole frame
+    ("frame_ms", from the previous end_frame()). A query is read `latency` frames after its frame
+    was submitted, when the GPU is done with it: each pass has a ring of latency+1 queries.
+
+    The timings (ms) of the last `history` resolved frames are averaged by get_summary(), all the resolved
+    frames are kept in records when keep_records is set, for dump().
+    """
+    NO_RESULT = 0xFFFFFFFF
+
+    def __init__(self, ctx, latency=3, history=60, keep_records=False):
+        self.ctx = ctx
+        self.latency = latency
+        self.queries = {}
+        self.frame = 0
+        self.frame_start = time.perf_counter()
+        self.gpu_queries = {}
+        self.cpu_times = {}
+        self.pending = collections.deque()
+        self.history = collections.deque(maxlen=history)
+        self.keep_records = keep_records
+        self.records = []
+
+    @contextlib.contextmanager
+    def gpu(self, name):
+        if name not in self.queries:
+            self.queries[name] = [self.ctx.query(time=True) for _ in range(self.latency + 1)]
+
+        query = self.queries[name][self.frame % (self.latency + 1)]
+        with query:
+            yield
+        self.gpu_queries[name] = query
+
+    @contextlib.contextmanager
+    def cpu(self, name):
+        t0 = time.perf_counter()
+        yield
+        self.cpu_times[name] = 1000 * (time.perf_counter() - t0)
+
+    def end_frame(self):
+        t1 = time.perf_counter()
+        self.cpu_times["frame_ms"] = 1000 * (t1 - self.frame_start)
+        self.frame_start = t1
+
+        self.pending.append((self.frame, self.gpu_queries, self.cpu_times))
+        self.gpu_queries = {}
+        self.cpu_times = {}
+        self.frame += 1
+
+        while len(self.pending) > self.latency:
+            self.resolve()
+
+    def resolve(self):
+        frame, gpu_queries, cpu_times = self.pending.popleft()
+
+        # a query without result reads 2^32 - 1 ns (llvmpipe, first use of a ring): its pass is left out of the frame
+        timings = {name: query.elapsed / 1e6 for name, query in gpu_queries.items() if query.elapsed < self.NO_RESULT}
+        timings.update(cpu_times)
+
+        self.history.append(timings)
+        if self.keep_records:
+            self.records.append({"frame": frame, **timings})
+
+    def flush(self):
+        while self.pending:
+            self.resolve()
+
+    def get_summary(self):
+        # mean ms per pass, "name ms | name ms ..."
+        names = list(dict.fromkeys(name for timings in self.history for name in timings))
+        if not names:
+            return "n/a"
+
+        means = [(name, [timings[name] for timings in self.history if name in timings]) for name in names]
+        return " | ".join(f"{name} {sum(values) / len(values):.2f}" for name, values in means) + " ms"
+
+    def dump(self, path):
+        # per-frame timings, .json (list of records) or .csv
+        if path.endswith(".json"):
+            with open(path, "w") as file:
+                json.dump(self.records, file, indent=1)
+        else:
+            names = list(dict.fromkeys(name for record in self.records for name in record))
+            with open(path, "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=names)
+                writer.writeheader()
+                writer.writerows(self.records)
+
+        print(f"Pass timings of {len(self.records)} frames saved to {path}")
+
+# -----------------------------------------------------------------------------------------------------------
+
+class RenderScaleGovernor:
+    """Render scale (fraction of the window width / height) adjusted each frame toward a target frame time.
+
+    The time of a frame is about proportional to its number of pixels: update() divides it by the square
+    of the scale it was rendered at, smooths that full resolution cost and moves the scale a fraction `gain`
+    of the way to sqrt(target / cost). Nothing changes while the frame time is within `tolerance` of the
+    target, so the scale settles instead of oscillating around it.
+    """
+    def __init__(self, target_ms, scale=1.0, min_scale=RENDER_SCALE_MIN, max_scale=RENDER_SCALE_MAX, gain=0.25, smoothing=0.1, tolerance=0.1):
+        self.target_ms = target_ms
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.gain = gain
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+
+        self.scale = min(max(scale, min_scale), max_scale)
+        self.cost = None
+        self.last_time = time.perf_counter()
+
+    def update(self):
+        # end of a frame rendered at self.scale, returns the scale of the next one
+        t1 = time.perf_counter()
+        frame_ms = 1000 * (t1 - self.last_time)
+        self.last_time = t1
+
+        cost = frame_ms / (self.scale * self.scale)
+        self.cost = cost if self.cost is None else self.cost + self.smoothing * (cost - self.cost)
+
+        if abs(self.cost * self.scale * self.scale / self.target_ms - 1.0) > self.tolerance:
+            ideal = math.sqrt(self.target_ms / self.cost)
+            self.scale = min(max(self.scale + self.gain * (ideal - self.scale), self.min_scale), self.max_scale)
+
+        return self.scale
@@ -0,0 +1,271 @@
+import os, time, math, argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from config import *
+from sdf_scene import SCENES, get_basic_scene
+
+# -----------------------------------------------------------------------------------------------------------
+# CPU renderer of the ray model (ray_fs.glsl, without OpenGL): the frame is split in tiles of CPU_TILE x CPU_TILE
+# pixels rendered by a pool of processes into a shared memory framebuffer. The rays of a tile are sphere traced as
+# NumPy batches (the rays still marching at each step), the sceneSDF evaluated by Node.get_distance() of the scene
+# graph: get_basic_scene() for the hand-written sceneSDF, else the --scene.
+#
+# float32 arithmetic as the shader, the pixels differ from the GPU ones where the order of the float operations
+# decides a hit or a shadow (silhouettes, shadow edges).
+
+MAX_MARCHING_STEPS = 256
+MIN_DIST   = np.float32(0.0)
+MAX_DIST   = np.float32(96.0)
+EPSILON    = np.float32(0.001)
+CAMERA_POS = np.array([0.0, 2.0, -3.0], dtype=np.float32)
+LIGHT_POS  = np.array([0.0, 5.0, 2.0], dtype=np.float32)
+
+MATERIAL = np.array([0.4, 0.6, 1.0], dtype=np.float32)
+
+def quantize(colors):
+    # float => rgba8 texel (UNORM: clamped to [0, 1], rounded to the nearest of the 256 levels)
+    return np.rint(np.clip(colors, 0.0, 1.0) * np.float32(255.0)).astype(np.uint8)
+
+def dot(a, b):
+    return (a * b).sum(axis=-1)
+
+def normalize(v):
+    return v / np.sqrt(dot(v, v))[..., None]
+
+def get_camera(mouse, resolution):
+    # get_camera() of the shader: eye, fwd, side, up
+    eye = CAMERA_POS.copy()
+    m = np.asarray(mouse, dtype=np.float32) / np.asarray(resolution, dtype=np.float32)
+
+    # mouseControl(): pR(ro.yz, m.y * PI * 0.4 - 0.4), pR(ro.xz, m.x * TAU)
+    for (i, j), a in (((1, 2), m[1] * np.float32(math.pi * 0.4) - np.float32(0.4)), ((0, 2), m[0] * np.float32(2.0 * math.pi))):
+        c, s = np.cos(a, dtype=np.float32), np.sin(a, dtype=np.float32)
+        eye[i], eye[j] = c * eye[i] + s * eye[j], c * eye[j] - s * eye[i]
+
+    fwd = normalize(-eye)
+    side = normalize(np.cross(np.array([0.0, 1.0, 0.0], dtype=np.float32), fwd))
+    up = np.cross(fwd, side)
+
+    return eye, fwd, side, up
+
+class TileRenderer:
+    """Scene graph and camera of the frame, sphere traces the rays of a tile (a worker of CPURenderer per process).
+
+    scene_graph: normals of the generated sceneSDF (tetrahedron) instead of the ones of the hand-written one (central
+    differences).
+    """
+
+    def __init__(self, scene, screen_width, screen_height, scene_graph=False, culling=True, mouse=(0, 0)):
+        self.scene = scene
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.scene_graph = scene_graph
+        self.culling = culling
+
+        self.eye, self.fwd, self.side, self.up = get_camera(mouse, (screen_width, screen_height))
+
+    def scene_sdf(self, p):
+        return self.scene.get_distance(p, self.culling)
+
+    def march(self, eye, rd, start, end):
+        # shortest_distance_to_surface() of the (n, 3) rays: the rays are dropped once they hit or pass end
+        depth = np.full(len(rd), start, dtype=np.float32)
+        result = np.full(len(rd), end, dtype=np.float32)
+        active = np.arange(len(rd))
+
+        for _ in range(MAX_MARCHING_STEPS):
+            if len(active) == 0:
+                break
+
+            dist = self.scene_sdf(eye[active] + depth[active, None] * rd[active])
+
+            hit = dist < EPSILON
+            result[active[hit]] = depth[active[hit]]
+
+            depth[active] += np.where(hit, np.float32(0.0), dist)
+            active = active[~hit & (depth[active] < end)]
+
+        return result
+
+    def get_normal(self, p):
+        if self.scene_graph:
+            n = np.zeros_like(p)
+            for i in range(4):
+                e = np.float32(2.0) * np.array([((i + 3) >> 1) & 1, (i >> 1) & 1, i & 1], dtype=np.float32) - np.float32(1.0)
+                n += e * self.scene_sdf(p + e * EPSILON)[:, None]
+            return normalize(n)
+
+        n = np.empty_like(p)
+        for axis in range(3):
+            e = np.zeros(3, dtype=np.float32)
+            e[axis] = EPSILON
+            n[:, axis] = self.scene_sdf(p + e) - self.scene_sdf(p - e)
+        return normalize(n)
+
+    def get_light(self, p, rd, color):
+        L = normalize(LIGHT_POS - p)
+        N = self.get_normal(p)
+        V = -rd
+        R = -L - np.float32(2.0) * dot(N, -L)[:, None] * N
+
+        specular = np.float32(0.5) * np.clip(dot(R, V), 0.0, 1.0)[:, None] ** np.float32(10.0)
+        diffuse = color * np.clip(dot(L, N), 0.0, 1.0)[:, None]
+        ambient = color * np.float32(0.05)
+        fresnel = np.float32(0.25) * color * np.maximum(np.float32(1.0) + dot(rd, N), 0.0)[:, None] ** np.float32(3.0)
+
+        # shadows
+        d = self.march(p + N * np.float32(0.02), np.broadcast_to(normalize(LIGHT_POS), p.shape), MIN_DIST, MAX_DIST)
+        shadow = d < np.sqrt(dot(LIGHT_POS - p, LIGHT_POS - p))
+
+        return np.where(shadow[:, None], ambient + fresnel, diffuse + ambient + specular + fresnel)
+
+    def render(self, x0, y0, x1, y1):
+        """(y1 - y0, x1 - x0, 4) uint8 RGBA pixels of the tile, bottom row first (pixel centers of gl_FragCoord)."""
+        px, py = np.meshgrid(np.arange(x0, x1, dtype=np.float32) + np.float32(0.5), np.arange(y0, y1, dtype=np.float32) + np.float32(0.5))
+        height = np.float32(self.screen_height)
+
+        uv_x = (px.ravel() * np.float32(2.0) - np.float32(self.screen_width)) / height
+        uv_y = (py.ravel() * np.float32(2.0) - height) / height
+
+        screen_pos = self.eye + (self.fwd + self.side * uv_x[:, None] + self.up * uv_y[:, None])
+        rd = normalize(screen_pos - self.eye)
+        eye = np.broadcast_to(self.eye, rd.shape)
+
+        dist = self.march(eye, rd, MIN_DIST, MAX_DIST)
+
+        colors = np.zeros_like(rd)
+        is_hit = dist < MAX_DIST
+        if is_hit.any():
+            pos = eye[is_hit] + dist[is_hit, None] * rd[is_hit]
+            colors[is_hit] = MATERIAL + self.get_light(pos, rd[is_hit], MATERIAL)
+
+        pixels = np.empty((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        pixels[..., :3] = quantize(colors).reshape(y1 - y0, x1 - x0, 3)
+        pixels[..., 3] = 255
+        return pixels
+
+# -----------------------------------------------------------------------------------------------------------
+
+# process state of the pool workers
+worker = {}
+
+def init_worker(shm_name, shape, renderer):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    worker["shm"] = shm
+    worker["frame"] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    worker["renderer"] = renderer
+
+def render_tile(tile):
+    x0, y0, x1, y1 = tile
+    worker["frame"][y0:y1, x0:x1] = worker["renderer"].render(x0, y0, x1, y1)
+
+class CPURenderer:
+    """Frame of a TileRenderer rendered by a pool of processes (one tile at a time each) into shared memory."""
+
+    def __init__(self, renderer, processes=None, tile_size=CPU_TILE):
+        width, height = renderer.screen_width, renderer.screen_height
+        self.shape = (height, width, 4)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=height * width * 4)
+        self.frame = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        # the scene is handed over once per process (inherited when forked)
+        self.processes = processes or os.cpu_count()
+        self.pool = mp.Pool(self.processes, initializer=init_worker, initargs=(self.shm.name, self.shape, renderer))
+
+        self.tiles = [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+    def render(self):
+        """(height, width, 4) uint8 RGBA frame, top-down as App.frames()."""
+        for _ in self.pool.imap_unordered(render_tile, self.tiles):
+            pass
+        return self.frame[::-1].copy()
+
+    def release(self):
+        self.pool.close()
+        self.pool.join()
+        del self.frame
+        self.shm.close()
+        self.shm.unlink()
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_gpu_frame(args):
+    # OpenGL only for --compare
+    from main import App
+
+    # fixed render scale 1: the upscale pass copies the frame
+    screen_width, screen_height = args["size"]
+    app = App(screen_width=screen_width, screen_height=screen_height, headless=True, target_fps=0, render_scale=1.0, model="ray",
+              scene=args["scene"], nb_primitive=args["primitives"], culling=not args["no_culling"])
+    frame = next(app.frames(1)).copy()
+    app.quit()
+    return frame
+
+def compare(cpu_frame, gpu_frame, tolerance):
+    diff = np.abs(cpu_frame.astype(np.int16) - gpu_frame).max(axis=2)
+    return int(diff.max()), float(diff.mean()), np.count_nonzero(diff > tolerance) / diff.size
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 cpu_render.py --size=640x400 --output=frame.png
+# python3 cpu_render.py --scene=field --primitives=200 --processes 1 2 4 8
+# python3 cpu_render.py --size=640x400 --compare
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('--scene', help='Scene graph of the ray model (default: the hand-written sceneSDF)', default="", choices=("",) + tuple(SCENES))
+    parser.add_argument('--primitives', help='Number of primitives of the field scene', default=SDF_PRIMITIVES, type=int)
+    parser.add_argument('--no_culling', help='Scene graph evaluated without its bounding spheres', action='store_true')
+    parser.add_argument('--processes', help='Numbers of processes to time (default: 1 per core)', nargs='+', default=[os.cpu_count()], type=int)
+    parser.add_argument('--tile', help='Tile size (pixels)', default=CPU_TILE, type=int)
+    parser.add_argument('--frames', help='Rendered frames per number of processes (best time kept)', default=1, type=int)
+    parser.add_argument('--output', help='Save the CPU frame to an image file', default="", type=str)
+    parser.add_argument('--compare', help='Render the frame on the GPU (headless) too and compare the pixels', action='store_true')
+    parser.add_argument('--tolerance', help='--compare: max difference of a pixel channel (/255)', default=1, type=int)
+    parser.add_argument('--max_off', help='--compare: max fraction of the pixels off by more than the tolerance', default=0.01, type=float)
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    screen_width, screen_height = args["size"]
+
+    scene = SCENES[args["scene"]](args["primitives"]) if args["scene"] else get_basic_scene()
+    renderer = TileRenderer(scene, screen_width, screen_height, scene_graph=bool(args["scene"]), culling=not args["no_culling"])
+
+    base = None
+    for processes in args["processes"]:
+        cpu_renderer = CPURenderer(renderer, processes=processes, tile_size=args["tile"])
+
+        times = []
+        for _ in range(args["frames"]):
+            t0 = time.perf_counter()
+            frame = cpu_renderer.render()
+            times.append(time.perf_counter() - t0)
+
+        cpu_renderer.release()
+
+        # scaling: speedup over the first number of processes, relative to the ratio of the numbers of processes
+        elapsed = min(times)
+        base = base or (elapsed, processes)
+        speedup = base[0] / elapsed
+        print(f"{processes:3d} process(es): {1000 * elapsed:9.1f} ms/frame ({screen_width * screen_height / elapsed / 1e6:.3f} Mrays/s) | x{speedup:.2f}, {100 * speedup * base[1] / processes:.0f}% of linear")
+
+    if args["output"]:
+        import pygame as pg
+        pg.image.save(pg.image.frombuffer(frame.tobytes(), (screen_width, screen_height), 'RGBA'), args["output"])
+
+    if args["compare"]:
+        max_diff, mean_diff, off = compare(frame, get_gpu_frame(args), args["tolerance"])
+        print(f"GPU / CPU frames: max diff {max_diff}/255, mean diff {mean_diff:.4f}/255, {100 * off:.4f}% pixels off by more than {args['tolerance']}/255")
+
+        if off > args["max_off"]:
+            raise SystemExit(f"GPU / CPU frames disagree: {100 * off:.4f}% pixels > {100 * args['max_off']:.4f}%")
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,41 @@
 import pygame as pg
 import numpy as np
 import moderngl as mgl
-import sys
+import os, sys, argparse
 
 from config import *
-from shader_program import ShaderProgram
+from shader_program import ShaderProgram, setup_shader_cache
+from sdf_scene import SCENES, compile_scene
+from terrain import load_heightmap
 
 # -----------------------------------------------------------------------------------------------------------
 
 class App:
 
-    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT):
+    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, headless=False, frames=-1, hot_reload=False, timings="", sync=False, target_fps=TARGET_FPS, render_scale=1.0, model=MODEL, prepass=False, step_stats=False, scene="", nb_primitive=SDF_PRIMITIVES, culling=False, heightmap=False, temporal=False):
 
         self.screen_width = screen_width
         self.screen_height = screen_height
 
+        self.headless = headless
+        self.max_frames = frames
+        self.hot_reload = hot_reload
+        self.timings = timings
+        self.sync = sync
+
+        self.model = model
+        self.prepass = prepass
+        self.step_stats = step_stats
+        self.heightmap = heightmap
+        self.temporal = temporal
+
+        # --scene: sceneSDF of the ray model generated from a scene graph (cached by scene hash)
+        self.scene_sdf = compile_scene(SCENES[scene](nb_primitive), culling=culling) if scene else ""
+
+        # --target_fps=0: fixed render scale
+        self.target_fps = target_fps
+        self.render_scale = min(max(render_scale, RENDER_SCALE_MIN), RENDER_SCALE_MAX)
+
         #
         self.lastTime = time.time()
         self.currentTime = time.time()
@@ -22,21 +43,40 @@ class App:
         self.fps = FPSCounter()
 
         # pygame init
+        if self.headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+        # persistent shader binaries, before the OpenGL context creation
+        setup_shader_cache()
+
         pg.init()
 
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 3)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
+        if self.headless:
+            # OpenGL context without window (EGL), rendering into an offscreen framebuffer
+            self.ctx = mgl.create_context(standalone=True, require=330, backend=HEADLESS_BACKEND)
+
+            self.fbo = self.ctx.simple_framebuffer((self.screen_width, self.screen_height), components=4)
+            self.fbo.use()
+        else:
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 3)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
 
-        pg.display.set_mode((self.screen_width, self.screen_height), flags=pg.OPENGL | pg.DOUBLEBUF)  # | pg.FULLSCREEN)
+            pg.display.set_mode((self.screen_width, self.screen_height), flags=pg.OPENGL | pg.DOUBLEBUF)  # | pg.FULLSCREEN)
 
-        pg.event.set_grab(False)
-        pg.mouse.set_visible(True)
+            pg.event.set_grab(False)
+            pg.mouse.set_visible(True)
+
+            # OpenGL context / options
+            self.ctx = mgl.create_context()
+            self.fbo = self.ctx.screen
+
+        # GPU time per pass (timer queries) + CPU time of flip
+        self.timer = PassTimer(self.ctx, keep_records=bool(self.timings))
 
         self.u_scroll = 5.0  # mouse
+        self.mouse = (0, 0)
 
-        # OpenGL context / options
-        self.ctx = mgl.create_context()
         # self.ctx.enable(flags=mgl.DEPTH_TEST | mgl.CULL_FACE)
 
         # time objects
@@ -45,31 +85,158 @@ class App:
         self.delta_time = 0
         self.num_frames = 0
 
-        # load shaders
-        all_shaders = ShaderProgram(self.ctx)
-        self.program = all_shaders.programs[MODEL]
-
         vertex_data = [(-1, -1, 0), (1, -1, 0), (1, 1, 0), (-1, 1, 0), (-1, -1, 0), (1, 1, 0)]
         vertex_data = np.array(vertex_data, dtype=np.float32)
 
         self.vbo = self.ctx.buffer(vertex_data)  # self.vbo = self.ctx.buffer(vertex_data.tobytes())
+        self.vao = None
+        self.prepass_vao = None
+        self.resolve_vao = None
+        self.reshade_vao = None
+        self.upscale_vao = None
+
+        # uniforms, last values kept to be set again on a reloaded program
+        self.uniforms = {}
+
+        # --step_stats: marching steps of the primary rays per pixel, + steps of the prepass per pixel
+        if self.step_stats:
+            self.steps = []
+
+        if self.temporal:
+            # --temporal: half the pixels shaded per frame (checkerboard) into a half width target, then the frame
+            # resolved into one of 2 history targets (color, depth in alpha), the other one holding the previous frame. The
+            # pixels rejected by the resolve are marked in a depth buffer, so that the reshade pass only shades them.
+            self.shaded_textures, self.shaded_fbo = self.get_target(((self.screen_width + 1) // 2, self.screen_height))
+            self.reshade_depth = self.ctx.depth_renderbuffer((self.screen_width, self.screen_height))
+            self.history = [self.get_target((self.screen_width, self.screen_height), self.reshade_depth) for _ in range(2)]
+            self.history_size = None
+        else:
+            # offscreen target of the window size, the frames are rendered in its lower left corner at the render scale
+            self.render_texture = self.ctx.texture((self.screen_width, self.screen_height), 4)
+            self.render_texture.filter = mgl.LINEAR, mgl.LINEAR
+            attachments = [self.render_texture]
+
+            if self.step_stats:
+                self.stats_texture = self.ctx.texture((self.screen_width, self.screen_height), 1, dtype='f4')
+                attachments.append(self.stats_texture)
+
+            self.render_fbo = self.ctx.framebuffer(color_attachments=attachments)
+
+        # --prepass: (start depth, steps) per tile
+        if self.prepass:
+            self.prepass_texture = self.ctx.texture(self.get_tiles(self.screen_width, self.screen_height), 2, dtype='f4')
+            self.prepass_texture.filter = mgl.NEAREST, mgl.NEAREST
+            self.prepass_fbo = self.ctx.framebuffer(color_attachments=[self.prepass_texture])
+
+        # --heightmap: terrain of the terrain model baked once (cached on disk), sampled with mipmaps
+        if self.heightmap:
+            heights = load_heightmap()
+            self.heightmap_texture = self.ctx.texture((TERRAIN_RES, TERRAIN_RES), 1, heights, dtype='f4')
+            self.heightmap_texture.build_mipmaps()
+            self.heightmap_texture.repeat_x = False
+            self.heightmap_texture.repeat_y = False
+            self.height_max = float(heights.max())
+
+        self.governor = RenderScaleGovernor(1000.0 / self.target_fps, scale=self.render_scale) if self.target_fps > 0 else None
 
+        # load shaders
+        self.all_shaders = ShaderProgram(self.ctx, watch=self.hot_reload)
+        self.load_program()
+
+    def load_program(self):
+        values = {"CONE_START": int(self.prepass), "STEP_STATS": int(self.step_stats), "TILE": PREPASS_TILE,
+                  "SCENE_GRAPH": int(bool(self.scene_sdf)), "SCENE_SDF": self.scene_sdf,
+                  "HEIGHTMAP": int(self.heightmap), "TERRAIN_SIZE": TERRAIN_SIZE, "TERRAIN_RES": TERRAIN_RES, "TERRAIN_STEP": TERRAIN_STEP}
+        self.program = self.all_shaders.get_program(self.model, PREPASS=0, TEMPORAL=int(self.temporal), **values)
+        self.programs = [self.program]
+
+        if self.vao:
+            self.vao.release()
         self.vao = self.ctx.vertex_array(self.program, [(self.vbo, '3f', 'vertexPosition')])
 
-        # uniforms
-        self.set_uniform('u_resolution', (self.screen_width, self.screen_height))
-        self.set_uniform('u_mouse', (0, 0))
+        if self.temporal:
+            self.resolve_program = self.all_shaders.get_program(self.model, PREPASS=0, TEMPORAL=2, **values)
+            self.reshade_program = self.all_shaders.get_program(self.model, PREPASS=0, TEMPORAL=3, **values)
+            self.programs += [self.resolve_program, self.reshade_program]
+
+            if self.resolve_vao:
+                self.resolve_vao.release()
+                self.reshade_vao.release()
+            self.resolve_vao = self.ctx.vertex_array(self.resolve_program, [(self.vbo, '3f', 'vertexPosition')])
+            self.reshade_vao = self.ctx.vertex_array(self.reshade_program, [(self.vbo, '3f', 'vertexPosition')])
+
+            self.set_uniform('u_shaded', 3)
+            self.set_uniform('u_history', 4)
+
+            # the previous frame may come from another program
+            self.history_size = None
+
+        if self.prepass:
+            self.prepass_program = self.all_shaders.get_program(self.model, PREPASS=1, TEMPORAL=0, **{**values, "CONE_START": 0, "STEP_STATS": 0})
+            self.programs.append(self.prepass_program)
+
+            if self.prepass_vao:
+                self.prepass_vao.release()
+            self.prepass_vao = self.ctx.vertex_array(self.prepass_program, [(self.vbo, '3f', 'vertexPosition')])
+
+            self.set_uniform('u_start_depth', 1)
+
+        if self.heightmap:
+            self.set_uniform('u_heightmap', 2)
+            self.set_uniform('u_height_max', self.height_max)
+
+        for u_name, u_value in self.uniforms.items():
+            self.set_uniform(u_name, u_value)
+
+        # bilinear upscale of the offscreen frame to the window
+        self.upscale_program = self.all_shaders.get_program("upscale")
+        self.upscale_program['u_texture'] = 0
+        self.upscale_program['u_screen'] = (self.screen_width, self.screen_height)
+
+        if self.upscale_vao:
+            self.upscale_vao.release()
+        self.upscale_vao = self.ctx.vertex_array(self.upscale_program, [(self.vbo, '3f', 'vertexPosition')])
 
     def destroy(self):
         self.vbo.release()
-        self.program.release()
+        self.all_shaders.destroy()
         self.vao.release()
+        self.upscale_vao.release()
+        if self.temporal:
+            self.resolve_vao.release()
+            self.reshade_vao.release()
+            self.reshade_depth.release()
+            for textures, fbo in [(self.shaded_textures, self.shaded_fbo)] + self.history:
+                fbo.release()
+                [texture.release() for texture in textures]
+        else:
+            self.render_fbo.release()
+            self.render_texture.release()
+            if self.step_stats:
+                self.stats_texture.release()
+        if self.prepass:
+            self.prepass_vao.release()
+            self.prepass_fbo.release()
+            self.prepass_texture.release()
+        if self.heightmap:
+            self.heightmap_texture.release()
+
+    def quit(self):
+        self.timer.flush()
+        if self.timings:
+            self.timer.dump(self.timings)
+
+        self.destroy()
+        pg.quit()
 
     def set_uniform(self, u_name, u_value):
-        try:
-            self.program[u_name] = u_value
-        except KeyError:
-            pass
+        # MODEL programs (main pass and prepass)
+        self.uniforms[u_name] = u_value
+        for program in self.programs:
+            try:
+                program[u_name] = u_value
+            except KeyError:
+                pass
 
     def get_time(self):
         self.time = pg.time.get_ticks() * 0.001
@@ -79,8 +246,14 @@ class App:
         delta = self.currentTime - self.lastTime
 
         if delta >= 1:
-            fps = f"PyGame FPS: {self.fps.get_fps():3.0f}"
-            pg.display.set_caption(fps)
+            fps = f"PyGame FPS: {self.fps.get_fps():3.0f} | scale {self.render_scale:.2f}"
+            if self.step_stats and self.steps:
+                fps += " | steps %.1f + prepass %.1f" % tuple(np.mean(self.steps[-60:], axis=0))
+            timings = self.timer.get_summary()
+            if self.headless:
+                print(fps + " | " + timings)
+            else:
+                pg.display.set_caption(fps + " | " + timings)
 
             self.lastTime = self.currentTime
 
@@ -91,8 +264,7 @@ class App:
         for event in pg.event.get():
 
             if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
-                self.destroy()
-                pg.quit()
+                self.quit()
                 sys.exit()
 
             if event.type == pg.MOUSEMOTION:
@@ -104,43 +276,252 @@ class App:
                 self.mouse_scroll(event.x, event.y)
 
     def mouse_pos(self, x, y, dx, dy):
-        self.set_uniform('u_mouse', (x, y))
+        self.mouse = (x, y)
 
     def mouse_scroll(self, x, y):
         self.u_scroll = max(1.0, self.u_scroll + y)
         self.set_uniform('u_scroll', self.u_scroll)
 
+    def get_tiles(self, width, height):
+        return (width + PREPASS_TILE - 1) // PREPASS_TILE, (height + PREPASS_TILE - 1) // PREPASS_TILE
+
+    def get_target(self, size, depth_attachment=None):
+        # color + depth in alpha (+ steps) render target of the temporal passes
+        textures = [self.ctx.texture(size, 4, dtype='f4')]
+        if self.step_stats:
+            textures.append(self.ctx.texture(size, 1, dtype='f4'))
+
+        return textures, self.ctx.framebuffer(color_attachments=textures, depth_attachment=depth_attachment)
+
+    def get_render_size(self):
+        return max(int(self.screen_width * self.render_scale), 1), max(int(self.screen_height * self.render_scale), 1)
+
     #
     def render(self):
-        self.ctx.clear()
-        self.vao.render()
-        pg.display.flip()
+        width, height = self.get_render_size()
+
+        if self.heightmap:
+            self.heightmap_texture.use(location=2)
+
+        if self.prepass:
+            with self.timer.gpu("prepass"):
+                self.prepass_fbo.use()
+                self.prepass_fbo.viewport = (0, 0, *self.get_tiles(width, height))
+                self.prepass_vao.render()
+
+        if self.temporal:
+            output_texture = self.render_temporal(width, height)
+        else:
+            with self.timer.gpu("render"):
+                self.render_fbo.use()
+                self.render_fbo.viewport = (0, 0, width, height)
+                if self.prepass:
+                    self.prepass_texture.use(location=1)
+                self.vao.render()
+
+            if self.step_stats:
+                self.read_steps([(self.render_fbo, (0, 0, width, height), 1)], width, height)
+
+            output_texture = self.render_texture
+
+        with self.timer.gpu("upscale"):
+            self.fbo.use()
+            output_texture.use(location=0)
+            self.upscale_program['u_region'] = (width, height)
+            self.upscale_vao.render()
+
+    def render_temporal(self, width, height):
+        # checkerboard pass, then resolve pass into the history target of the frame, returns its color texture
+        shaded_size = ((width + 1) // 2, height)
+
+        with self.timer.gpu("render"):
+            self.shaded_fbo.use()
+            self.shaded_fbo.viewport = (0, 0, *shaded_size)
+            if self.prepass:
+                self.prepass_texture.use(location=1)
+            self.vao.render()
+
+        (color, *_), fbo = self.history[self.num_frames % 2]
+        (prev_color, *_), _ = self.history[(self.num_frames + 1) % 2]
+
+        # resolve: depth of every pixel written (0: rejected), reshade: at depth 0.5, only over the rejected pixels
+        self.ctx.enable(mgl.DEPTH_TEST)
+
+        with self.timer.gpu("resolve"):
+            fbo.use()
+            fbo.viewport = (0, 0, width, height)
+            self.shaded_textures[0].use(location=3)
+            prev_color.use(location=4)
+            self.ctx.depth_func = '1'
+            self.resolve_vao.render()
+
+        with self.timer.gpu("reshade"):
+            self.ctx.depth_func = '>'
+            self.reshade_vao.render()
+
+        self.ctx.disable(mgl.DEPTH_TEST)
+
+        if self.step_stats:
+            self.read_steps([(self.shaded_fbo, (0, 0, *shaded_size), 1), (fbo, (0, 0, width, height), 1)], width, height)
+
+        self.history_size = (width, height)
+        return color
+
+    def read_steps(self, targets, width, height):
+        # mean steps per pixel of the frame (readback: stalls the pipeline, statistics only), targets: (fbo, viewport, attachment)
+        steps = sum(np.frombuffer(fbo.read(viewport=viewport, components=1, attachment=attachment, dtype='f4'), dtype=np.float32).sum()
+                    for fbo, viewport, attachment in targets) / (width * height)
+
+        prepass_steps = 0.0
+        if self.prepass:
+            tiles = np.frombuffer(self.prepass_fbo.read(viewport=(0, 0, *self.get_tiles(width, height)), components=2, dtype='f4'), dtype=np.float32)
+            prepass_steps = tiles[1::2].sum() / (width * height)
+
+        self.steps.append((steps, prepass_steps))
+
+    def update_render_scale(self):
+        # after the frame: scale of the next one
+        if self.governor:
+            self.render_scale = self.governor.update()
 
     #
     def update(self):
-        self.set_uniform('u_time', pg.time.get_ticks() * 0.001)
+        # shader hot reload, at the frame boundary
+        if self.all_shaders.reload():
+            self.load_program()
+
+        u_time = pg.time.get_ticks() * 0.001
+
+        # pixels of the offscreen frame
+        width, height = self.get_render_size()
+        u_mouse = (self.mouse[0] * width / self.screen_width, self.mouse[1] * height / self.screen_height)
+
+        # --temporal: camera of the previous frame, whose history is only valid at the same render size
+        if self.temporal:
+            self.set_uniform('u_prev_time', self.uniforms.get('u_time', u_time))
+            self.set_uniform('u_prev_mouse', self.uniforms.get('u_mouse', u_mouse))
+            self.set_uniform('u_history_valid', int(self.history_size == (width, height)))
+
+        self.set_uniform('u_time', u_time)
         self.set_uniform('u_frames', self.num_frames)
 
+        self.set_uniform('u_resolution', (width, height))
+        self.set_uniform('u_mouse', u_mouse)
+
+    #
+    def frames(self, count=-1):
+        """Render `count` frames (-1 for unlimited) and yield each one as a (height, width, 4) uint8 RGBA array.
+
+        The array is a top-down view of a single buffer reused for every frame: copy it to keep a frame.
+        """
+        frame = np.empty((self.screen_height, self.screen_width, 4), dtype=np.uint8)
+
+        nb_frames = 0
+        while count < 0 or nb_frames < count:
+            nb_frames += 1
+            self.num_frames += 1
+
+            self.get_time()
+
+            self.update()
+            self.render()
+
+            self.fbo.read_into(frame, components=4)
+
+            self.delta_time = self.clock.tick(MAX_FPS)
+
+            if self.sync:
+                self.ctx.finish()
+
+            self.timer.end_frame()
+            self.update_render_scale()
+            self.get_fps()
+
+            yield frame[::-1]
+
     #
     def run(self):
-        while True:
+        start_time = time.perf_counter()
+
+        while self.max_frames < 0 or self.num_frames < self.max_frames:
             self.num_frames += 1
 
             self.get_time()
 
-            self.check_events()
+            if not self.headless:
+                self.check_events()
 
             self.update()
             self.render()
 
+            if not self.headless:
+                with self.timer.cpu("flip"):
+                    pg.display.flip()
+
             self.delta_time = self.clock.tick(MAX_FPS)
 
+            if self.sync:
+                self.ctx.finish()
+
+            self.timer.end_frame()
+            self.update_render_scale()
             self.get_fps()
 
+        self.ctx.finish()
+        self.timer.flush()
+        elapsed = time.perf_counter() - start_time
+        print(f"Rendered {self.num_frames} frames in {elapsed:.3f}s ({self.num_frames / elapsed:.1f} FPS)")
+        print(f"Pass timings: {self.timer.get_summary()}")
+        if self.step_stats:
+            print("Marching steps per pixel: %.2f + prepass %.2f" % tuple(np.mean(self.steps, axis=0)))
 
-# -----------------------------------------------------------------------------------------------------------
+        self.quit()
 
-if __name__ == '__main__':
-    app = App()
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 main.py
+# python3 main.py --headless --frames=100 --size=1920x1080
+# python3 main.py --target_fps=30
+# python3 main.py --target_fps=0 --render_scale=0.5
+# python3 main.py --model=terrain --prepass --step_stats
+# python3 main.py --scene=field --primitives=400 --step_stats
+# python3 main.py --scene=field --primitives=400 --culling
+# python3 main.py --model=terrain --heightmap
+# python3 main.py --model=terrain --temporal
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('--headless', help='Render offscreen without window (EGL context)', action='store_true')
+    parser.add_argument('--frames', help='Number of frames to render, -1 for unlimited', default=-1, type=int)
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('--hot_reload', help='Recompile the shaders when their source files change', action='store_true')
+    parser.add_argument('--timings', help='Save the per-frame pass timings to a .csv or .json file', default="", type=str)
+    parser.add_argument('--sync', help='Wait for the GPU at the end of each frame (per-frame times of benchmarks)', action='store_true')
+    parser.add_argument('--target_fps', help='Frame rate the render scale is adjusted to, 0 for a fixed render scale', default=TARGET_FPS, type=float)
+    parser.add_argument('--model', help='Fragment shader of the scene', default=MODEL, choices=("ray", "terrain"))
+    parser.add_argument('--prepass', help=f'Cone-marching prepass: the rays start at a depth computed per {PREPASS_TILE}x{PREPASS_TILE} tile', action='store_true')
+    parser.add_argument('--step_stats', help='Mean number of marching steps per pixel (reads back every frame)', action='store_true')
+    parser.add_argument('--scene', help='Scene graph compiled to the sceneSDF of the ray model (default: hand-written sceneSDF)', default="", choices=("",) + tuple(SCENES))
+    parser.add_argument('--primitives', help='Number of primitives of the field scene', default=SDF_PRIMITIVES, type=int)
+    parser.add_argument('--culling', help='Scene graph evaluated with its bounding spheres (off by default: slower with drivers flattening branches, llvmpipe)', action='store_true')
+    parser.add_argument('--heightmap', help='Terrain model: marching of a heightmap baked once instead of the noise evaluated at each step', action='store_true')
+    parser.add_argument('--temporal', help='Shade half the pixels per frame (checkerboard), the others reprojected from the previous frame', action='store_true')
+    parser.add_argument('--render_scale', help=f'Initial (or fixed) render scale, in [{RENDER_SCALE_MIN}, {RENDER_SCALE_MAX}]', default=1.0, type=float)
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    print("Args = %s" % args)
+
+    screen_width, screen_height = args["size"]
+
+    app = App(screen_width=screen_width, screen_height=screen_height, headless=args["headless"], frames=args["frames"], hot_reload=args["hot_reload"], timings=args["timings"], sync=args["sync"],
+              target_fps=args["target_fps"], render_scale=args["render_scale"],
+              model=args["model"], prepass=args["prepass"], step_stats=args["step_stats"],
+              scene=args["scene"], nb_primitive=args["primitives"], culling=args["culling"], heightmap=args["heightmap"], temporal=args["temporal"])
     app.run()
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+import os, abc, math, hashlib
+
+import numpy as np
+
+from config import SDF_CACHE_DIR, SDF_GROUP_SIZE, SDF_CULL_MARGIN
+
+# -----------------------------------------------------------------------------------------------------------
+# Scene graph of signed distance functions compiled to the GLSL sceneSDF(vec3 p) of ray_fs.glsl
+#
+#   primitives: Sphere, Box, Torus, Plane
+#   transforms: node.translate(x, y, z), node.rotate(axis, angle), node.scale(s)
+#   operations: a | b (union), a & b (intersection), a - b (difference)
+#
+# Each node has a bounding sphere (None for unbounded ones: planes). With culling, the children of a union are
+# grouped in a hierarchy of bounding spheres (at most SDF_GROUP_SIZE per group): a group is only evaluated when its
+# sphere is closer than both the current distance and SDF_CULL_MARGIN, else the distance to the sphere (a lower
+# bound) stands for it. The culling relies on real branches: drivers that flatten them into selects (llvmpipe)
+# evaluate every group anyway, plus the tests.
+#
+# node.get_distance(p) evaluates the same distances with NumPy on (n, 3) float32 points (CPU renderer), the culling
+# with masks of the points.
+
+GLSL_FUNCTIONS = """float sdf_sphere(vec3 p, float r) {
+    return length(p) - r;
+}
+
+float sdf_box(vec3 p, vec3 b) {
+    vec3 q = abs(p) - b;
+    return length(max(q, 0.0)) + min(max(q.x, max(q.y, q.z)), 0.0);
+}
+
+float sdf_torus(vec3 p, vec2 t) {
+    return length(vec2(length(p.xz) - t.x, p.y)) - t.y;
+}
+
+float sdf_plane(vec3 p, float h) {
+    return p.y - h;
+}
+"""
+
+def length(v):
+    return np.sqrt((v * v).sum(axis=-1))
+
+def to_float(value):
+    # single precision literal
+    text = "%.7g" % value
+    return text if any(c in text for c in ".e") else text + ".0"
+
+def to_vec3(values):
+    return "vec3(%s)" % ", ".join(to_float(v) for v in values)
+
+class Generator:
+    # GLSL statements of sceneSDF, one variable per intermediate result
+    def __init__(self, culling):
+        self.culling = culling
+        self.lines = []
+        self.depth = 1
+        self.count = 0
+
+    def get_var(self, prefix):
+        self.count += 1
+        return f"{prefix}{self.count}"
+
+    def add(self, line):
+        self.lines.append("    " * self.depth + line)
+
+    def open(self, line):
+        self.add(line + " {")
+        self.depth += 1
+
+    def close(self):
+        self.depth -= 1
+        self.add("}")
+
+# -----------------------------------------------------------------------------------------------------------
+
+class Node(abc.ABC):
+
+    @abc.abstractmethod
+    def get_bounds(self):
+        # bounding sphere (center, radius), None if unbounded
+        pass
+
+    @abc.abstractmethod
+    def get_desc(self):
+        # canonical description, hashed for the cache of the generated sources
+        pass
+
+    @abc.abstractmethod
+    def emit(self, gen, p):
+        # statements computing the distance at point p (GLSL vec3 variable), returns the float variable
+        pass
+
+    @abc.abstractmethod
+    def get_distance(self, p, culling=True):
+        # distances at the (n, 3) float32 points p, as the emitted statements
+        pass
+
+    def translate(self, x, y, z):
+        return Translate(self, (x, y, z))
+
+    def rotate(self, axis, angle):
+        return Rotate(self, axis, angle)
+
+    def scale(self, s):
+        return Scale(self, s)
+
+    def __or__(self, other):
+        return Union(self, other)
+
+    def __and__(self, other):
+        return Intersection(self, other)
+
+    def __sub__(self, other):
+        return Difference(self, other)
+
+class Primitive(Node):
+    function = ""
+
+    def __init__(self, *params):
+        self.params = params
+
+    def get_desc(self):
+        return (type(self).__name__, self.params)
+
+    def get_args(self):
+        return ", ".join(to_float(v) for v in self.params)
+
+    def emit(self, gen, p):
+        d = gen.get_var("d")
+        gen.add(f"float {d} = {self.function}({p}, {self.get_args()});")
+        return d
+
+class Sphere(Primitive):
+    function = "sdf_sphere"
+
+    def __init__(self, radius):
+        super().__init__(float(radius))
+
+    def get_bounds(self):
+        return np.zeros(3), self.params[0]
+
+    def get_distance(self, p, culling=True):
+        return length(p) - np.float32(self.params[0])
+
+class Box(Primitive):
+    function = "sdf_box"
+
+    def __init__(self, half_size):
+        super().__init__(*(float(v) for v in half_size))
+
+    def get_args(self):
+        return to_vec3(self.params)
+
+    def get_bounds(self):
+        return np.zeros(3), float(np.linalg.norm(self.params))
+
+    def get_distance(self, p, culling=True):
+        q = np.abs(p) - np.array(self.params, dtype=np.float32)
+        return length(np.maximum(q, 0.0)) + np.minimum(q.max(axis=-1), 0.0)
+
+class Torus(Primitive):
+    # in the xz plane
+    function = "sdf_torus"
+
+    def __init__(self, major, minor):
+        super().__init__(float(major), float(minor))
+
+    def get_args(self):
+        return "vec2(%s)" % super().get_args()
+
+    def get_bounds(self):
+        return np.zeros(3), self.params[0] + self.params[1]
+
+    def get_distance(self, p, culling=True):
+        major, minor = np.float32(self.params[0]), np.float32(self.params[1])
+        q = np.stack([length(p[:, [0, 2]]) - major, p[:, 1]], axis=-1)
+        return length(q) - minor
+
+class Plane(Primitive):
+    # y = height
+    function = "sdf_plane"
+
+    def __init__(self, height):
+        super().__init__(float(height))
+
+    def get_bounds(self):
+        return None
+
+    def get_distance(self, p, culling=True):
+        return p[:, 1] - np.float32(self.params[0])
+
+# -----------------------------------------------------------------------------------------------------------
+
+class Translate(Node):
+
+    def __init__(self, child, offset):
+        self.child = child
+        self.offset = np.asarray(offset, dtype=float)
+
+    def get_bounds(self):
+        bounds = self.child.get_bounds()
+        return None if bounds is None else (bounds[0] + self.offset, bounds[1])
+
+    def get_desc(self):
+        return ("translate", tuple(self.offset), self.child.get_desc())
+
+    def emit(self, gen, p):
+        q = gen.get_var("p")
+        gen.add(f"vec3 {q} = {p} - {to_vec3(self.offset)};")
+        return self.child.emit(gen, q)
+
+    def get_distance(self, p, culling=True):
+        return self.child.get_distance(p - self.offset.astype(np.float32), culling)
+
+class Rotate(Node):
+
+    def __init__(self, child, axis, angle):
+        self.child = child
+
+        # Rodrigues rotation matrix
+        axis = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+        k = np.array([[0.0, -axis[2], axis[1]], [axis[2], 0.0, -axis[0]], [-axis[1], axis[0], 0.0]])
+        self.matrix = np.eye(3) + math.sin(angle) * k + (1.0 - math.cos(angle)) * k @ k
+
+    def get_bounds(self):
+        bounds = self.child.get_bounds()
+        return None if bounds is None else (self.matrix @ bounds[0], bounds[1])
+
+    def get_desc(self):
+        return ("rotate", tuple(np.round(self.matrix, 9).ravel()), self.child.get_desc())
+
+    def emit(self, gen, p):
+        # child evaluated at the inverse rotation (transpose) of p, GLSL matrices are column major
+        q = gen.get_var("p")
+        gen.add(f"vec3 {q} = mat3({', '.join(to_float(v) for v in self.matrix.ravel())}) * {p};")
+        return self.child.emit(gen, q)
+
+    def get_distance(self, p, culling=True):
+        # the GLSL mat3 is the transpose: p by the matrix on the right
+        return self.child.get_distance(p @ self.matrix.astype(np.float32), culling)
+
+class Scale(Node):
+    # uniform: the distance is scaled too
+
+    def __init__(self, child, s):
+        self.child = child
+        self.s = float(s)
+
+    def get_bounds(self):
+        bounds = self.child.get_bounds()
+        return None if bounds is None else (bounds[0] * self.s, bounds[1] * self.s)
+
+    def get_desc(self):
+        return ("scale", self.s, self.child.get_desc())
+
+    def emit(self, gen, p):
+        q = gen.get_var("p")
+        gen.add(f"vec3 {q} = {p} / {to_float(self.s)};")
+
+        d = gen.get_var("d")
+        gen.add(f"float {d} = {self.child.emit(gen, q)} * {to_float(self.s)};")
+        return d
+
+    def get_distance(self, p, culling=True):
+        s = np.float32(self.s)
+        return self.child.get_distance(p / s, culling) * s
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_enclosing_sphere(spheres):
+    centers = np.array([center for center, _ in spheres])
+    radii = np.array([radius for _, radius in spheres])
+
+    center = centers.mean(axis=0)
+    return center, float((np.linalg.norm(centers - center, axis=1) + radii).max())
+
+def make_groups(items, group_size):
+    # items: (node, (center, radius)) => tree of groups (list of items / groups, (center, radius)) of at most
+    # group_size children, split at the median center along the axis of largest spread
+    if len(items) <= group_size:
+        return items, get_enclosing_sphere([bounds for _, bounds in items])
+
+    centers = np.array([bounds[0] for _, bounds in items])
+    axis = int(np.argmax(centers.max(axis=0) - centers.min(axis=0)))
+    items = [items[i] for i in np.argsort(centers[:, axis], kind='stable')]
+
+    half = len(items) // 2
+    groups = [make_groups(items[:half], group_size), make_groups(items[half:], group_size)]
+    return groups, get_enclosing_sphere([bounds for _, bounds in groups])
+
+class Union(Node):
+
+    def __init__(self, *children):
+        # nested unions are flattened, so that a | b | c | ... is grouped as a whole
+        self.children = []
+        for child in children:
+            self.children += child.children if isinstance(child, Union) else [child]
+
+    def get_bounds(self):
+        bounds = [child.get_bounds() for child in self.children]
+        return None if any(b is None for b in bounds) else get_enclosing_sphere(bounds)
+
+    def get_desc(self):
+        return ("union", tuple(child.get_desc() for child in self.children))
+
+    def emit(self, gen, p):
+        d = gen.get_var("d")
+        gen.add(f"float {d} = 1e10;")
+
+        bounded = [(child, child.get_bounds()) for child in self.children]
+        unbounded = [child for child, bounds in bounded if bounds is None]
+        bounded = [(child, bounds) for child, bounds in bounded if bounds is not None]
+
+        # unbounded children first: their distance lets the bounded ones be culled
+        for child in unbounded:
+            gen.add(f"{d} = min({d}, {child.emit(gen, p)});")
+
+        if not gen.culling:
+            for child, _ in bounded:
+                gen.add(f"{d} = min({d}, {child.emit(gen, p)});")
+        elif bounded:
+            self.emit_group(gen, p, d, make_groups(bounded, SDF_GROUP_SIZE)[0])
+
+        return d
+
+    def emit_group(self, gen, p, d, items):
+        for item, (center, radius) in items:
+            # children of a group: evaluated once the group passed its test (a sphere test costs about a primitive)
+            if not isinstance(item, list):
+                gen.add(f"{d} = min({d}, {item.emit(gen, p)});")
+                continue
+
+            b = gen.get_var("b")
+            gen.add(f"float {b} = length({p} - {to_vec3(center)}) - {to_float(radius)};")
+
+            # farther than the current distance: skipped, farther than the margin: bounding sphere distance
+            gen.open(f"if ({b} < {d})")
+            gen.add(f"if ({b} > {to_float(SDF_CULL_MARGIN)}) {d} = {b};")
+            gen.open("else")
+
+            self.emit_group(gen, p, d, item)
+
+            gen.close()
+            gen.close()
+
+    def get_distance(self, p, culling=True):
+        d = np.full(len(p), 1e10, dtype=np.float32)
+
+        bounded = [(child, child.get_bounds()) for child in self.children]
+        unbounded = [child for child, bounds in bounded if bounds is None]
+        bounded = [(child, bounds) for child, bounds in bounded if bounds is not None]
+
+        for child in unbounded:
+            d = np.minimum(d, child.get_distance(p, culling))
+
+        if not culling:
+            for child, _ in bounded:
+                d = np.minimum(d, child.get_distance(p, culling))
+        elif bounded:
+            d = self.get_group_distance(p, d, make_groups(bounded, SDF_GROUP_SIZE)[0])
+
+        return d
+
+    def get_group_distance(self, p, d, items):
+        # emit_group() on the points: the children of a group are evaluated at the points that passed its test only
+        for item, (center, radius) in items:
+            if not isinstance(item, list):
+                d = np.minimum(d, item.get_distance(p))
+                continue
+
+            b = length(p - center.astype(np.float32)) - np.float32(radius)
+
+            closer = b < d
+            far = closer & (b > SDF_CULL_MARGIN)
+            near = closer & ~far
+
+            d = np.where(far, b, d)
+            if near.any():
+                d[near] = self.get_group_distance(p[near], d[near], item)
+
+        return d
+
+class Intersection(Node):
+
+    def __init__(self, *children):
+        self.children = children
+
+    def get_bounds(self):
+        bounds = [b for b in (child.get_bounds() for child in self.children) if b is not None]
+        return min(bounds, key=lambda b: b[1]) if bounds else None
+
+    def get_desc(self):
+        return ("intersection", tuple(child.get_desc() for child in self.children))
+
+    def emit(self, gen, p):
+        d = gen.get_var("d")
+        gen.add(f"float {d} = {self.children[0].emit(gen, p)};")
+        for child in self.children[1:]:
+            gen.add(f"{d} = max({d}, {child.emit(gen, p)});")
+        return d
+
+    def get_distance(self, p, culling=True):
+        d = self.children[0].get_distance(p, culling)
+        for child in self.children[1:]:
+            d = np.maximum(d, child.get_distance(p, culling))
+        return d
+
+class Difference(Node):
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def get_bounds(self):
+        return self.a.get_bounds()
+
+    def get_desc(self):
+        return ("difference", self.a.get_desc(), self.b.get_desc())
+
+    def emit(self, gen, p):
+        d = gen.get_var("d")
+        gen.add(f"float {d} = {self.a.emit(gen, p)};")
+
+        bounds = self.b.get_bounds()
+        if gen.culling and bounds is not None:
+            # -b < -(distance to the bounding sphere of b) <= d: max(d, -b) = d, b not evaluated
+            b = gen.get_var("b")
+            gen.add(f"float {b} = length({p} - {to_vec3(bounds[0])}) - {to_float(bounds[1])};")
+            gen.open(f"if ({b} < -{d})")
+            gen.add(f"{d} = max({d}, -{self.b.emit(gen, p)});")
+            gen.close()
+        else:
+            gen.add(f"{d} = max({d}, -{self.b.emit(gen, p)});")
+
+        return d
+
+    def get_distance(self, p, culling=True):
+        d = self.a.get_distance(p, culling)
+
+        bounds = self.b.get_bounds()
+        if culling and bounds is not None:
+            inside = length(p - bounds[0].astype(np.float32)) - np.float32(bounds[1]) < -d
+            if inside.any():
+                d[inside] = np.maximum(d[inside], -self.b.get_distance(p[inside], culling))
+        else:
+            d = np.maximum(d, -self.b.get_distance(p, culling))
+
+        return d
+
+# -----------------------------------------------------------------------------------------------------------
+
+def generate(scene, culling=True):
+    gen = Generator(culling)
+    d = scene.emit(gen, "p")
+
+    return GLSL_FUNCTIONS + "\nfloat sceneSDF(vec3 p)\n{\n" + "\n".join(gen.lines) + f"\n    return {d};\n}}\n"
+
+def compile_scene(scene, culling=True, cache_dir=SDF_CACHE_DIR):
+    """GLSL of the sceneSDF of a scene graph, generated once per scene (hash of its description), option and
+    version of the generator (source of this module)."""
+    desc = repr((scene.get_desc(), culling, SDF_GROUP_SIZE, SDF_CULL_MARGIN))
+    with open(__file__, "rb") as file:
+        key = hashlib.sha256(file.read() + desc.encode()).hexdigest()[:32]
+    path = os.path.join(cache_dir, f"{key}.glsl")
+
+    if os.path.exists(path):
+        with open(path) as file:
+            return file.read()
+
+    source = generate(scene, culling)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(source)
+    os.replace(tmp_path, path)
+
+    return source
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_basic_scene():
+    # the hand-written sceneSDF of ray_fs.glsl
+    return Sphere(1.0).translate(-3.0, 0.0, 0.0) | Plane(-1.0) | Box((1.0, 1.0, 1.0))
+
+def get_field_scene(nb_primitive, seed=0):
+    # ground plane + random spheres / boxes / tori / holed boxes around the origin
+    rng = np.random.default_rng(seed)
+    nodes = [Plane(-1.0)]
+
+    for i in range(nb_primitive):
+        size = rng.uniform(0.1, 0.3)
+        kind = i % 4
+
+        if kind == 0:
+            node = Sphere(size)
+        elif kind == 1:
+            node = Box(rng.uniform(0.5, 1.0, 3) * size)
+        elif kind == 2:
+            node = Torus(size, 0.3 * size)
+        else:
+            node = Box((size, size, size)) - Sphere(1.3 * size)
+
+        node = node.rotate(rng.normal(size=3), rng.uniform(0.0, 2.0 * math.pi))
+        nodes.append(node.translate(rng.uniform(-6.0, 6.0), rng.uniform(-0.8, 1.5), rng.uniform(-6.0, 6.0)))
+
+    return Union(*nodes)
+
+SCENES = {"basic": lambda nb_primitive: get_basic_scene(), "field": get_field_scene}
@@ -1,13 +1,54 @@
 #version 330 core
 
+// 1: cone-marching prepass, 1 fragment per TILE x TILE pixels writes (start depth of the tile, steps)
+#define PREPASS     PREPASS_VAL
+// 1: the primary rays start at the depth of their tile in u_start_depth (written by the prepass)
+#define CONE_START  CONE_START_VAL
+// 1: number of steps of the primary ray written to the 2nd color attachment
+#define STEP_STATS  STEP_STATS_VAL
+#define TILE        TILE_VAL
+// 1: terrain sampled from the baked heightmap u_heightmap (terrain.py) instead of evaluated at each step
+#define HEIGHTMAP   HEIGHTMAP_VAL
+#define TERRAIN_SIZE TERRAIN_SIZE_VAL
+#define TERRAIN_RES  TERRAIN_RES_VAL
+#define TERRAIN_STEP TERRAIN_STEP_VAL
+
+// color and depth of the ray (MAX_DIST when it hits nothing) in fragColor.rgb / .a
+// 1: checkerboard pass, texel (i, j) of a half width target shades the pixel (2i or 2i + 1, j) of the frame parity
+// 2: resolve pass, the pixels of the other parity are reprojected from the previous frame, the rejected ones are
+//    written at depth 0 (no shading code in this pass)
+// 3: reshade pass, drawn at depth 0.5 with a depth test: only the rejected pixels are shaded
+#define TEMPORAL    TEMPORAL_VAL
+
 layout(location = 0) out vec4 fragColor;
 
+#if STEP_STATS
+layout(location = 1) out vec4 stepCount;
+#endif
+
+#if CONE_START
+uniform sampler2D u_start_depth;
+#endif
+
+#if HEIGHTMAP
+uniform sampler2D u_heightmap;
+uniform float     u_height_max;
+#endif
+
 uniform vec2  u_resolution;
 uniform float u_time;
 uniform int   u_frames;
 uniform vec2  u_mouse;
 uniform float u_scroll;
 
+#if TEMPORAL == 2
+uniform sampler2D u_shaded;             // checkerboard pass
+uniform sampler2D u_history;            // previous frame
+uniform int   u_history_valid;
+uniform vec2  u_prev_mouse;             // previous camera
+uniform float u_prev_time;
+#endif
+
 const bool ROTATE = false;
 
 const int MAX_MARCHING_STEPS = 512;
@@ -89,6 +130,16 @@ float dist_plane(vec3 p, float h) {
     return d;
 }
 
+#if HEIGHTMAP
+const float TERRAIN_TEXEL = TERRAIN_SIZE / float(TERRAIN_RES);
+
+// height of the baked terrain at xz, from the mipmap level whose texels are about the size of a pixel at this depth
+float terrain_height(vec2 xz, float depth) {
+    float lod = log2(max(depth * 2.0 / (u_resolution.y * TERRAIN_TEXEL), 1.0));
+    return textureLod(u_heightmap, xz / TERRAIN_SIZE + 0.5, lod).r;
+}
+#endif
+
 float dist_sphere(vec3 p, vec3 pos) {
     return length(p - pos) - 1;
 }
@@ -104,7 +155,11 @@ float sceneSDF(vec3 p)
 {
     float dt = dist_torus(p);
 
+#if HEIGHTMAP
+    float dp = p.y - terrain_height(p.xz, 0.0);
+#else
     float dp = dist_plane(p, 2.0);
+#endif
 	float ds = dist_sphere(p, vec3(-3.0, 0.0, 0.0));
     float dc = dist_cube(p, vec3(1, 1, 1));
 
@@ -115,6 +170,18 @@ float sceneSDF(vec3 p)
 // ------------------------------------------------------------------------------------------------
 // the gradiant is more or less the same as the normal of the object on that point
 
+#if HEIGHTMAP
+// gradient of the heightmap: central differences between the neighbour texels
+vec3 get_normal(vec3 p) {
+    vec2 uv = p.xz / TERRAIN_SIZE + 0.5;
+    float left  = textureLodOffset(u_heightmap, uv, 0.0, ivec2(-1, 0)).r;
+    float right = textureLodOffset(u_heightmap, uv, 0.0, ivec2( 1, 0)).r;
+    float down  = textureLodOffset(u_heightmap, uv, 0.0, ivec2(0, -1)).r;
+    float up    = textureLodOffset(u_heightmap, uv, 0.0, ivec2(0,  1)).r;
+
+    return normalize(vec3(left - right, 2.0 * TERRAIN_TEXEL, down - up));
+}
+#else
 vec3 get_normal(vec3 p) {
     return normalize(vec3(
         sceneSDF(vec3(p.x + EPSILON, p.y, p.z)) - sceneSDF(vec3(p.x - EPSILON, p.y, p.z)),
@@ -122,10 +189,51 @@ vec3 get_normal(vec3 p) {
         sceneSDF(vec3(p.x, p.y, p.z  + EPSILON)) - sceneSDF(vec3(p.x, p.y, p.z - EPSILON))
     ));
 }
+#endif
 
 // ------------------------------------------------------------------------------------------------
 // Return the shortest distance from the camera (eye) to the scene surface along the marching direction
 
+int march_steps = 0;
+
+#if HEIGHTMAP
+// Heightfield: the height above the terrain bounds the distance only where the slopes are gentle, so the steps are
+// a fraction of it. Once under the surface, the hit is interpolated between the heights of the last two steps. The
+// ray ends above the highest point of the terrain going up, or out of the baked area.
+float shortest_distance_to_surface(vec3 eye, vec3 marching_direction, float start, float end) {
+    float depth = start;
+    float footprint = 2.0 / u_resolution.y;
+
+    float last_depth = start;
+    float last_height = 0.0;
+
+    for (int i = 0; i < MAX_MARCHING_STEPS; i++) {
+        vec3 pos_along_ray = eye + depth * marching_direction;
+
+        march_steps++;
+        float height = pos_along_ray.y - terrain_height(pos_along_ray.xz, depth);
+
+        if (height < 0.0) {
+            return depth > start ? mix(last_depth, depth, last_height / (last_height - height)) : depth;
+        }
+        if (height < max(EPSILON, depth * footprint)) {
+            return depth;
+        }
+
+        last_depth = depth;
+        last_height = height;
+        depth += TERRAIN_STEP * height;
+
+        pos_along_ray = eye + depth * marching_direction;
+        if (depth >= end || (marching_direction.y >= 0.0 && pos_along_ray.y > u_height_max) ||
+            any(greaterThan(abs(pos_along_ray.xz), vec2(0.5 * TERRAIN_SIZE)))) {
+            return end;
+        }
+    }
+
+    return end;
+}
+#else
 float shortest_distance_to_surface(vec3 eye, vec3 marching_direction, float start, float end) {
     float depth = start;
 
@@ -134,6 +242,7 @@ float shortest_distance_to_surface(vec3 eye, vec3 marching_direction, float star
 
         if(ROTATE) rotate(pos_along_ray);
 
+        march_steps++;
         float dist = sceneSDF(pos_along_ray);
 
         if (dist < EPSILON) {
@@ -147,6 +256,37 @@ float shortest_distance_to_surface(vec3 eye, vec3 marching_direction, float star
 
     return end;
 }
+#endif
+
+#if PREPASS
+// bound of the ratio sceneSDF / true distance, the cone steps assume a distance that never overestimates
+const float CONE_LIPSCHITZ = 0.25;
+
+// March of the cone around the ray (radius depth * cone_k), returns the depth up to which the cone is empty: a start
+// depth of all the rays inside. A step is limited so that the cone section stays in the empty sphere of its start.
+float cone_march(vec3 eye, vec3 marching_direction, float cone_k, float end) {
+    float depth = 0.0;
+
+    for (int i = 0; i < MAX_MARCHING_STEPS; i++) {
+        vec3 pos_along_ray = eye + depth * marching_direction;
+
+        if(ROTATE) rotate(pos_along_ray);
+
+        march_steps++;
+        float dist = CONE_LIPSCHITZ * sceneSDF(pos_along_ray) - depth * cone_k;
+
+        if (dist < EPSILON) {
+            return depth;
+        }
+        depth += dist / (1.0 + cone_k);
+        if (depth >= end) {
+            return end;
+        }
+    }
+
+    return depth;
+}
+#endif
 
 // ------------------------------------------------------------------------------------------------
 
@@ -237,8 +377,8 @@ void pR(inout vec2 p, float a) {
 	p = cos(a)*p + sin(a)*vec2(p.y, -p.x);
 }
 
-void mouseControl(inout vec3 ro) {
-    vec2 m = u_mouse / u_resolution;
+void mouseControl(inout vec3 ro, vec2 mouse) {
+    vec2 m = mouse / u_resolution;
     pR(ro.yz, m.y * PI * 0.4 - 0.4);
     pR(ro.xz, m.x * TAU);
 }
@@ -253,31 +393,145 @@ mat3 getCam(vec3 eye, vec3 target) {
     return mat3(right, up, fwd);
 }
 
+// ------------------------------------------------------------------------------------------------
+// camera for a mouse position (and time): the ray of the screen point uv is normalize(fwd + side * uv.x + up * uv.y)
+
+void get_camera(vec2 mouse, float time, out vec3 eye, out vec3 fwd, out vec3 side, out vec3 up) {
+    eye = vec3(220.0, 50.0 * sin(time*0.5) + 50.0, 220.0);
+    //eye = CAMERA_POS;                       // ray origin vec3(0, 0, -3);
+
+    mouseControl(eye, mouse);
+
+    vec3 target = vec3(0, 0, 0);
+
+    fwd  = normalize(target - eye);
+    side = normalize(cross(vec3(0, 1, 0), fwd));
+    up   = cross(fwd, side);
+}
+
+// ------------------------------------------------------------------------------------------------
+
+#if TEMPORAL == 2
+// relative depth difference above which two depths are different surfaces
+const float HISTORY_DEPTH_TOLERANCE = 0.05;
+
+// left, right, down, up
+const ivec2 NEIGHBOURS[4] = ivec2[4](ivec2(-1, 0), ivec2(1, 0), ivec2(0, -1), ivec2(0, 1));
+
+// Pixel of the frame parity: from the checkerboard pass. Other pixel: its depth is interpolated from its 4 neighbours
+// (shaded this frame) and its point reprojected with the previous camera. The previous color is kept if the
+// previous depth there is the same surface, clamped to the colors of the neighbours (no ghosting of moving edges).
+// Returns false when the pixel has to be shaded: border, silhouette, out of the previous frame, disocclusion.
+bool resolve(vec3 eye, vec3 rd) {
+    ivec2 pixel = ivec2(gl_FragCoord.xy);
+    ivec2 size = ivec2(u_resolution);
+
+    if (((pixel.x + pixel.y + u_frames) & 1) == 0) {
+        fragColor = texelFetch(u_shaded, ivec2(pixel.x >> 1, pixel.y), 0);
+        return true;
+    }
+
+    if (u_history_valid == 0 || any(equal(pixel, ivec2(0))) || any(equal(pixel, size - 1))) {
+        return false;
+    }
+
+    vec3 color_min = vec3(1.0);
+    vec3 color_max = vec3(0.0);
+    vec4 inv_depths;
+
+    for (int i = 0; i < 4; i++) {
+        vec4 neighbour = texelFetch(u_shaded, ivec2((pixel.x + NEIGHBOURS[i].x) >> 1, pixel.y + NEIGHBOURS[i].y), 0);
+
+        color_min = min(color_min, neighbour.rgb);
+        color_max = max(color_max, neighbour.rgb);
+        inv_depths[i] = 1.0 / neighbour.a;
+    }
+
+    // 1 / depth is about linear on the screen across a surface: the horizontal and vertical interpolations differ
+    // at a silhouette (the depth of the pixel is unknown), not on surfaces at grazing angles
+    float inv_x = 0.5 * (inv_depths[0] + inv_depths[1]);
+    float inv_y = 0.5 * (inv_depths[2] + inv_depths[3]);
+    if (abs(inv_x - inv_y) > HISTORY_DEPTH_TOLERANCE * max(inv_x, inv_y)) {
+        return false;
+    }
+    float depth = 2.0 / (inv_x + inv_y);
+
+    vec3 prev_eye, fwd, side, up;
+    get_camera(u_prev_mouse, u_prev_time, prev_eye, fwd, side, up);
+
+    vec3 v = eye + depth * rd - prev_eye;
+    float z = dot(v, fwd);
+    vec2 prev_coord = (vec2(dot(v, side), dot(v, up)) / z * u_resolution.y + u_resolution) * 0.5;
+
+    if (z <= 0.0 || any(lessThan(prev_coord, vec2(0.5))) || any(greaterThan(prev_coord, u_resolution - 0.5))) {
+        return false;
+    }
+
+    // filtered: the depth is a blend across the silhouettes, rejected
+    vec4 prev = texture(u_history, prev_coord / vec2(textureSize(u_history, 0)));
+    if (abs(prev.a - length(v)) > HISTORY_DEPTH_TOLERANCE * prev.a) {
+        return false;
+    }
+
+    fragColor = vec4(clamp(prev.rgb, color_min, color_max), depth);
+    return true;
+}
+#endif
+
 // ------------------------------------------------------------------------------------------------
 
 void main() {
-    vec2 uv = (gl_FragCoord.xy * 2. - u_resolution.xy) / u_resolution.y; // (0,0) at the center of the screen X and Y in [-1, 1]
+    vec2 frag_coord = gl_FragCoord.xy;
 
-    //vec2 uv0 = uv;                                // svg distance to the scene (original distance to the center of the canvas)
-    //uv = fract(uv*2) - 0.5;                       // repeat the screne
+#if PREPASS
+    // center ray of the tile
+    frag_coord = (floor(gl_FragCoord.xy) + 0.5) * TILE;
+#endif
 
-    vec3 eye = vec3(220.0, 50.0 * sin(u_time*0.5) + 50.0, 220.0);
-    //vec3 eye    = CAMERA_POS;                   // ray origin vec3(0, 0, -3);
+#if TEMPORAL == 1
+    // pixel of the frame parity in the row
+    frag_coord.x = 2.0 * floor(gl_FragCoord.x) + float((int(gl_FragCoord.y) + u_frames) & 1) + 0.5;
+#endif
 
-    mouseControl(eye);
+    vec2 uv = (frag_coord * 2. - u_resolution.xy) / u_resolution.y; // (0,0) at the center of the screen X and Y in [-1, 1]
 
-    vec3 target = vec3(0, 0, 0);
+    //vec2 uv0 = uv;                                // svg distance to the scene (original distance to the center of the canvas)
+    //uv = fract(uv*2) - 0.5;                       // repeat the screne
+
+    vec3 eye, fwd, side, up;
+    get_camera(u_mouse, u_time, eye, fwd, side, up);
 
-    vec3 fwd    = normalize(target - eye);
-    vec3 side   = normalize(cross(vec3(0, 1, 0), fwd));
-    vec3 up     = cross(fwd, side);
-    
     vec3 screen_pos = eye + (fwd + side * uv.x + up * uv.y);
     vec3 rd = normalize(screen_pos - eye); // <=> vec3 rd = getCam(eye, target) * normalize(vec3(uv, FOV));
 
     //vec3 rd = normalize(vec3(uv, 1));
 
-    float dist = shortest_distance_to_surface(eye, rd, MIN_DIST, MAX_DIST);
+#if PREPASS
+    // the rays of the tile are at most TILE / sqrt(2) pixels from the center one on the screen plane (1 unit from
+    // the eye), so their angle with it is below asin of that: cone slope with a 10% margin
+    float cone_k = 1.1 * (TILE * 0.7072 * 2.0 / u_resolution.y);
+    fragColor = vec4(cone_march(eye, rd, cone_k, MAX_DIST), float(march_steps), 0, 1);
+    return;
+#endif
+
+#if TEMPORAL == 2
+    gl_FragDepth = resolve(eye, rd) ? 1.0 : 0.0;
+#if STEP_STATS
+    stepCount = vec4(0, 0, 0, 1);
+#endif
+    return;
+#endif
+
+    float start = MIN_DIST;
+#if CONE_START
+    start = max(start, texelFetch(u_start_depth, ivec2(frag_coord) / TILE, 0).r);
+#endif
+
+    float dist = shortest_distance_to_surface(eye, rd, start, MAX_DIST);
+
+#if STEP_STATS
+    stepCount = vec4(float(march_steps), 0, 0, 1);
+#endif
 
     vec3 col = vec3(0);
     vec3 background = vec3(0.5, 0.8, 0.9);
@@ -319,4 +573,8 @@ void main() {
     }
 
     fragColor = vec4(col, 1);               // out pixel color
+
+#if TEMPORAL
+    fragColor.a = dist;
+#endif
 }
\ No newline at end of file
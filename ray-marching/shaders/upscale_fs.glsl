@@ -0,0 +1,17 @@
+#version 330 core
+
+layout(location = 0) out vec4 fragColor;
+
+uniform sampler2D u_texture;  // offscreen target, the frame is in its lower left u_region pixels
+uniform vec2      u_region;
+uniform vec2      u_screen;
+
+// bilinear upscale of the region to the window
+void main() {
+    vec2 pos = gl_FragCoord.xy / u_screen * u_region;
+
+    // no filtering with the texels outside of the region (previous frames of a larger scale)
+    pos = clamp(pos, vec2(0.5), u_region - 0.5);
+
+    fragColor = vec4(texture(u_texture, pos / vec2(textureSize(u_texture, 0))).rgb, 1.0);
+}
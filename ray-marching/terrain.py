@@ -0,0 +1,66 @@
+import os, math, time, hashlib
+
+import numpy as np
+
+from config import TERRAIN_CACHE_DIR, TERRAIN_SIZE, TERRAIN_RES
+
+# -----------------------------------------------------------------------------------------------------------
+# Heightmap of the terrain_fs.glsl terrain, baked once with NumPy: the shader samples it (with mipmaps) instead of
+# evaluating noise() + fbm() at each marching step.
+#
+# Port of dist_plane(p, 2.0) of the shader: the surface is at y = get_height(x, z).
+
+NUM_OCTAVES = 6
+BAKE_ROWS   = 256
+
+def noise(x, z):
+    return np.sin(x) + np.sin(z)
+
+def fbm(x, z):
+    res = np.zeros_like(x)
+    amp = np.float32(0.5)
+    freq = np.float32(1.95)
+
+    # p = p * freq * rot2D(PI / 4.0) - res * 0.4 (GLSL vector * matrix: p by the columns of rot2D)
+    c, s = np.float32(math.cos(math.pi / 4.0)), np.float32(math.sin(math.pi / 4.0))
+    for _ in range(NUM_OCTAVES):
+        res += amp * noise(x, z)
+        amp *= np.float32(0.5)
+        x, z = (x * c - z * s) * freq - res * np.float32(0.4), (x * s + z * c) * freq - res * np.float32(0.4)
+
+    return res
+
+def get_height(x, z, h=2.0):
+    n = noise(x * np.float32(0.01), z * np.float32(0.01))
+    return -(80.0 * n + 20.0 * fbm(x * np.float32(0.1), z * np.float32(0.1)) * n + 20.0 + h).astype(np.float32)
+
+def bake_heightmap(size=TERRAIN_SIZE, res=TERRAIN_RES):
+    # (res, res) float32, row j / column i: height at the texel center (x, z) = ((i, j) + 0.5) * size / res - size / 2
+    coords = ((np.arange(res, dtype=np.float32) + 0.5) * np.float32(size / res) - np.float32(size / 2)).astype(np.float32)
+    heights = np.empty((res, res), dtype=np.float32)
+
+    for row in range(0, res, BAKE_ROWS):
+        z, x = np.meshgrid(coords[row:row + BAKE_ROWS], coords, indexing='ij')
+        heights[row:row + BAKE_ROWS] = get_height(x, z)
+
+    return heights
+
+def load_heightmap(size=TERRAIN_SIZE, res=TERRAIN_RES, cache_dir=TERRAIN_CACHE_DIR):
+    """Heightmap of the terrain, baked on the first call for a (size, res) then loaded from the cache."""
+    with open(__file__, "rb") as file:
+        key = hashlib.sha256(file.read() + repr((size, res)).encode()).hexdigest()[:32]
+    path = os.path.join(cache_dir, f"{key}.npy")
+
+    if os.path.exists(path):
+        return np.load(path)
+
+    t0 = time.perf_counter()
+    heights = bake_heightmap(size, res)
+    print("Terrain baked: %dx%d texels in %.2f s" % (res, res, time.perf_counter() - t0))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, heights)
+    os.replace(tmp_path, path)
+
+    return heights
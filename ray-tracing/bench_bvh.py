@@ -0,0 +1,79 @@
+import os, sys, json, time, argparse, subprocess, tempfile
+
+import numpy as np
+
+from config import SCENE_BOX, BVH_BINS, BVH_LEAF_SIZE, BVH_STACK
+from bvh import get_random_primitives, build_bvh
+
+# -----------------------------------------------------------------------------------------------------------
+# Benchmark of the BVH against the brute force loop on random scenes (half spheres, half triangles)
+#
+#   build: build_bvh time (best of --builds)
+#   trace: median frame time of main.py --headless --sync (after the warm-up frames), BVH and --brute_force
+#
+# The frame time is used rather than the "compute" timer query: the brute force dispatches are long enough for
+# some drivers (llvmpipe) to report a partial GPU time.
+
+def bench_build(nb_primitive, nb_builds):
+    primitives = get_random_primitives(nb_primitive, *SCENE_BOX, seed=0)
+
+    times = []
+    for _ in range(nb_builds):
+        t0 = time.perf_counter()
+        nodes, _ = build_bvh(primitives, nb_bins=BVH_BINS, max_leaf_size=BVH_LEAF_SIZE, max_depth=BVH_STACK)
+        times.append(time.perf_counter() - t0)
+
+    return 1000 * min(times), len(nodes)
+
+def bench_trace(nb_primitive, size, warmup, frames, brute_force):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        timings_file = os.path.join(tmp_dir, "timings.json")
+
+        cmd = [sys.executable, "main.py", "--headless", "--sync", f"--frames={warmup + frames}", f"--timings={timings_file}",
+               f"--size={size}", f"--primitives={nb_primitive}", "--seed=0"]
+        if brute_force:
+            cmd.append("--brute_force")
+
+        process = subprocess.run(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if process.returncode != 0:
+            print(process.stdout + process.stderr)
+            raise RuntimeError(f"{' '.join(cmd)} failed")
+
+        with open(timings_file) as file:
+            records = json.load(file)[warmup:]
+
+    return float(np.median([record["frame_ms"] for record in records]))
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 bench_bvh.py
+# python3 bench_bvh.py --primitives 1000 10000 --size=640x400 --frames=20
+# python3 bench_bvh.py --primitives 1000000 --no_brute_force
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('--primitives', help='Scene sizes', nargs='+', default=[1000, 10000, 100000], type=int)
+    parser.add_argument('--size', help='Screen size WxH of the traced frames', default="160x100", type=str)
+    parser.add_argument('--builds', help='Number of BVH builds per scene (best time kept)', default=3, type=int)
+    parser.add_argument('--warmup', help='Warm-up frames, not measured', default=1, type=int)
+    parser.add_argument('--frames', help='Measured frames', default=3, type=int)
+    parser.add_argument('--no_brute_force', help='Skip the brute force frames (slow on large scenes)', action='store_true')
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    for nb_primitive in args["primitives"]:
+        build_ms, nb_nodes = bench_build(nb_primitive, args["builds"])
+        bvh_ms = bench_trace(nb_primitive, args["size"], args["warmup"], args["frames"], brute_force=False)
+
+        line = f"{nb_primitive:8d} primitives: build {build_ms:9.1f} ms ({nb_nodes} nodes) | BVH frame {bvh_ms:9.1f} ms"
+
+        if not args["no_brute_force"]:
+            brute_force_ms = bench_trace(nb_primitive, args["size"], args["warmup"], args["frames"], brute_force=True)
+            line += f" | brute force frame {brute_force_ms:9.1f} ms | x{brute_force_ms / bvh_ms:.1f}"
+
+        print(line, flush=True)
+
+if __name__ == "__main__":
+    main()
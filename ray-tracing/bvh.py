@@ -0,0 +1,196 @@
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# Bounding volume hierarchy of spheres / triangles, built with binned SAH (NumPy), flattened for std430 SSBOs.
+#
+# struct Node                                      struct Primitive
+# {                                                {
+#     vec3 bmin;  int left_first;                      vec4 a;  // sphere: center, type | triangle: v0, type
+#     vec3 bmax;  int count;                           vec4 b;  // sphere: radius       | triangle: v1
+# };                                               vec4 c;  //                      | triangle: v2
+#                                                  };
+# count == 0: interior node, children at left_first and left_first + 1
+# count  > 0: leaf, primitives [left_first, left_first + count[
+
+NODE_DTYPE      = np.dtype([('bmin', 'f4', 3), ('left_first', 'i4'), ('bmax', 'f4', 3), ('count', 'i4')])
+PRIMITIVE_DTYPE = np.dtype([('a', 'f4', 4), ('b', 'f4', 4), ('c', 'f4', 4)])
+
+SPHERE   = 0
+TRIANGLE = 1
+
+def make_primitives(spheres=None, triangles=None):
+    # spheres: (n, 4) center + radius, triangles: (m, 3, 3) vertices
+    spheres = np.zeros((0, 4), dtype=np.float32) if spheres is None else np.asarray(spheres, dtype=np.float32).reshape(-1, 4)
+    triangles = np.zeros((0, 3, 3), dtype=np.float32) if triangles is None else np.asarray(triangles, dtype=np.float32).reshape(-1, 3, 3)
+
+    primitives = np.zeros(len(spheres) + len(triangles), dtype=PRIMITIVE_DTYPE)
+
+    prims = primitives[:len(spheres)]
+    prims['a'][:, :3] = spheres[:, :3]
+    prims['a'][:, 3]  = SPHERE
+    prims['b'][:, 0]  = spheres[:, 3]
+
+    prims = primitives[len(spheres):]
+    prims['a'][:, :3] = triangles[:, 0]
+    prims['a'][:, 3]  = TRIANGLE
+    prims['b'][:, :3] = triangles[:, 1]
+    prims['c'][:, :3] = triangles[:, 2]
+
+    return primitives
+
+def get_random_primitives(nb_primitive, bmin, bmax, seed=None):
+    # half spheres, half triangles, sized so that the scene box stays about as full whatever the count
+    rng = np.random.default_rng(seed)
+    bmin, bmax = np.asarray(bmin), np.asarray(bmax)
+    size = 0.5 * (np.prod(bmax - bmin) / max(nb_primitive, 1)) ** (1.0 / 3.0)
+
+    nb_sphere = nb_primitive // 2
+    spheres = np.column_stack([rng.uniform(bmin, bmax, (nb_sphere, 3)), rng.uniform(0.3, 1.0, nb_sphere) * size])
+
+    nb_triangle = nb_primitive - nb_sphere
+    triangles = rng.uniform(bmin, bmax, (nb_triangle, 1, 3)) + rng.uniform(-2.0 * size, 2.0 * size, (nb_triangle, 3, 3))
+
+    return make_primitives(spheres, triangles)
+
+def get_bounds(primitives):
+    # (n, 3) min and max corners of the primitives
+    a, b, c = primitives['a'][:, :3], primitives['b'][:, :3], primitives['c'][:, :3]
+    is_sphere = (primitives['a'][:, 3] == SPHERE)[:, None]
+    radius = primitives['b'][:, :1]
+
+    bmin = np.where(is_sphere, a - radius, np.minimum(np.minimum(a, b), c))
+    bmax = np.where(is_sphere, a + radius, np.maximum(np.maximum(a, b), c))
+    return bmin, bmax
+
+def get_area(bmin, bmax):
+    # half surface area of boxes (the SAH only compares ratios)
+    d = bmax - bmin
+    return d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0]
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_segment_starts(counts):
+    return np.cumsum(counts) - counts
+
+def build_bvh(primitives, nb_bins=16, max_leaf_size=4, max_depth=32):
+    """Binned SAH BVH of the primitives.
+
+    The tree is built breadth first: all the nodes of a level are binned / split at once with segmented
+    NumPy operations (the primitives of a node are contiguous in `work`), so the Python loop runs once per
+    level instead of once per node. Nodes of at most max_leaf_size primitives become leaves, the others are
+    split at the best SAH bin boundary (traversal and intersection costs of 1) unless no split is cheaper.
+    The depth is capped to max_depth, the size of the traversal stack of the shader.
+
+    Returns the nodes (NODE_DTYPE, root first, children of a node next to each other) and the primitives
+    reordered so that each leaf references a contiguous range.
+    """
+    n = len(primitives)
+    bmin, bmax = get_bounds(primitives)
+    centroids = 0.5 * (bmin + bmax)
+
+    nodes = np.zeros(max(2 * n - 1, 1), dtype=NODE_DTYPE)
+    nb_nodes = 1
+
+    order = []
+    nb_ordered = 0
+
+    # nodes of the current level: index, number of primitives, primitives (contiguous per node)
+    level_nodes = np.zeros(1, dtype=np.int64)
+    level_counts = np.array([n])
+    work = np.arange(n)
+
+    for depth in range(1, max_depth + 1):
+        k = len(level_nodes)
+        starts = get_segment_starts(level_counts)
+        segment = np.repeat(np.arange(k), level_counts)
+
+        work_min, work_max, work_centroids = bmin[work], bmax[work], centroids[work]
+
+        node_min = np.minimum.reduceat(work_min, starts)
+        node_max = np.maximum.reduceat(work_max, starts)
+        nodes['bmin'][level_nodes] = node_min
+        nodes['bmax'][level_nodes] = node_max
+
+        # binning of the centroids of each node, on the 3 axes
+        cmin = np.minimum.reduceat(work_centroids, starts)
+        extent = np.maximum.reduceat(work_centroids, starts) - cmin
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(extent > 0, nb_bins / extent, 0.0)
+        bins = np.minimum(((work_centroids - cmin[segment]) * scale[segment]).astype(np.int64), nb_bins - 1)
+
+        costs = np.full((3, k, nb_bins - 1), np.inf)
+        for axis in range(3):
+            keys = segment * nb_bins + bins[:, axis]
+            counts = np.bincount(keys, minlength=k * nb_bins)
+
+            sorted_keys = np.argsort(keys, kind='stable')
+            non_empty = counts > 0
+            key_starts = get_segment_starts(counts)[non_empty]
+
+            bin_min = np.full((k * nb_bins, 3), np.inf, dtype=np.float32)
+            bin_max = np.full((k * nb_bins, 3), -np.inf, dtype=np.float32)
+            bin_min[non_empty] = np.minimum.reduceat(work_min[sorted_keys], key_starts)
+            bin_max[non_empty] = np.maximum.reduceat(work_max[sorted_keys], key_starts)
+
+            counts, bin_min, bin_max = counts.reshape(k, nb_bins), bin_min.reshape(k, nb_bins, 3), bin_max.reshape(k, nb_bins, 3)
+
+            # split i: bins [0, i] on the left, ]i, nb_bins[ on the right
+            left_count = np.cumsum(counts, axis=1)[:, :-1]
+            right_count = level_counts[:, None] - left_count
+            left_area = get_area(np.minimum.accumulate(bin_min, axis=1)[:, :-1], np.maximum.accumulate(bin_max, axis=1)[:, :-1])
+            right_area = get_area(np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, ::-1][:, 1:],
+                                  np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, ::-1][:, 1:])
+
+            with np.errstate(invalid='ignore'):
+                valid = (left_count > 0) & (right_count > 0)
+                costs[axis] = np.where(valid, left_area * left_count + right_area * right_count, np.inf)
+
+        costs = costs.transpose(1, 0, 2).reshape(k, -1)
+        best = np.argmin(costs, axis=1)
+        best_cost = costs[np.arange(k), best]
+        best_axis, best_split = best // (nb_bins - 1), best % (nb_bins - 1)
+
+        node_area = get_area(node_min, node_max)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sah_cost = 1.0 + best_cost / node_area
+
+        has_split = np.isfinite(best_cost)
+        is_leaf = (level_counts <= max_leaf_size) | (depth == max_depth) | (has_split & (sah_cost >= level_counts) & (level_counts <= 4 * max_leaf_size))
+
+        # leaves: their primitives are appended to the reordered list
+        leaves = np.flatnonzero(is_leaf)
+        nodes['left_first'][level_nodes[leaves]] = nb_ordered + get_segment_starts(level_counts[leaves])
+        nodes['count'][level_nodes[leaves]] = level_counts[leaves]
+
+        leaf_elements = is_leaf[segment]
+        order.append(work[leaf_elements])
+        nb_ordered += int(level_counts[leaves].sum())
+
+        splits = np.flatnonzero(~is_leaf)
+        if len(splits) == 0:
+            break
+
+        # interior nodes: children allocated next to each other
+        children = nb_nodes + 2 * np.arange(len(splits))
+        nodes['left_first'][level_nodes[splits]] = children
+        nodes['count'][level_nodes[splits]] = 0
+        nb_nodes += 2 * len(splits)
+
+        # side of each primitive (0: left, 1: right), halves of the node when all its centroids are at the same point
+        split_index = np.full(k, -1)
+        split_index[splits] = np.arange(len(splits))
+
+        element_axis = best_axis[segment]
+        side = bins[np.arange(len(work)), element_axis] > best_split[segment]
+        rank = np.arange(len(work)) - starts[segment]
+        side = np.where(has_split[segment], side, rank >= level_counts[segment] // 2)
+
+        split_elements = ~leaf_elements
+        child_keys = 2 * split_index[segment[split_elements]] + side[split_elements]
+        sorted_children = np.argsort(child_keys, kind='stable')
+
+        work = work[split_elements][sorted_children]
+        level_counts = np.bincount(child_keys, minlength=2 * len(splits))
+        level_nodes = np.stack([children, children + 1], axis=1).reshape(-1)
+
+    return nodes[:nb_nodes], primitives[np.concatenate(order)]
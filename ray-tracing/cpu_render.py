@@ -0,0 +1,307 @@
+import os, time, random, argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from config import *
+from bvh import SPHERE as SPHERE_TYPE
+from scene_loader import load_scene, get_view_pos
+
+# -----------------------------------------------------------------------------------------------------------
+# CPU renderer of the ray_cs.glsl frame (without OpenGL): the frame is split in tiles of CPU_TILE x CPU_TILE pixels
+# rendered by a pool of processes into a shared memory framebuffer. The rays of a tile are traced as NumPy batches:
+# sphere / triangle tests of intersect_primitive(), BVH traversed by packets (the rays of a tile still in a node box),
+# normal shading of trace().
+#
+# float32 arithmetic as the shader, the pixels differ from the GPU ones where the order of the float operations
+# decides a hit (silhouettes, edges shared by 2 triangles).
+
+INF     = np.float32(1e30)
+EPSILON = np.float32(1e-4)
+
+BACKGROUND = np.array([0.075, 0.133, 0.173], dtype=np.float32)
+
+def quantize(colors):
+    # float => rgba8 texel (UNORM: clamped to [0, 1], rounded to the nearest of the 256 levels)
+    return np.rint(np.clip(colors, 0.0, 1.0) * np.float32(255.0)).astype(np.uint8)
+
+def dot(a, b):
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+def cross(a, b):
+    return np.stack([a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+                     a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+                     a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]], axis=-1)
+
+def intersect_primitives(primitives, ray_o, ray_d):
+    # (nb ray, nb primitive) distances along the rays of origin ray_o, INF if missed
+    t = np.full((len(ray_d), len(primitives)), INF, dtype=np.float32)
+    is_sphere = primitives['a'][:, 3] == SPHERE_TYPE
+
+    spheres = primitives[is_sphere]
+    if len(spheres):
+        o_c = ray_o - spheres['a'][:, :3]
+        b = ray_d @ o_c.T
+        c = dot(o_c, o_c) - spheres['b'][:, 0] * spheres['b'][:, 0]
+        h = b * b - c
+
+        with np.errstate(invalid='ignore'):
+            h = np.sqrt(h)
+            t_sphere = np.where(-b - h > EPSILON, -b - h, -b + h)
+        t[:, is_sphere] = np.where((h >= 0.0) & (t_sphere > EPSILON), t_sphere, INF)
+
+    # Moller-Trumbore, the terms of the origin computed once per triangle
+    triangles = primitives[~is_sphere]
+    if len(triangles):
+        a = triangles['a'][:, :3]
+        e1 = triangles['b'][:, :3] - a
+        e2 = triangles['c'][:, :3] - a
+        p = cross(ray_d[:, None, :], e2[None, :, :])
+        det = dot(e1[None], p)
+
+        s = ray_o - a
+        q = cross(s, e1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = np.float32(1.0) / det
+            u = dot(s[None], p) * inv_det
+            v = (ray_d @ q.T) * inv_det
+            t_triangle = dot(e2, q) * inv_det
+
+            hit = (np.abs(det) >= 1e-8) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t_triangle > EPSILON)
+        t[:, ~is_sphere] = np.where(hit, t_triangle, INF)
+
+    return t
+
+def intersect_box(bmin, bmax, ray_o, inv_d, t_max):
+    # slab test: entry distances in the box, INF if missed or farther than t_max
+    with np.errstate(invalid='ignore'):
+        t0 = (bmin - ray_o) * inv_d
+        t1 = (bmax - ray_o) * inv_d
+    t_near = np.minimum(t0, t1)
+    t_far = np.maximum(t0, t1)
+
+    t_enter = np.maximum(np.maximum(t_near[:, 0], t_near[:, 1]), np.maximum(t_near[:, 2], np.float32(0.0)))
+    t_exit = np.minimum(np.minimum(t_far[:, 0], t_far[:, 1]), np.minimum(t_far[:, 2], t_max))
+
+    return np.where(t_enter <= t_exit, t_enter, INF)
+
+class TileRenderer:
+    """Scene and camera of the frame, traces the rays of a tile (a worker of CPURenderer per process)."""
+
+    def __init__(self, nodes, primitives, cam_pos, screen_width, screen_height, brute_force=False):
+        self.primitives = primitives
+        self.cam_pos = np.asarray(cam_pos, dtype=np.float32)
+
+        # nodes as plain arrays / lists (no record access per visited node), distances of their centers to the camera
+        self.bmin, self.bmax = nodes['bmin'], nodes['bmax']
+        self.left_first, self.count = nodes['left_first'].tolist(), nodes['count'].tolist()
+        self.node_distances = np.linalg.norm(0.5 * (self.bmin + self.bmax) - self.cam_pos, axis=1).tolist()
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.brute_force = brute_force
+
+    def update_hits(self, t_hit, hit, rays, first, t):
+        # closest of the primitives [first, first + n[ (the first one on a tie, as the loops of the shader)
+        best = np.argmin(t, axis=1)
+        t_best = t[np.arange(len(rays)), best]
+
+        closer = t_best < t_hit[rays]
+        t_hit[rays[closer]] = t_best[closer]
+        hit[rays[closer]] = first + best[closer]
+
+    def intersect_scene(self, ray_d):
+        # closest primitive along the rays: t, index (-1 if none)
+        t_hit = np.full(len(ray_d), INF, dtype=np.float32)
+        hit = np.full(len(ray_d), -1, dtype=np.int64)
+
+        if self.brute_force:
+            all_rays = np.arange(len(ray_d))
+            for first in range(0, len(self.primitives), CPU_PRIMITIVE_CHUNK):
+                t = intersect_primitives(self.primitives[first:first + CPU_PRIMITIVE_CHUNK], self.cam_pos, ray_d)
+                self.update_hits(t_hit, hit, all_rays, first, t)
+            return t_hit, hit
+
+        with np.errstate(divide='ignore'):
+            inv_d = np.float32(1.0) / ray_d
+
+        # packets: a node and the rays that reached it, the nearer child popped first
+        stack = [(0, np.arange(len(ray_d)))]
+        while stack:
+            node, rays = stack.pop()
+
+            rays = rays[intersect_box(self.bmin[node], self.bmax[node], self.cam_pos, inv_d[rays], t_hit[rays]) < INF]
+            if len(rays) == 0:
+                continue
+
+            first, count = self.left_first[node], self.count[node]
+            if count > 0:
+                t = intersect_primitives(self.primitives[first:first + count], self.cam_pos, ray_d[rays])
+                self.update_hits(t_hit, hit, rays, first, t)
+            else:
+                near, far = first, first + 1
+                if self.node_distances[near] > self.node_distances[far]:
+                    near, far = far, near
+                stack += [(far, rays), (near, rays)]
+
+        return t_hit, hit
+
+    def get_normals(self, primitives, pos):
+        a = primitives['a'][:, :3]
+        normals = np.where((primitives['a'][:, 3] == SPHERE_TYPE)[:, None], pos - a,
+                           cross(primitives['b'][:, :3] - a, primitives['c'][:, :3] - a))
+        return normals / np.linalg.norm(normals, axis=1, keepdims=True)
+
+    def render(self, x0, y0, x1, y1):
+        """(y1 - y0, x1 - x0, 4) uint8 RGBA pixels of the tile, bottom row first (pixel centers of trace())."""
+        px, py = np.meshgrid(np.arange(x0, x1, dtype=np.float32) + np.float32(0.5), np.arange(y0, y1, dtype=np.float32) + np.float32(0.5))
+        width, height = np.float32(self.screen_width), np.float32(self.screen_height)
+
+        x = (px.ravel() * np.float32(2.0) - width) / width
+        y = (py.ravel() * np.float32(2.0) - height) / width
+        ray_d = np.stack([x, y, np.full_like(x, -1.0)], axis=1)
+        ray_d /= np.linalg.norm(ray_d, axis=1, keepdims=True)
+
+        t_hit, hit = self.intersect_scene(ray_d)
+
+        colors = np.tile(BACKGROUND, (len(ray_d), 1))
+        is_hit = hit >= 0
+        if is_hit.any():
+            rays = ray_d[is_hit]
+            normals = self.get_normals(self.primitives[hit[is_hit]], self.cam_pos + rays * t_hit[is_hit, None])
+
+            # triangles are seen from both sides (faceforward)
+            normals = np.where((dot(normals, rays) < 0.0)[:, None], normals, -normals)
+            colors[is_hit] = (normals + np.float32(1.0)) / np.float32(2.0)
+
+        pixels = np.empty((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        pixels[..., :3] = quantize(colors).reshape(y1 - y0, x1 - x0, 3)
+        pixels[..., 3] = 255
+        return pixels
+
+# -----------------------------------------------------------------------------------------------------------
+
+# process state of the pool workers
+worker = {}
+
+def init_worker(shm_name, shape, renderer):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    worker["shm"] = shm
+    worker["frame"] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    worker["renderer"] = renderer
+
+def render_tile(tile):
+    x0, y0, x1, y1 = tile
+    worker["frame"][y0:y1, x0:x1] = worker["renderer"].render(x0, y0, x1, y1)
+
+class CPURenderer:
+    """Frame of a TileRenderer rendered by a pool of processes (one tile at a time each) into shared memory."""
+
+    def __init__(self, renderer, processes=None, tile_size=CPU_TILE):
+        width, height = renderer.screen_width, renderer.screen_height
+        self.shape = (height, width, 4)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=height * width * 4)
+        self.frame = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        # the scene is handed over once per process (inherited when forked)
+        self.processes = processes or os.cpu_count()
+        self.pool = mp.Pool(self.processes, initializer=init_worker, initargs=(self.shm.name, self.shape, renderer))
+
+        self.tiles = [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+    def render(self):
+        """(height, width, 4) uint8 RGBA frame, top-down as App.frames()."""
+        for _ in self.pool.imap_unordered(render_tile, self.tiles):
+            pass
+        return self.frame[::-1].copy()
+
+    def release(self):
+        self.pool.close()
+        self.pool.join()
+        del self.frame
+        self.shm.close()
+        self.shm.unlink()
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_gpu_frame(args, seed):
+    # OpenGL only for --compare
+    from main import App
+
+    screen_width, screen_height = args["size"]
+    app = App(screen_width=screen_width, screen_height=screen_height, headless=True, nb_primitive=args["primitives"], seed=seed,
+              brute_force=args["brute_force"], mesh=args["mesh"])
+    frame = next(app.frames(1)).copy()
+    app.quit()
+    return frame
+
+def compare(cpu_frame, gpu_frame, tolerance):
+    diff = np.abs(cpu_frame.astype(np.int16) - gpu_frame).max(axis=2)
+    return int(diff.max()), float(diff.mean()), np.count_nonzero(diff > tolerance) / diff.size
+
+# -----------------------------------------------------------------------------------------------------------
+# python3 cpu_render.py --size=640x400 --output=frame.png
+# python3 cpu_render.py --primitives=10000 --seed=42 --processes 1 2 4 8
+# python3 cpu_render.py --primitives=1000 --seed=42 --compare
+
+def main():
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('--primitives', help='Number of random spheres / triangles, 0 for the single sphere scene', default=0, type=int)
+    parser.add_argument('-s', '--seed', help='Seed of the random scene, random if not set', default=None, type=int)
+    parser.add_argument('--mesh', help='Triangle mesh to trace (.ply / .obj), replaces the random scene', default="", type=str)
+    parser.add_argument('--brute_force', help='Intersect every primitive instead of traversing the BVH', action='store_true')
+    parser.add_argument('--processes', help='Numbers of processes to time (default: 1 per core)', nargs='+', default=[os.cpu_count()], type=int)
+    parser.add_argument('--tile', help='Tile size (pixels)', default=CPU_TILE, type=int)
+    parser.add_argument('--frames', help='Rendered frames per number of processes (best time kept)', default=1, type=int)
+    parser.add_argument('--output', help='Save the CPU frame to an image file', default="", type=str)
+    parser.add_argument('--compare', help='Render the frame on the GPU (headless) too and compare the pixels', action='store_true')
+    parser.add_argument('--tolerance', help='--compare: max difference of a pixel channel (/255)', default=1, type=int)
+    parser.add_argument('--max_off', help='--compare: max fraction of the pixels off by more than the tolerance', default=0.01, type=float)
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    screen_width, screen_height = args["size"]
+    seed = args["seed"] if args["seed"] is not None else random.getrandbits(32)
+
+    nodes, primitives, bounds = load_scene(args["primitives"], seed, args["mesh"], args["brute_force"])
+    cam_pos = get_view_pos(bounds) if args["mesh"] else CAM_POS
+
+    renderer = TileRenderer(nodes, np.asarray(primitives), tuple(cam_pos), screen_width, screen_height, brute_force=args["brute_force"])
+
+    base = None
+    for processes in args["processes"]:
+        cpu_renderer = CPURenderer(renderer, processes=processes, tile_size=args["tile"])
+
+        times = []
+        for _ in range(args["frames"]):
+            t0 = time.perf_counter()
+            frame = cpu_renderer.render()
+            times.append(time.perf_counter() - t0)
+
+        cpu_renderer.release()
+
+        # scaling: speedup over the first number of processes, relative to the ratio of the numbers of processes
+        elapsed = min(times)
+        base = base or (elapsed, processes)
+        speedup = base[0] / elapsed
+        print(f"{processes:3d} process(es): {1000 * elapsed:9.1f} ms/frame ({screen_width * screen_height / elapsed / 1e6:.3f} Mrays/s) | x{speedup:.2f}, {100 * speedup * base[1] / processes:.0f}% of linear")
+
+    if args["output"]:
+        import cv2
+        cv2.imwrite(args["output"], cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR))
+
+    if args["compare"]:
+        max_diff, mean_diff, off = compare(frame, get_gpu_frame(args, seed), args["tolerance"])
+        print(f"GPU / CPU frames: max diff {max_diff}/255, mean diff {mean_diff:.4f}/255, {100 * off:.4f}% pixels off by more than {args['tolerance']}/255")
+
+        if off > args["max_off"]:
+            raise SystemExit(f"GPU / CPU frames disagree: {100 * off:.4f}% pixels > {100 * args['max_off']:.4f}%")
+
+if __name__ == "__main__":
+    main()
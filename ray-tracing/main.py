@@ -1,4 +1,4 @@
-import sys, argparse, random
+import os, sys, argparse, random
 
 import pygame as pg
 import numpy as np
@@ -7,20 +7,63 @@ import glm
 from array import array
 
 from config import *
-from shader_program import ShaderProgram
+from shader_program import ShaderProgram, setup_shader_cache
+from scene_loader import load_scene, get_view_pos
+
+# -----------------------------------------------------------------------------------------------------------
+
+class Scene:
+
+    def __init__(self, app):
+        self.app = app
+        self.ctx = app.ctx
+
+        nodes, primitives, self.bounds = load_scene(self.app.nb_primitive, self.app.seed, self.app.mesh, self.app.brute_force)
+        self.nb_primitive = len(primitives)
+
+        self.ssbo_nodes      = self.get_buffer(nodes)
+        self.ssbo_primitives = self.get_buffer(primitives)
+
+    def destroy(self):
+        self.ssbo_nodes.release()
+        self.ssbo_primitives.release()
+
+    def get_buffer(self, array):
+        # uploaded MESH_CHUNK bytes at a time: only one chunk of a memory-mapped array is paged in per write
+        buffer = self.ctx.buffer(reserve=array.nbytes)
+
+        step = max(MESH_CHUNK // array.itemsize, 1)
+        for start in range(0, len(array), step):
+            buffer.write(array[start:start + step], offset=start * array.itemsize)
+
+        return buffer
 
 # -----------------------------------------------------------------------------------------------------------
 
 class App:
 
-    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, fps=-1, record_video="", video_fps=60):
+    def __init__(self, screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, fps=-1, record_video="", video_fps=60, readback_buffers=3, headless=False, frames=-1, hot_reload=False, timings="", group_size=None, autotune=False, sync=False, accumulate=False, nb_primitive=0, seed=None, brute_force=False, mesh=""):
 
         self.screen_width = screen_width
         self.screen_height = screen_height
         self.max_fps = fps
 
+        self.headless = headless
+        self.max_frames = frames
+        self.hot_reload = hot_reload
+        self.timings = timings
+        self.sync = sync
+        self.accumulate = accumulate
+        self.nb_primitive = nb_primitive
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.brute_force = brute_force
+        self.mesh = mesh
+        self.group_size = group_size
+        self.autotune = autotune
+
         self.record_video = record_video
         self.video_fps = video_fps
+        self.readback_buffers = readback_buffers
 
         if self.record_video:
             if self.record_video in ("XVID", "h264", "avc1", "mp4v"):
@@ -29,42 +72,59 @@ class App:
                 self.video_recorder = ScreenRecorder(self.screen_width, self.screen_height, self.video_fps)
 
         #
-        print("SCREEN WIDTH =", SCREEN_WIDTH)
-        print("SCREEN HEIGHT=", SCREEN_HEIGHT)
-
-        print("X LOCAL  GROUPSIZE=", XGROUPSIZE)
-        print("Y LOCAL  GROUPSIZE=", YGROUPSIZE)
-        print("Z LOCAL  GROUPSIZE=", ZGROUPSIZE)
-        print("X GLOBAL GROUPSIZE=", SCREEN_WIDTH // XGROUPSIZE)
-        print("Y GLOBAL GROUPSIZE=", SCREEN_HEIGHT // YGROUPSIZE)
-        print("Z GLOBAL GROUPSIZE=", 1)
+        print("SCREEN WIDTH =", self.screen_width)
+        print("SCREEN HEIGHT=", self.screen_height)
+        print("PRIMITIVES   =", self.nb_primitive)
+        print("SEED=", self.seed)
 
         #
         self.lastTime = time.time()
         self.currentTime = time.time()
         self.pause = False
 
+        # camera / scene uniforms last sent to the compute shader, number of accumulated samples
+        self.cam_pos = glm.vec3(CAM_POS)
+        self.scene_uniforms = None
+        self.frame_index = 0
+
         self.fps = FPSCounter()
 
         # pygame init
+        if self.headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+        # persistent shader binaries, before the OpenGL context creation
+        setup_shader_cache()
+
         pg.init()
 
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
-        pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
+        if self.headless:
+            # OpenGL context without window (EGL), rendering into an offscreen framebuffer
+            self.ctx = mgl.create_context(standalone=True, require=430, backend=HEADLESS_BACKEND)
 
-        pg_flags = pg.OPENGL | pg.DOUBLEBUF
-        if FULLSCREEN:
-            pg_flags |= pg.FULLSCREEN
+            self.fbo = self.ctx.simple_framebuffer((self.screen_width, self.screen_height), components=4)
+            self.fbo.use()
+        else:
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 4)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_MINOR_VERSION, 3)
+            pg.display.gl_set_attribute(pg.GL_CONTEXT_PROFILE_MASK, pg.GL_CONTEXT_PROFILE_CORE)
 
-        pg.display.set_mode((self.screen_width, self.screen_height), flags=pg_flags)
+            pg_flags = pg.OPENGL | pg.DOUBLEBUF
+            if FULLSCREEN:
+                pg_flags |= pg.FULLSCREEN
 
-        pg.event.set_grab(GRAB_MOUSE)
-        pg.mouse.set_visible(True)
+            pg.display.set_mode((self.screen_width, self.screen_height), flags=pg_flags)
+
+            pg.event.set_grab(GRAB_MOUSE)
+            pg.mouse.set_visible(True)
+
+            # OpenGL context / options
+            self.ctx = mgl.create_context()
+            self.fbo = self.ctx.screen
+
+        # GPU time per pass (timer queries) + CPU time of flip / readback
+        self.timer = PassTimer(self.ctx, keep_records=bool(self.timings))
 
-        # OpenGL context / options
-        self.ctx = mgl.create_context()
-        
         self.ctx.wireframe = False
         #self.ctx.front_face = 'cw'
         #self.ctx.enable(flags=mgl.DEPTH_TEST)
@@ -87,20 +147,61 @@ class App:
             1.0, -1.0, 1.0, 0.0,  # br
         ]
 
-        quad_buffer = self.ctx.buffer(data=np.array(quad, dtype='f4'))
+        self.quad_buffer = self.ctx.buffer(data=np.array(quad, dtype='f4'))
+        self.quad_vao = None
 
-        self.all_shaders = ShaderProgram(self.ctx)
-        self.quad_program = self.all_shaders.get_program("quad")
+        # local work group size: --group_size, else the winner of a previous --autotune on this device, else config.py
+        self.tuner = GroupSizeTuner(self.ctx)
+        self.xgroupsize, self.ygroupsize = self.group_size or self.tuner.get("ray") or (XGROUPSIZE, YGROUPSIZE)
 
-        # compute shader
-        with open(f'shaders/ray_cs.glsl') as file:
-            compute_shader_source = file.read()
+        self.all_shaders = ShaderProgram(self.ctx, watch=self.hot_reload, group_size=(self.xgroupsize, self.ygroupsize, ZGROUPSIZE))
+        self.load_programs()
+
+        # primitives + BVH nodes (SSBOs)
+        self.scene = Scene(self)
+
+        if self.mesh:
+            self.cam_pos = get_view_pos(self.scene.bounds)
+
+        self.texture = self.ctx.texture((int(self.screen_width/1), int(self.screen_height/1)), 4, dtype='f1')
+        self.texture.filter = mgl.NEAREST, mgl.NEAREST # because when we access the image from a CS it is an Image2D (not Sampler2D)
+        #self.texture.bind_to_image(0, read=False, write=True)
+
+        # progressive rendering: running average of the samples, in float
+        if self.accumulate:
+            self.accum_texture = self.ctx.texture((self.screen_width, self.screen_height), 4, dtype='f4')
+            self.accum_texture.filter = mgl.NEAREST, mgl.NEAREST
+
+        if self.record_video:
+            self.readback = AsyncReadback(self.ctx, self.screen_width, self.screen_height, nb_buffers=self.readback_buffers)
+
+        # --autotune: the candidate frames are not timed (the accumulation restarts with the winner's programs)
+        if self.autotune:
+            with self.timer.disabled():
+                self.set_group_size(self.tuner.tune("ray", self.run_group_size))
+            self.all_shaders.prune()
+
+        print("X LOCAL  GROUPSIZE=", self.xgroupsize)
+        print("Y LOCAL  GROUPSIZE=", self.ygroupsize)
+        print("Z LOCAL  GROUPSIZE=", ZGROUPSIZE)
 
-        compute_shader_source = compute_shader_source.replace("XGROUPSIZE_VAL", str(XGROUPSIZE)) \
-                                                     .replace("YGROUPSIZE_VAL", str(YGROUPSIZE)) \
-                                                     .replace("ZGROUPSIZE_VAL", str(ZGROUPSIZE))
+    def set_group_size(self, group_size):
+        self.xgroupsize, self.ygroupsize = group_size
+        self.all_shaders.group_size = (self.xgroupsize, self.ygroupsize, ZGROUPSIZE)
+        self.load_programs()
 
-        self.compute_shader = self.ctx.compute_shader(compute_shader_source)
+    def run_group_size(self, group_size):
+        # --autotune: one frame rendered with a candidate local size
+        self.set_group_size(group_size)
+        self.render_frame()
+
+    def load_programs(self):
+        # programs and their static uniforms / vertex arrays, reloaded after a shader change
+        self.quad_program = self.all_shaders.get_program("quad")
+
+        # compute shader
+        self.compute_shader = self.all_shaders.get_compute_program("ray", ACCUMULATE=int(self.accumulate), BVH=int(not self.brute_force), BVH_STACK=BVH_STACK)
+        self.scene_uniforms = None
 
         self.set_uniform(self.compute_shader, "SCREEN_WIDTH", self.screen_width)
         self.set_uniform(self.compute_shader, "SCREEN_HEIGHT", self.screen_height)
@@ -109,16 +210,40 @@ class App:
         self.compute_shader["out_texture"] = 0
         #self.compute_shader["out_texture2"] = 1 # layout(rgba8, binding = 1) uniform image2D out_texture2;
 
-        self.texture = self.ctx.texture((int(self.screen_width/1), int(self.screen_height/1)), 4, dtype='f1')
-        self.texture.filter = mgl.NEAREST, mgl.NEAREST # because when we access the image from a CS it is an Image2D (not Sampler2D)
-        #self.texture.bind_to_image(0, read=False, write=True)
-
         self.quad_program['quad_tex'] = 0
 
-        self.quad_vao = self.ctx.vertex_array(self.quad_program, [(quad_buffer, '2f 2f', 'vert', 'texcoord')])
+        if self.quad_vao:
+            self.quad_vao.release()
+        self.quad_vao = self.ctx.vertex_array(self.quad_program, [(self.quad_buffer, '2f 2f', 'vert', 'texcoord')])
 
     def destroy(self):
+        self.scene.destroy()
         self.all_shaders.destroy()
+        if self.accumulate:
+            self.accum_texture.release()
+        self.quad_vao.release()
+        self.quad_buffer.release()
+
+    def quit(self):
+        self.timer.flush()
+        if self.timings:
+            self.timer.dump(self.timings)
+
+        if self.record_video:
+            for data in self.readback.flush():
+                self.capture_frame(data)
+            self.video_recorder.end_recording()
+            print(f"Readback stall: {self.readback.get_stall_ms():.3f} ms/frame ({self.readback_buffers} buffer(s))")
+            self.readback.release()
+
+        self.destroy()
+        pg.quit()
+
+    def get_pixel_groups(self):
+        # one invocation per pixel, the invocations past the right / top borders are masked in the shader
+        group_x = (self.screen_width  + self.xgroupsize - 1) // self.xgroupsize
+        group_y = (self.screen_height + self.ygroupsize - 1) // self.ygroupsize
+        return group_x, group_y
 
     def set_uniform(self, program, u_name, u_value):
         try:
@@ -132,7 +257,13 @@ class App:
 
         if delta >= 1:
             fps = f"FPS: {self.fps.get_fps():3.0f}"
-            pg.display.set_caption(fps)
+            if self.accumulate:
+                fps += f" | SPP: {self.frame_index}"
+            timings = self.timer.get_summary()
+            if self.headless:
+                print(fps + " | " + timings)
+            else:
+                pg.display.set_caption(fps + " | " + timings)
 
             self.lastTime = self.currentTime
 
@@ -143,10 +274,7 @@ class App:
         for event in pg.event.get():
 
             if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
-                self.destroy()
-                if self.record_video:
-                    self.video_recorder.end_recording()
-                pg.quit()
+                self.quit()
                 sys.exit()
 
             if event.type == pg.KEYDOWN:
@@ -156,50 +284,143 @@ class App:
             if event.type == pg.KEYUP:
                 pass
 
-    def run(self):
+        self.move_camera()
+
+    def move_camera(self):
+        keys = pg.key.get_pressed()
+        velocity = CAM_SPEED * self.delta_time
+
+        if keys[pg.K_LEFT]:
+            self.cam_pos.x -= velocity
+        if keys[pg.K_RIGHT]:
+            self.cam_pos.x += velocity
+        if keys[pg.K_DOWN]:
+            self.cam_pos.y -= velocity
+        if keys[pg.K_UP]:
+            self.cam_pos.y += velocity
+        if keys[pg.K_PAGEUP]:
+            self.cam_pos.z -= velocity
+        if keys[pg.K_PAGEDOWN]:
+            self.cam_pos.z += velocity
+
+    def capture_frame(self, data):
+        self.video_recorder.capture_rgba(data)
+
+    def render_frame(self):
+        # shader hot reload, at the frame boundary
+        if self.all_shaders.reload():
+            self.load_programs()
+
+        self.time = pg.time.get_ticks() * 0.001
+
+        self.ctx.clear(color=(0.0, 0.0, 0.0))
+
+        if not self.pause:
+            self.set_uniform(self.compute_shader, "time", self.time)
+            self.set_uniform(self.compute_shader, "delta_time", self.delta_time)
+
+            # camera / scene, any change restarts the accumulation
+            uniforms = {"cam_pos": tuple(self.cam_pos), "NB_PRIMITIVE": self.scene.nb_primitive}
+            if uniforms != self.scene_uniforms:
+                for u_name, u_value in uniforms.items():
+                    self.set_uniform(self.compute_shader, u_name, u_value)
+                self.scene_uniforms = uniforms
+                self.frame_index = 0
+
+            self.set_uniform(self.compute_shader, "frame_index", self.frame_index)
+
+            # CS: layout(std430, binding = 1) readonly buffer bvh_nodes / layout(std430, binding = 2) readonly buffer scene_primitives
+            self.scene.ssbo_nodes.bind_to_storage_buffer(1)
+            self.scene.ssbo_primitives.bind_to_storage_buffer(2)
+
+            # CS: layout(rgba8, binding = 0) uniform image2D out_texture;
+            self.texture.bind_to_image(0, read=False, write=True) # glBindImageTexture(0, texHandle, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_R32F);
+
+            # CS: layout(rgba32f, binding = 1) uniform image2D accum_texture;
+            if self.accumulate:
+                self.accum_texture.bind_to_image(1, read=True, write=True)
+
+            group_x, group_y = self.get_pixel_groups()
+            with self.timer.gpu("compute"):
+                self.compute_shader.run(group_x=group_x, group_y=group_y, group_z=1)
+                #self.compute_shader.run(group_x= self.screen_width, group_y= self.screen_height, group_z=1)
+                self.ctx.memory_barrier()
 
-        while True:
-            self.time = pg.time.get_ticks() * 0.001
+            self.frame_index += 1
 
-            self.check_events()
+        # FS
+        with self.timer.gpu("quad"):
+            self.texture.use(location=0)
+            self.quad_vao.render(mode=mgl.TRIANGLE_STRIP)
 
-            self.ctx.clear(color=(0.0, 0.0, 0.0))
+    def end_frame(self):
+        self.delta_time = self.clock.tick(self.max_fps)
 
-            if not self.pause:
-                self.set_uniform(self.compute_shader, "time", self.time)
-                self.set_uniform(self.compute_shader, "delta_time", self.delta_time)
+        if self.sync:
+            self.ctx.finish()
 
-                # CS: layout(std430, binding = 0) buffer bodies_in
-                #self.bodies.ssbo_in.bind_to_storage_buffer(0)
+        self.timer.end_frame()
 
-                # CS: layout(rgba8, binding = 0) uniform image2D out_texture;
-                self.texture.bind_to_image(0, read=False, write=True) # glBindImageTexture(0, texHandle, 0, GL_FALSE, 0, GL_WRITE_ONLY, GL_R32F);
+        self.get_fps()
+        self.num_frames += 1
 
-                # Number of WorkGroup: self.screen_width//XGROUPSIZE * self.screen_height//YGROUPSIZE * 1
-                self.compute_shader.run(group_x= self.screen_width//XGROUPSIZE, group_y= self.screen_height//YGROUPSIZE, group_z=1)
-                #self.compute_shader.run(group_x= self.screen_width, group_y= self.screen_height, group_z=1)
+    def frames(self, count=-1):
+        """Render `count` frames (-1 for unlimited) and yield each one as a (height, width, 4) uint8 RGBA array.
 
-                self.ctx.memory_barrier()
+        The array is a top-down view of a single buffer reused for every frame: copy it to keep a frame.
+        """
+        frame = np.empty((self.screen_height, self.screen_width, 4), dtype=np.uint8)
 
-            # FS
-            self.texture.use(location=0)
-            self.quad_vao.render(mode=mgl.TRIANGLE_STRIP)
+        nb_frames = 0
+        while count < 0 or nb_frames < count:
+            nb_frames += 1
+
+            self.render_frame()
+            self.fbo.read_into(frame, components=4)
+            self.end_frame()
+
+            yield frame[::-1]
 
-            pg.display.flip()
+    def run(self):
+
+        start_time = time.perf_counter()
+
+        while self.max_frames < 0 or self.num_frames < self.max_frames:
+
+            if not self.headless:
+                self.check_events()
+
+            self.render_frame()
+
+            if not self.headless:
+                with self.timer.cpu("flip"):
+                    pg.display.flip()
 
             # record video
             if self.record_video:
-                pg_surface = pygame.image.fromstring(self.texture.read(), (self.texture.width, self.texture.height), 'RGBA', True)
-                self.video_recorder.capture_frame(pg_surface)
+                with self.timer.cpu("readback"):
+                    data = self.readback.read(self.texture)
+                    if data is not None:
+                        self.capture_frame(data)
 
-            self.delta_time = self.clock.tick(self.max_fps)
+            self.end_frame()
 
-            self.get_fps()
-            self.num_frames += 1
+        self.ctx.finish()
+        self.timer.flush()
+        elapsed = time.perf_counter() - start_time
+        print(f"Rendered {self.num_frames} frames in {elapsed:.3f}s ({self.num_frames / elapsed:.1f} FPS)")
+        print(f"Pass timings: {self.timer.get_summary()}")
+
+        self.quit()
 
 # -----------------------------------------------------------------------------------------------------------
 # python3 main.py --fps=-1
 # python3 main.py --fps=60 -rv="h264" -vfps=60
+# python3 main.py --headless --frames=1000 --size=1920x1080
+# python3 main.py --accumulate
+# python3 main.py --primitives=100000 --seed=42
+# python3 main.py --primitives=10000 --brute_force
+# python3 main.py --mesh=bunny.ply
 
 def main():
 
@@ -208,13 +429,31 @@ def main():
     parser.add_argument('-f', '--fps', help='Max FPS, -1 for unlimited', default=-1, type=int)
     parser.add_argument('-rv', '--record_video', help='', default="", type=str)
     parser.add_argument('-vfps', '--video_fps', help='', default=60, type=int)
+    parser.add_argument('-rb', '--readback_buffers', help='Number of PBOs for video readback, 1 for synchronous read', default=3, type=int)
+    parser.add_argument('--headless', help='Render offscreen without window (EGL context)', action='store_true')
+    parser.add_argument('--frames', help='Number of frames to render, -1 for unlimited', default=-1, type=int)
+    parser.add_argument('--size', help='Screen size WxH', default=f"{SCREEN_WIDTH}x{SCREEN_HEIGHT}", type=parse_size)
+    parser.add_argument('-g', '--group_size', help='Local work group size XxY of the compute shaders (default: autotuned or config)', default=None, type=parse_size)
+    parser.add_argument('--autotune', help='Time candidate local sizes on this device and keep the fastest one', action='store_true')
+    parser.add_argument('--hot_reload', help='Recompile the shaders when their source files change', action='store_true')
+    parser.add_argument('--timings', help='Save the per-frame pass timings to a .csv or .json file', default="", type=str)
+    parser.add_argument('--sync', help='Wait for the GPU at the end of each frame (per-frame times of benchmarks)', action='store_true')
+    parser.add_argument('--primitives', help='Number of random spheres / triangles, 0 for the single sphere scene', default=0, type=int)
+    parser.add_argument('-s', '--seed', help='Seed of the random scene, random if not set', default=None, type=int)
+    parser.add_argument('--mesh', help='Triangle mesh to trace (.ply / .obj), replaces the random scene', default="", type=str)
+    parser.add_argument('--brute_force', help='Intersect every primitive instead of traversing the BVH', action='store_true')
+    parser.add_argument('--accumulate', help='Progressive rendering: average 1 jittered sample per frame while the camera / scene do not change', action='store_true')
 
     result = parser.parse_args()
     args = dict(result._get_kwargs())
 
     print("Args = %s" % args)
 
-    app = App(screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, fps=args["fps"], record_video=args["record_video"], video_fps=args["video_fps"])
+    screen_width, screen_height = args["size"]
+
+    app = App(screen_width=screen_width, screen_height=screen_height, fps=args["fps"], record_video=args["record_video"], video_fps=args["video_fps"],
+              readback_buffers=args["readback_buffers"], headless=args["headless"], frames=args["frames"], hot_reload=args["hot_reload"], timings=args["timings"], group_size=args["group_size"], autotune=args["autotune"], sync=args["sync"], accumulate=args["accumulate"],
+              nb_primitive=args["primitives"], seed=args["seed"], brute_force=args["brute_force"], mesh=args["mesh"])
     app.run()
 
 if __name__ == "__main__":
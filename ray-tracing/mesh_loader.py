@@ -0,0 +1,272 @@
+import os, hashlib
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from config import MESH_CACHE_DIR, MESH_CHUNK
+from bvh import PRIMITIVE_DTYPE, TRIANGLE, build_bvh
+
+# -----------------------------------------------------------------------------------------------------------
+# Triangle meshes (binary / ascii PLY, OBJ) => primitives in the std430 layout of the compute shader.
+#
+# The parsed primitives are cached as .npy files (one per mesh file, size, mtime) and memory-mapped, so that the
+# next runs only page them in while they are uploaded. The files are read through np.memmap and parsed in chunks
+# of MESH_CHUNK bytes with vectorized NumPy operations (no Python loop on the lines / faces).
+
+PLY_TYPES = {"char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1", "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+             "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4", "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"}
+
+WHITESPACE = np.frombuffer(b" \t\r\n", dtype=np.uint8)
+NEWLINE, SPACE = ord("\n"), ord(" ")
+
+def triangulate(faces):
+    # (n, k) polygons => (n * (k - 2), 3) triangles, fan around the first vertex
+    k = faces.shape[1]
+    if k == 3:
+        return faces
+    fan = np.stack([np.zeros(k - 2, dtype=int), np.arange(1, k - 1), np.arange(2, k)], axis=1)
+    return faces[:, fan].reshape(-1, 3)
+
+def write_primitives(path, vertices, faces):
+    # triangles written straight into the memory-mapped .npy, MESH_CHUNK bytes at a time
+    primitives = open_memmap(path, mode='w+', dtype=PRIMITIVE_DTYPE, shape=(len(faces),))
+
+    step = max(MESH_CHUNK // PRIMITIVE_DTYPE.itemsize, 1)
+    for start in range(0, len(faces), step):
+        triangles = vertices[faces[start:start + step]]
+
+        chunk = np.zeros(len(triangles), dtype=PRIMITIVE_DTYPE)
+        chunk['a'][:, :3] = triangles[:, 0]
+        chunk['a'][:, 3]  = TRIANGLE
+        chunk['b'][:, :3] = triangles[:, 1]
+        chunk['c'][:, :3] = triangles[:, 2]
+        primitives[start:start + len(chunk)] = chunk
+
+    primitives.flush()
+    del primitives
+
+# -----------------------------------------------------------------------------------------------------------
+
+def read_ply_header(path):
+    with open(path, "rb") as file:
+        if file.readline().strip() != b"ply":
+            raise ValueError(f"{path}: not a PLY file")
+
+        ply_format, elements = None, []
+        while True:
+            line = file.readline()
+            if not line:
+                raise ValueError(f"{path}: no end_header")
+
+            words = line.decode("ascii").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "end_header":
+                return ply_format, elements, file.tell()
+
+            if words[0] == "format":
+                ply_format = words[1]
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property":
+                # scalar: (name, type) | list: (name, (count type, item type))
+                if words[1] == "list":
+                    elements[-1][2].append((words[4], (PLY_TYPES[words[2]], PLY_TYPES[words[3]])))
+                else:
+                    elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+
+def get_ply_dtype(properties, byte_order, list_size=None):
+    fields = []
+    for name, kind in properties:
+        if isinstance(kind, tuple):
+            fields += [(name + "_count", byte_order + kind[0]), (name, byte_order + kind[1], list_size)]
+        else:
+            fields.append((name, byte_order + kind))
+    return np.dtype(fields)
+
+def read_ply(path):
+    ply_format, elements, offset = read_ply_header(path)
+
+    vertices, faces = None, None
+
+    if ply_format == "ascii":
+        # every number of the body, the elements are consecutive rows
+        values = np.fromstring(np.memmap(path, dtype=np.uint8, mode='r', offset=offset).tobytes(), sep=" ")
+        position = 0
+
+        for name, count, properties in elements:
+            nb_scalar = sum(not isinstance(kind, tuple) for _, kind in properties)
+            if nb_scalar == len(properties):
+                rows = values[position:position + count * nb_scalar].reshape(count, nb_scalar)
+                position += count * nb_scalar
+            else:
+                # single list property of the same size on every row
+                list_size = int(values[position])
+                rows = values[position:position + count * (list_size + 1)].reshape(count, list_size + 1)
+                position += count * (list_size + 1)
+                if not np.all(rows[:, 0] == list_size):
+                    raise ValueError(f"{path}: faces of different sizes are not supported")
+
+            if name == "vertex":
+                names = [prop for prop, _ in properties]
+                vertices = rows[:, [names.index("x"), names.index("y"), names.index("z")]].astype(np.float32)
+            elif name == "face":
+                faces = rows[:, 1:].astype(np.int64)
+    else:
+        byte_order = "<" if ply_format == "binary_little_endian" else ">"
+
+        for name, count, properties in elements:
+            list_size = None
+            if any(isinstance(kind, tuple) for _, kind in properties):
+                # fixed size records with the size of the first list, checked on all the rows below
+                first = np.memmap(path, dtype=get_ply_dtype(properties, byte_order, 1), mode='r', offset=offset, shape=(1,))
+                list_size = int(first[[prop for prop, kind in properties if isinstance(kind, tuple)][0] + "_count"][0])
+
+            dtype = get_ply_dtype(properties, byte_order, list_size)
+            records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+            offset += count * dtype.itemsize
+
+            if name == "vertex":
+                vertices = np.empty((count, 3), dtype=np.float32)
+                for axis, prop in enumerate("xyz"):
+                    vertices[:, axis] = records[prop]
+            elif name == "face":
+                prop = [prop for prop, kind in properties if isinstance(kind, tuple)][0]
+                if not np.all(records[prop + "_count"] == list_size):
+                    raise ValueError(f"{path}: faces of different sizes are not supported")
+                faces = records[prop].astype(np.int64)
+                break
+
+    if vertices is None or faces is None:
+        raise ValueError(f"{path}: no vertex / face element")
+
+    return vertices, triangulate(faces)
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_lines(chunk, starts, keep):
+    # characters of the kept lines (first character, the keyword, blanked), with the start of each line in them
+    lengths = np.diff(np.append(starts, len(chunk)))
+    chars = chunk[np.repeat(keep, lengths)]
+
+    kept_lengths = lengths[keep]
+    kept_starts = np.cumsum(kept_lengths) - kept_lengths
+    chars[kept_starts] = SPACE
+    return chars, kept_starts
+
+def get_tokens_per_line(chars, line_starts):
+    is_space = np.isin(chars, WHITESPACE)
+    token_start = ~is_space & np.concatenate(([True], is_space[:-1]))
+    return np.add.reduceat(token_start.astype(np.int32), line_starts) if len(line_starts) else np.zeros(0, dtype=np.int32)
+
+def get_first_values(values, counts, nb_values):
+    # first nb_values of each line (x y z of "v x y z w" or "v x y z r g b")
+    if np.all(counts == nb_values):
+        return values.reshape(-1, nb_values)
+    first = np.cumsum(counts) - counts
+    return values[first[:, None] + np.arange(nb_values)]
+
+def parse_obj_chunk(chunk, nb_vertex):
+    starts = np.concatenate(([0], np.flatnonzero(chunk[:-1] == NEWLINE) + 1))
+    first, second = chunk[starts], chunk[np.minimum(starts + 1, len(chunk) - 1)]
+    separated = np.isin(second, WHITESPACE)
+
+    # "v x y z"
+    is_vertex = (first == ord("v")) & separated
+    chars, line_starts = get_lines(chunk, starts, is_vertex)
+    values = np.fromstring(chars.tobytes(), dtype=np.float32, sep=" ")
+    vertices = get_first_values(values, get_tokens_per_line(chars, line_starts), 3)
+
+    # "f v/vt/vn v/vt/vn v/vt/vn ...", the /vt/vn parts are blanked
+    is_face = (first == ord("f")) & separated
+    chars, line_starts = get_lines(chunk, starts, is_face)
+
+    index = np.arange(len(chars), dtype=np.int32)
+    last_space = np.maximum.accumulate(np.where(np.isin(chars, WHITESPACE), index, -1))
+    last_slash = np.maximum.accumulate(np.where(chars == ord("/"), index, -1))
+    chars[last_slash > last_space] = SPACE
+
+    counts = get_tokens_per_line(chars, line_starts)
+    indices = np.fromstring(chars.tobytes(), dtype=np.int64, sep=" ")
+
+    # 1-based, negative: relative to the vertices defined before the face
+    vertex_before = nb_vertex + np.cumsum(is_vertex)[is_face]
+    indices = np.where(indices < 0, indices + np.repeat(vertex_before, counts), indices - 1)
+
+    # polygons fanned around their first vertex
+    first_index = np.cumsum(counts) - counts
+    nb_triangles = counts - 2
+    fan_first = np.repeat(first_index, nb_triangles)
+    fan_rank = np.arange(nb_triangles.sum()) - np.repeat(np.cumsum(nb_triangles) - nb_triangles, nb_triangles)
+    faces = np.stack([indices[fan_first], indices[fan_first + fan_rank + 1], indices[fan_first + fan_rank + 2]], axis=1)
+
+    return vertices, faces.astype(np.int32 if nb_vertex + len(vertices) < 2**31 else np.int64)
+
+def read_obj(path):
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    vertices, faces = [], []
+    nb_vertex = 0
+
+    start = 0
+    while start < len(data):
+        # chunks cut after a newline
+        chunk = np.array(data[start:start + MESH_CHUNK])
+        if start + len(chunk) < len(data):
+            newlines = np.flatnonzero(chunk == NEWLINE)
+            if len(newlines) == 0:
+                raise ValueError(f"{path}: line longer than {MESH_CHUNK} bytes")
+            chunk = chunk[:newlines[-1] + 1]
+        elif chunk[-1] != NEWLINE:
+            chunk = np.append(chunk, np.uint8(NEWLINE))
+        start += len(chunk)
+
+        chunk_vertices, chunk_faces = parse_obj_chunk(chunk, nb_vertex)
+        vertices.append(chunk_vertices)
+        faces.append(chunk_faces)
+        nb_vertex += len(chunk_vertices)
+
+    return np.concatenate(vertices), np.concatenate(faces)
+
+# -----------------------------------------------------------------------------------------------------------
+
+def get_cache_path(path, suffix, cache_dir):
+    stat = os.stat(path)
+    key = hashlib.sha256(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:32]
+    return os.path.join(cache_dir, f"{key}{suffix}.npy")
+
+def load_mesh(path, cache_dir=MESH_CACHE_DIR):
+    """Primitives (PRIMITIVE_DTYPE) of the triangles of a .ply / .obj mesh, memory-mapped from the cache."""
+    cache_path = get_cache_path(path, "", cache_dir)
+
+    if not os.path.exists(cache_path):
+        if path.lower().endswith(".ply"):
+            vertices, faces = read_ply(path)
+        elif path.lower().endswith(".obj"):
+            vertices, faces = read_obj(path)
+        else:
+            raise ValueError(f"{path}: unsupported mesh format (.ply, .obj)")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        write_primitives(tmp_path, vertices, faces)
+        os.replace(tmp_path, cache_path)
+
+    return np.load(cache_path, mmap_mode='r')
+
+def load_mesh_bvh(path, nb_bins, max_leaf_size, max_depth, cache_dir=MESH_CACHE_DIR):
+    """BVH nodes and reordered primitives of a mesh, built once per mesh / parameters then memory-mapped."""
+    suffix = f"_bvh{nb_bins}_{max_leaf_size}_{max_depth}"
+    nodes_path = get_cache_path(path, suffix + "_nodes", cache_dir)
+    primitives_path = get_cache_path(path, suffix + "_primitives", cache_dir)
+
+    if not (os.path.exists(nodes_path) and os.path.exists(primitives_path)):
+        nodes, primitives = build_bvh(load_mesh(path, cache_dir), nb_bins=nb_bins, max_leaf_size=max_leaf_size, max_depth=max_depth)
+
+        for array, array_path in ((primitives, primitives_path), (nodes, nodes_path)):
+            tmp_path = f"{array_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, array_path)
+        del nodes, primitives
+
+    return np.load(nodes_path, mmap_mode='r'), np.load(primitives_path, mmap_mode='r')
@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+import glm
+
+from config import *
+from bvh import NODE_DTYPE, make_primitives, get_random_primitives, get_bounds, build_bvh
+from mesh_loader import load_mesh, load_mesh_bvh
+
+# -----------------------------------------------------------------------------------------------------------
+# Scenes of the ray model without OpenGL, shared by main.py (uploaded to the SSBOs) and cpu_render.py
+
+def load_scene(nb_primitive=0, seed=None, mesh="", brute_force=False):
+    """Nodes, primitives and (min, max) box of a scene: the --mesh, else nb_primitive random primitives (0: SPHERE)."""
+    t0 = time.perf_counter()
+
+    if mesh:
+        # memory-mapped from the mesh cache, parsed / built on the first run
+        if brute_force:
+            nodes, primitives = np.zeros(1, dtype=NODE_DTYPE), load_mesh(mesh)
+        else:
+            nodes, primitives = load_mesh_bvh(mesh, nb_bins=BVH_BINS, max_leaf_size=BVH_LEAF_SIZE, max_depth=BVH_STACK)
+        print(f"Mesh: {mesh}, {len(primitives)} triangles, {len(nodes)} nodes loaded in {time.perf_counter() - t0:.3f}s")
+    else:
+        if nb_primitive == 0:
+            primitives = make_primitives(spheres=[SPHERE])
+        else:
+            primitives = get_random_primitives(nb_primitive, *SCENE_BOX, seed=seed)
+
+        if brute_force:
+            # not read by the shader, bound anyway
+            nodes = np.zeros(1, dtype=NODE_DTYPE)
+        else:
+            nodes, primitives = build_bvh(primitives, nb_bins=BVH_BINS, max_leaf_size=BVH_LEAF_SIZE, max_depth=BVH_STACK)
+            print(f"BVH: {len(primitives)} primitives, {len(nodes)} nodes built in {time.perf_counter() - t0:.3f}s")
+
+    # box of the scene: root node, else the primitives
+    if brute_force:
+        bmin, bmax = get_bounds(primitives)
+        bounds = (bmin.min(axis=0), bmax.max(axis=0))
+    else:
+        bounds = (nodes['bmin'][0], nodes['bmax'][0])
+
+    return nodes, primitives, bounds
+
+def get_view_pos(bounds):
+    # camera in front of the mesh bounds (90 degrees field of view, looking down -z)
+    bmin, bmax = glm.vec3(bounds[0]), glm.vec3(bounds[1])
+    center = (bmin + bmax) * 0.5
+    return glm.vec3(center.x, center.y, bmax.z + 0.6 * max(bmax.x - bmin.x, bmax.y - bmin.y))
@@ -4,19 +4,68 @@
 #define YGROUPSIZE  YGROUPSIZE_VAL
 #define ZGROUPSIZE  ZGROUPSIZE_VAL
 
+// 1: progressive rendering, 1 jittered sample per frame averaged in accum_texture
+#define ACCUMULATE  ACCUMULATE_VAL
+
+// 1: BVH traversal (stack of BVH_STACK nodes, the max depth of the tree), 0: brute force loop on the primitives
+#define BVH         BVH_VAL
+#define BVH_STACK   BVH_STACK_VAL
+
+#define SPHERE      0
+#define TRIANGLE    1
+
+#define INF         1e30
+#define EPSILON     1e-4
+
 // Number of threads/invocation (per WorkGroup): XGROUPSIZE * YGROUPSIZE * ZGROUPSIZE
 layout(local_size_x=XGROUPSIZE, local_size_y=YGROUPSIZE, local_size_z=ZGROUPSIZE) in;
 //layout(local_size_x = 8, local_size_y = 8) in;
 
-layout(rgba32f, binding = 0) uniform image2D out_texture;
+layout(rgba8, binding = 0) uniform image2D out_texture;
 //layout(rgba8, binding = 1) uniform image2D out_texture2;
 
+#if ACCUMULATE
+layout(rgba32f, binding = 1) uniform image2D accum_texture;
+#endif
+
 uniform int   SCREEN_WIDTH;
 uniform int   SCREEN_HEIGHT;
 
 uniform float time;
 uniform int   delta_time;
 
+// camera (looking down -z), the accumulation is restarted by the application when it changes
+uniform vec3  cam_pos;
+
+uniform int   frame_index;  // number of samples already accumulated
+
+uniform int   NB_PRIMITIVE;
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+struct Node
+{
+    vec3 bmin;  int left_first;  // count == 0: children left_first, left_first + 1
+    vec3 bmax;  int count;       // count  > 0: leaf of the primitives [left_first, left_first + count[
+};
+
+struct Primitive
+{
+    vec4 a;  // sphere: center, type | triangle: v0, type
+    vec4 b;  // sphere: radius       | triangle: v1
+    vec4 c;  //                      | triangle: v2
+};
+
+layout(std430, binding = 1) readonly buffer bvh_nodes
+{
+    Node nodes[];
+} bvh;
+
+layout(std430, binding = 2) readonly buffer scene_primitives
+{
+    Primitive primitives[];
+} scene;
+
 // ---------------------------------------------------------------------------------------------------------------------
 
 ivec2 to_tex_coord(float posx, float posy) {
@@ -25,6 +74,204 @@ ivec2 to_tex_coord(float posx, float posy) {
 
 // ---------------------------------------------------------------------------------------------------------------------
 
+uint hash(uint state)
+{
+    state ^= 2747636419u;
+    state *= 2654435769u;
+    state ^= state >> 16;
+    state *= 2654435769u;
+    state ^= state >> 16;
+    state *= 2654435769u;
+    return state;
+}
+
+float random_01(inout uint state)
+{
+    state = hash(state);
+    return float(state) / 4294967295.0;
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
+// distance to the primitive along the ray, INF if missed
+float intersect_primitive(Primitive prim, vec3 ray_o, vec3 ray_d)
+{
+	if (int(prim.a.w) == SPHERE)
+	{
+		vec3 o_c = ray_o - prim.a.xyz;
+		float b = dot(ray_d, o_c);
+		float c = dot(o_c, o_c) - prim.b.x * prim.b.x;
+		float h = b * b - c;
+
+		if (h < 0.0) {
+			return INF;
+		}
+
+		h = sqrt(h);
+		float t = (-b - h > EPSILON) ? -b - h : -b + h;
+		return (t > EPSILON) ? t : INF;
+	}
+
+	// Moller-Trumbore
+	vec3 e1 = prim.b.xyz - prim.a.xyz;
+	vec3 e2 = prim.c.xyz - prim.a.xyz;
+	vec3 p = cross(ray_d, e2);
+	float det = dot(e1, p);
+
+	if (abs(det) < 1e-8) {
+		return INF;
+	}
+
+	float inv_det = 1.0 / det;
+	vec3 s = ray_o - prim.a.xyz;
+	float u = dot(s, p) * inv_det;
+	vec3 q = cross(s, e1);
+	float v = dot(ray_d, q) * inv_det;
+
+	if (u < 0.0 || v < 0.0 || u + v > 1.0) {
+		return INF;
+	}
+
+	float t = dot(e2, q) * inv_det;
+	return (t > EPSILON) ? t : INF;
+}
+
+vec3 get_normal(Primitive prim, vec3 pos)
+{
+	if (int(prim.a.w) == SPHERE) {
+		return normalize(pos - prim.a.xyz);
+	}
+	return normalize(cross(prim.b.xyz - prim.a.xyz, prim.c.xyz - prim.a.xyz));
+}
+
+// slab test: entry distance in the box, INF if missed or farther than t_max
+float intersect_box(vec3 bmin, vec3 bmax, vec3 ray_o, vec3 inv_d, float t_max)
+{
+	vec3 t0 = (bmin - ray_o) * inv_d;
+	vec3 t1 = (bmax - ray_o) * inv_d;
+	vec3 t_near = min(t0, t1);
+	vec3 t_far = max(t0, t1);
+
+	float t_enter = max(max(t_near.x, t_near.y), max(t_near.z, 0.0));
+	float t_exit = min(min(t_far.x, t_far.y), min(t_far.z, t_max));
+
+	return (t_enter <= t_exit) ? t_enter : INF;
+}
+
+// closest primitive along the ray: t, index (-1 if none)
+vec2 intersect_scene(vec3 ray_o, vec3 ray_d)
+{
+	float t_hit = INF;
+	int hit = -1;
+
+#if BVH
+	vec3 inv_d = 1.0 / ray_d;
+
+	// near child first, the far one is pushed with its entry distance and skipped if a closer hit was found meanwhile
+	int stack_node[BVH_STACK];
+	float stack_t[BVH_STACK];
+	int stack_size = 0;
+
+	int node = 0;
+	if (intersect_box(bvh.nodes[0].bmin, bvh.nodes[0].bmax, ray_o, inv_d, t_hit) == INF) {
+		return vec2(t_hit, hit);
+	}
+
+	while (true)
+	{
+		Node n = bvh.nodes[node];
+
+		if (n.count > 0)
+		{
+			for (int i = n.left_first; i < n.left_first + n.count; i++)
+			{
+				float t = intersect_primitive(scene.primitives[i], ray_o, ray_d);
+				if (t < t_hit) {
+					t_hit = t;
+					hit = i;
+				}
+			}
+		}
+		else
+		{
+			int near = n.left_first;
+			int far = n.left_first + 1;
+			float t_near = intersect_box(bvh.nodes[near].bmin, bvh.nodes[near].bmax, ray_o, inv_d, t_hit);
+			float t_far = intersect_box(bvh.nodes[far].bmin, bvh.nodes[far].bmax, ray_o, inv_d, t_hit);
+
+			if (t_far < t_near) {
+				int tmp_node = near; near = far; far = tmp_node;
+				float tmp_t = t_near; t_near = t_far; t_far = tmp_t;
+			}
+
+			if (t_near < INF)
+			{
+				if (t_far < INF) {
+					stack_node[stack_size] = far;
+					stack_t[stack_size] = t_far;
+					stack_size++;
+				}
+				node = near;
+				continue;
+			}
+		}
+
+		// pop the next node still in front of the closest hit
+		node = -1;
+		while (stack_size > 0)
+		{
+			stack_size--;
+			if (stack_t[stack_size] < t_hit) {
+				node = stack_node[stack_size];
+				break;
+			}
+		}
+
+		if (node < 0) {
+			break;
+		}
+	}
+#else
+	for (int i = 0; i < NB_PRIMITIVE; i++)
+	{
+		float t = intersect_primitive(scene.primitives[i], ray_o, ray_d);
+		if (t < t_hit) {
+			t_hit = t;
+			hit = i;
+		}
+	}
+#endif
+
+	return vec2(t_hit, hit);
+}
+
+vec3 trace(vec2 pixel_pos, ivec2 dims)
+{
+	vec3 pixel = vec3(0.075, 0.133, 0.173);
+
+	float x = (pixel_pos.x * 2.0 - dims.x) / dims.x;
+	float y = (pixel_pos.y * 2.0 - dims.y) / dims.x; // .y
+
+	vec3 ray_o = cam_pos;
+	vec3 ray_d = normalize(vec3(x, y, -1.0));
+
+	vec2 hit = intersect_scene(ray_o, ray_d);
+
+	if (hit.y >= 0.0)
+	{
+		vec3 intersection = ray_o + ray_d * hit.x;
+		vec3 normal = get_normal(scene.primitives[int(hit.y)], intersection);
+
+		// triangles are seen from both sides
+		normal = faceforward(normal, ray_d, normal);
+		pixel = (normal + 1.0) / 2.0;
+	}
+
+	return pixel;
+}
+
+// ---------------------------------------------------------------------------------------------------------------------
+
 void main()
 {
     // Def: gl_GlobalInvocationID = gl_WorkGroupID * gl_WorkGroupSize + gl_LocalInvocationID
@@ -45,34 +292,32 @@ void main()
     // vec4 color = vec4(local, global, 0.0, 1.0);
     // imageStore(out_texture, tex_coord2, color);
 
-	vec4 pixel = vec4(0.075, 0.133, 0.173, 1.0);
 	ivec2 pixel_coords = ivec2(gl_GlobalInvocationID.xy);
-	
+
 	ivec2 dims = imageSize(out_texture);
-	float x = -(float(pixel_coords.x * 2 - dims.x) / dims.x); 
-	float y = -(float(pixel_coords.y * 2 - dims.y) / dims.x); // .y
 
-	//float fov = 90.0;
-	//vec3 cam_o = vec3(0.0, 0.0, -tan(fov / 2.0));
-	vec3 cam_o = vec3(0.0, 0.0, -1);
-	vec3 ray_o = vec3(x, y, 0.0);
-	vec3 ray_d = normalize(ray_o - cam_o);
+	// ceil-divided dispatch: partial work groups on the right / top borders
+	if (pixel_coords.x >= dims.x || pixel_coords.y >= dims.y) {
+		return;
+	}
 
-	vec3 sphere_c = vec3(0.0, 0.0, -5.0);
-	float sphere_r = 1.0;
+#if ACCUMULATE
+	// jittered sample in the pixel, running average of the frame_index + 1 samples
+	uint state = hash(uint(pixel_coords.y * dims.x + pixel_coords.x) ^ hash(uint(frame_index)));
+	vec2 jitter = vec2(random_01(state), random_01(state));
 
-	vec3 o_c = ray_o - sphere_c;
-	float b = dot(ray_d, o_c);
-	float c = dot(o_c, o_c) - sphere_r * sphere_r;
-	float intersectionState = b * b - c;
-	vec3 intersection = ray_o + ray_d * (-b + sqrt(b * b - c));
+	vec3 color = trace(vec2(pixel_coords) + jitter, dims);
 
-	if (intersectionState >= 0.0)
-	{
-		pixel = vec4((normalize(intersection - sphere_c) + 1.0) / 2.0, 1.0);
+	if (frame_index > 0) {
+		color = mix(imageLoad(accum_texture, pixel_coords).rgb, color, 1.0 / float(frame_index + 1));
 	}
 
-	imageStore(out_texture, pixel_coords, pixel);
+	imageStore(accum_texture, pixel_coords, vec4(color, 1.0));
+#else
+	vec3 color = trace(vec2(pixel_coords) + 0.5, dims);
+#endif
+
+	imageStore(out_texture, pixel_coords, vec4(color, 1.0));
 
     //memoryBarrierImage();
     //memoryBarrier();